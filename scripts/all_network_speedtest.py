@@ -15,15 +15,17 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-import csv
+import atexit
 import datetime
 import errno
+import heapq
 import math
 import os
-import platform
 import re
+import select
 import signal
 import socket
+import struct
 import sys
 import threading
 import timeit
@@ -37,6 +39,11 @@ except ImportError:
     gzip = None
     GZIP_BASE = object
 
+try:
+    import zlib
+except ImportError:
+    zlib = None
+
 __version__ = "2.1.4b1"
 
 
@@ -70,19 +77,6 @@ except ImportError:
     except ImportError:
         json = None
 
-try:
-    import xml.etree.ElementTree as ET
-
-    try:
-        from xml.etree.ElementTree import _Element as ET_Element
-    except ImportError:
-        pass
-except ImportError:
-    from xml.dom import minidom as DOM
-    from xml.parsers.expat import ExpatError
-
-    ET = None
-
 try:
     from urllib2 import (
         urlopen,
@@ -314,11 +308,6 @@ except ImportError:
     ssl = None
     HTTP_ERRORS = (HTTPError, URLError, socket.error, BadStatusLine)
 
-if PY32PLUS:
-    etree_iter = ET.Element.iter
-elif PY25PLUS:
-    etree_iter = ET_Element.getiterator
-
 if PY26PLUS:
     thread_is_alive = threading.Thread.is_alive
 else:
@@ -332,6 +321,40 @@ def event_is_set(event):
         return event.isSet()
 
 
+def socket_unacked(sock):
+    """Return the bytes written to ``sock`` that the peer has not
+    acknowledged yet, None where the platform does not tell
+    """
+
+    # Only Linux reports the bytes a TCP socket still waits to have
+    # acknowledged
+    if sock is None or not sys.platform.startswith("linux"):
+        return None
+    try:
+        import fcntl
+        import termios
+
+        queued = fcntl.ioctl(sock.fileno(), termios.TIOCOUTQ, struct.pack("i", 0))
+    except (ImportError, AttributeError, IOError, OSError, ValueError):
+        return None
+    return struct.unpack("i", queued)[0]
+
+
+def socket_discard(sock):
+    """Make closing ``sock`` reset the connection, dropping what is still
+    queued for sending instead of delivering it in the background
+    """
+
+    if sock is None:
+        return
+    # struct linger holds two u_short on Windows
+    linger = struct.pack(("ii", "HH")[sys.platform == "win32"], 1, 0)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, linger)
+    except (socket.error, AttributeError):
+        pass
+
+
 class SpeedtestException(Exception):
     """Base exception for this module"""
 
@@ -402,7 +425,32 @@ class SpeedtestMissingBestServer(SpeedtestException):
     """get_best_server not called or not able to determine best server"""
 
 
-def create_connection(address, timeout=_GLOBAL_DEFAULT_TIMEOUT, source_address=None):
+class SpeedtestSiteLockTimeout(SpeedtestException):
+    """No site slot became free before the wait timed out"""
+
+
+class SpeedtestThresholdFailure(SpeedtestException):
+    """Results did not meet the thresholds given on the command line,
+    ``code`` being the exit code to report
+
+    The codes are set apart from 1, reported for any error, and 2, used
+    by argparse for invalid arguments, so a check can tell a slow link
+    from a test that could not run
+    """
+
+    # An absolute threshold failed
+    failed = 3
+    # Only the comparison with the history did
+    dropped = 4
+
+    def __init__(self, code):
+        SpeedtestException.__init__(self, code)
+        self.code = code
+
+
+def create_connection(
+    address, timeout=_GLOBAL_DEFAULT_TIMEOUT, source_address=None, family=0
+):
     """Connect to *address* and return the socket object.
 
     Convenience function.  Connect to *address* (a 2-tuple ``(host,
@@ -412,14 +460,16 @@ def create_connection(address, timeout=_GLOBAL_DEFAULT_TIMEOUT, source_address=N
     global default timeout setting returned by :func:`getdefaulttimeout`
     is used.  If *source_address* is set it must be a tuple of (host, port)
     for the socket to bind as a source address before making the connection.
-    An host of '' or port 0 tells the OS to use the default.
+    An host of '' or port 0 tells the OS to use the default. A *family* of
+    ``socket.AF_INET`` or ``socket.AF_INET6`` only tries addresses of that
+    family.
 
     Largely vendored from Python 2.7, modified to work with Python 2.4
     """
 
     host, port = address
     err = None
-    for res in socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM):
+    for res in socket.getaddrinfo(host, port, family, socket.SOCK_STREAM):
         af, socktype, proto, canonname, sa = res
         sock = None
         try:
@@ -450,6 +500,7 @@ class SpeedtestHTTPConnection(HTTPConnection):
     def __init__(self, *args, **kwargs):
         source_address = kwargs.pop("source_address", None)
         timeout = kwargs.pop("timeout", 10)
+        family = kwargs.pop("family", 0)
 
         self._tunnel_host = None
 
@@ -457,17 +508,26 @@ class SpeedtestHTTPConnection(HTTPConnection):
 
         self.source_address = source_address
         self.timeout = timeout
+        self.family = family
+        # Python 3.7+ sends file like bodies in blocks of this size
+        self.blocksize = SpeedtestTransferMeter.chunk_size
 
     def connect(self):
         """Connect to the host and port specified in __init__."""
-        try:
-            self.sock = socket.create_connection(
-                (self.host, self.port), self.timeout, self.source_address
-            )
-        except (AttributeError, TypeError):
+        if self.family:
+            # socket.create_connection can not be limited to a family
             self.sock = create_connection(
-                (self.host, self.port), self.timeout, self.source_address
+                (self.host, self.port), self.timeout, self.source_address, self.family
             )
+        else:
+            try:
+                self.sock = socket.create_connection(
+                    (self.host, self.port), self.timeout, self.source_address
+                )
+            except (AttributeError, TypeError):
+                self.sock = create_connection(
+                    (self.host, self.port), self.timeout, self.source_address
+                )
 
         if self._tunnel_host:
             self._tunnel()
@@ -485,6 +545,7 @@ if HTTPSConnection:
         def __init__(self, *args, **kwargs):
             source_address = kwargs.pop("source_address", None)
             timeout = kwargs.pop("timeout", 10)
+            family = kwargs.pop("family", 0)
 
             self._tunnel_host = None
 
@@ -492,17 +553,28 @@ if HTTPSConnection:
 
             self.timeout = timeout
             self.source_address = source_address
+            self.family = family
+            self.ssl_session = None
+            self.blocksize = SpeedtestTransferMeter.chunk_size
 
         def connect(self):
             "Connect to a host on a given (SSL) port."
-            try:
-                self.sock = socket.create_connection(
-                    (self.host, self.port), self.timeout, self.source_address
-                )
-            except (AttributeError, TypeError):
+            if self.family:
                 self.sock = create_connection(
-                    (self.host, self.port), self.timeout, self.source_address
+                    (self.host, self.port),
+                    self.timeout,
+                    self.source_address,
+                    self.family,
                 )
+            else:
+                try:
+                    self.sock = socket.create_connection(
+                        (self.host, self.port), self.timeout, self.source_address
+                    )
+                except (AttributeError, TypeError):
+                    self.sock = create_connection(
+                        (self.host, self.port), self.timeout, self.source_address
+                    )
 
             if self._tunnel_host:
                 self._tunnel()
@@ -515,6 +587,8 @@ if HTTPSConnection:
                             kwargs["server_hostname"] = self._tunnel_host
                         else:
                             kwargs["server_hostname"] = self.host
+                        if self.ssl_session is not None:
+                            kwargs["session"] = self.ssl_session
                     self.sock = self._context.wrap_socket(self.sock, **kwargs)
                 except AttributeError:
                     self.sock = ssl.wrap_socket(self.sock)
@@ -537,7 +611,7 @@ if HTTPSConnection:
                 )
 
 
-def _build_connection(connection, source_address, timeout, context=None):
+def _build_connection(connection, source_address, timeout, context=None, family=0):
     """Cross Python 2.4 - Python 3 callable to build an ``HTTPConnection`` or
     ``HTTPSConnection`` with the args we need
 
@@ -546,7 +620,9 @@ def _build_connection(connection, source_address, timeout, context=None):
     """
 
     def inner(host, **kwargs):
-        kwargs.update({"source_address": source_address, "timeout": timeout})
+        kwargs.update(
+            {"source_address": source_address, "timeout": timeout, "family": family}
+        )
         if context:
             kwargs["context"] = context
         return connection(host, **kwargs)
@@ -556,18 +632,22 @@ def _build_connection(connection, source_address, timeout, context=None):
 
 class SpeedtestHTTPHandler(AbstractHTTPHandler):
     """Custom ``HTTPHandler`` that can build a ``HTTPConnection`` with the
-    args we need for ``source_address`` and ``timeout``
+    args we need for ``source_address``, ``timeout`` and ``family``
     """
 
-    def __init__(self, debuglevel=0, source_address=None, timeout=10):
+    def __init__(self, debuglevel=0, source_address=None, timeout=10, family=0):
         AbstractHTTPHandler.__init__(self, debuglevel)
         self.source_address = source_address
         self.timeout = timeout
+        self.family = family
 
     def http_open(self, req):
         return self.do_open(
             _build_connection(
-                SpeedtestHTTPConnection, self.source_address, self.timeout
+                SpeedtestHTTPConnection,
+                self.source_address,
+                self.timeout,
+                family=self.family,
             ),
             req,
         )
@@ -577,14 +657,17 @@ class SpeedtestHTTPHandler(AbstractHTTPHandler):
 
 class SpeedtestHTTPSHandler(AbstractHTTPHandler):
     """Custom ``HTTPSHandler`` that can build a ``HTTPSConnection`` with the
-    args we need for ``source_address`` and ``timeout``
+    args we need for ``source_address``, ``timeout`` and ``family``
     """
 
-    def __init__(self, debuglevel=0, context=None, source_address=None, timeout=10):
+    def __init__(
+        self, debuglevel=0, context=None, source_address=None, timeout=10, family=0
+    ):
         AbstractHTTPHandler.__init__(self, debuglevel)
         self._context = context
         self.source_address = source_address
         self.timeout = timeout
+        self.family = family
 
     def https_open(self, req):
         return self.do_open(
@@ -593,6 +676,7 @@ class SpeedtestHTTPSHandler(AbstractHTTPHandler):
                 self.source_address,
                 self.timeout,
                 context=self._context,
+                family=self.family,
             ),
             req,
         )
@@ -600,11 +684,252 @@ class SpeedtestHTTPSHandler(AbstractHTTPHandler):
     https_request = AbstractHTTPHandler.do_request_
 
 
-def build_opener(source_address=None, timeout=10):
+def _connection_dropped(conn):
+    """Determine if an idle pooled connection has been closed by the
+    remote end, in which case it is readable (EOF) or has no socket
+    """
+
+    sock = conn.sock
+    if sock is None:
+        return True
+    try:
+        return bool(select.select([sock], [], [], 0)[0])
+    except (select.error, ValueError, socket.error):
+        return True
+
+
+class SpeedtestConnectionPool(object):
+    """Per host pool of persistent ``HTTPConnection``/``HTTPSConnection``
+    objects, so the sized test requests reuse sockets, and TLS sessions
+    when ``--secure`` is used, instead of paying a handshake per request
+    """
+
+    def __init__(self, source_address=None, timeout=10, context=None, family=0):
+        self.source_address = source_address
+        self.timeout = timeout
+        self.family = family
+
+        # TLS sessions can only be resumed from the context that created
+        # them, so all pooled HTTPS connections share a single one
+        if context is None and ssl and hasattr(ssl, "create_default_context"):
+            context = ssl.create_default_context()
+        self._context = context
+
+        self._idle = {}
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get(self, scheme, host):
+        """Return an idle connection to ``host``, or a new unconnected
+        one if none are available
+        """
+
+        key = (scheme, host)
+        self._lock.acquire()
+        try:
+            idle = self._idle.get(key, [])
+            while idle:
+                conn = idle.pop()
+                if not _connection_dropped(conn):
+                    return conn
+                conn.close()
+            session = self._sessions.get(key)
+        finally:
+            self._lock.release()
+
+        kwargs = {
+            "source_address": self.source_address,
+            "timeout": self.timeout,
+            "family": self.family,
+        }
+        if scheme == "https":
+            if self._context:
+                kwargs["context"] = self._context
+            conn = SpeedtestHTTPSConnection(host, **kwargs)
+            conn.ssl_session = session
+        else:
+            conn = SpeedtestHTTPConnection(host, **kwargs)
+        return conn
+
+    def put(self, scheme, host, conn):
+        """Return a connection with no outstanding response to the pool"""
+
+        key = (scheme, host)
+        session = getattr(conn.sock, "session", None)
+        self._lock.acquire()
+        try:
+            if session is not None:
+                self._sessions[key] = session
+            self._idle.setdefault(key, []).append(conn)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """Close all idle connections"""
+
+        self._lock.acquire()
+        try:
+            for idle in self._idle.values():
+                for conn in idle:
+                    conn.close()
+            self._idle.clear()
+        finally:
+            self._lock.release()
+
+
+class SpeedtestPooledResponse(object):
+    """File like wrapper around a response read from a pooled connection,
+    that hands the connection back to the pool on ``close``
+    """
+
+    def __init__(self, response, url, release):
+        self._response = response
+        self._release = release
+        self.code = self.status = response.status
+        self.msg = response.reason
+        self.headers = response.msg
+        self.url = url
+        # None where the response can not read into a buffer (Python 2)
+        self.readinto = getattr(response, "readinto", None)
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.url
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def read(self, amt=None):
+        return self._response.read(amt)
+
+    def close(self):
+        response = self._response
+        if self._release is None:
+            return
+        release = self._release
+        self._release = None
+
+        # Drain short leftovers, such as the ``size=`` body from an upload,
+        # so the connection can still be reused
+        length = getattr(response, "length", None)
+        if not response.isclosed() and length is not None and length <= 65536:
+            try:
+                response.read()
+            except HTTP_ERRORS:
+                pass
+
+        reusable = response.isclosed() and not response.will_close
+        response.close()
+        release(reusable)
+
+
+class SpeedtestKeepAliveHandler(AbstractHTTPHandler):
+    """Custom ``HTTPHandler``/``HTTPSHandler`` that sends requests over
+    persistent connections borrowed from a ``SpeedtestConnectionPool``
+    """
+
+    def __init__(self, pool, debuglevel=0):
+        AbstractHTTPHandler.__init__(self, debuglevel)
+        self._pool = pool
+
+    def http_open(self, req):
+        return self._pooled_open("http", SpeedtestHTTPConnection, req)
+
+    def https_open(self, req):
+        return self._pooled_open("https", SpeedtestHTTPSConnection, req)
+
+    http_request = AbstractHTTPHandler.do_request_
+    https_request = AbstractHTTPHandler.do_request_
+
+    def _pooled_open(self, scheme, connection, req):
+        if getattr(req, "_tunnel_host", None):
+            # Leave proxy tunnelling to the stock implementation
+            return self.do_open(
+                _build_connection(
+                    connection,
+                    self._pool.source_address,
+                    self._pool.timeout,
+                    family=self._pool.family,
+                ),
+                req,
+            )
+
+        try:
+            host = req.get_host()
+            selector = req.get_selector()
+        except AttributeError:
+            host = req.host
+            selector = req.selector
+
+        headers = dict(req.unredirected_hdrs)
+        for name, value in req.headers.items():
+            if name not in headers:
+                headers[name] = value
+        headers["Connection"] = "keep-alive"
+        headers = dict((name.title(), value) for name, value in headers.items())
+
+        method = req.get_method()
+        data = getattr(req, "data", None)
+
+        def connect():
+            conn.connect()
+            # Headers and body are sent separately, without this the body
+            # can wait on a delayed ACK once the connection is reused
+            conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        def send():
+            if isinstance(data, HTTPUploaderData):
+                # So the body can follow how much of it the server received
+                data.sock = conn.sock
+            conn.request(method, selector, data, headers)
+            return conn.getresponse()
+
+        conn = self._pool.get(scheme, host)
+        reused = conn.sock is not None
+        try:
+            if not reused:
+                connect()
+            try:
+                response = send()
+            except (socket.error, BadStatusLine):
+                # The server may have closed an idle connection between our
+                # liveness check and the request, retry once if it is safe.
+                # A body can be sent again if it can be read from the start
+                rewind = getattr(data, "rewind", None)
+                if not reused or (data is not None and rewind is None):
+                    raise
+                if rewind is not None:
+                    rewind()
+                conn.close()
+                connect()
+                response = send()
+        except Exception:
+            if data is not None:
+                # Drop the rest of a body cut off midway, rather than let it
+                # drain into the next test
+                socket_discard(conn.sock)
+            conn.close()
+            raise
+
+        def release(reusable):
+            if reusable:
+                self._pool.put(scheme, host, conn)
+            else:
+                conn.close()
+
+        return SpeedtestPooledResponse(response, req.get_full_url(), release)
+
+
+def build_opener(source_address=None, timeout=10, pool=None, family=0):
     """Function similar to ``urllib2.build_opener`` that will build
     an ``OpenerDirector`` with the explicit handlers we want,
-    ``source_address`` for binding, ``timeout`` and our custom
-    `User-Agent`
+    ``source_address`` for binding, ``timeout``, the address ``family``
+    to connect over and our custom `User-Agent`
+
+    If a ``SpeedtestConnectionPool`` is supplied as ``pool``, HTTP and
+    HTTPS requests are sent over persistent connections from that pool
     """
 
     printer("Timeout set to %d" % timeout, debug=True)
@@ -615,14 +940,23 @@ def build_opener(source_address=None, timeout=10):
     else:
         source_address_tuple = None
 
-    handlers = [
-        ProxyHandler(),
-        SpeedtestHTTPHandler(source_address=source_address_tuple, timeout=timeout),
-        SpeedtestHTTPSHandler(source_address=source_address_tuple, timeout=timeout),
-        HTTPDefaultErrorHandler(),
-        HTTPRedirectHandler(),
-        HTTPErrorProcessor(),
-    ]
+    if pool is not None:
+        transport_handlers = [SpeedtestKeepAliveHandler(pool)]
+    else:
+        transport_handlers = [
+            SpeedtestHTTPHandler(
+                source_address=source_address_tuple, timeout=timeout, family=family
+            ),
+            SpeedtestHTTPSHandler(
+                source_address=source_address_tuple, timeout=timeout, family=family
+            ),
+        ]
+
+    handlers = (
+        [ProxyHandler()]
+        + transport_handlers
+        + [HTTPDefaultErrorHandler(), HTTPRedirectHandler(), HTTPErrorProcessor()]
+    )
 
     opener = OpenerDirector()
     opener.addheaders = [("User-agent", build_user_agent())]
@@ -666,6 +1000,29 @@ class GzipDecodedResponse(GZIP_BASE):
             self.io.close()
 
 
+class GzipStreamingResponse(object):
+    """A file-like object to incrementally decode a response encoded with
+    the gzip method as it is read, without buffering the whole body
+    """
+
+    def __init__(self, response):
+        self.response = response
+        # 16 + MAX_WBITS tells zlib to expect a gzip header and trailer
+        self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def read(self, n=1024):
+        while 1:
+            chunk = self.response.read(n)
+            if not chunk:
+                return self._decoder.flush()
+            data = self._decoder.decompress(chunk)
+            if data:
+                return data
+
+    def close(self):
+        self.response.close()
+
+
 def get_exception():
     """Helper function to work with py2.4-py3 for getting the current
     exception in a try/except block
@@ -673,6 +1030,28 @@ def get_exception():
     return sys.exc_info()[1]
 
 
+def cpu_time():
+    """CPU time used by this process so far, in seconds"""
+    try:
+        return timeit.time.process_time()
+    except AttributeError:
+        # Python 3.2 and older
+        times = os.times()
+        return times[0] + times[1]
+
+
+def import_optional(name):
+    """Import and return the module ``name``, or None if it is not available
+
+    Modules only some code paths need, such as sqlite3 and csv, are
+    imported where they are used instead of at startup
+    """
+    try:
+        return __import__(name, {}, {}, ["__name__"])
+    except ImportError:
+        return None
+
+
 def distance(origin, destination):
     """Determine distance between 2 sets of [lat,lon] in km"""
 
@@ -691,9 +1070,23 @@ def distance(origin, destination):
     return d
 
 
+def unit_vector(lat, lon):
+    """Convert a [lat,lon] pair to a point on the unit sphere"""
+
+    lat = math.radians(lat)
+    lon = math.radians(lon)
+    return (
+        math.cos(lat) * math.cos(lon),
+        math.cos(lat) * math.sin(lon),
+        math.sin(lat),
+    )
+
+
 def build_user_agent():
     """Build a Mozilla/5.0 compatible User-Agent string"""
 
+    import platform
+
     ua_tuple = (
         "Mozilla/5.0",
         "(%s; U; %s; en-us)" % (platform.platform(), platform.architecture()[0]),
@@ -767,10 +1160,13 @@ def catch_request(request, opener=None):
         return None, e
 
 
-def get_response_stream(response):
+def get_response_stream(response, streaming=False):
     """Helper function to return either a Gzip reader if
     ``Content-Encoding`` is ``gzip`` otherwise the response itself
 
+    With ``streaming``, gzip content is decoded incrementally as it is
+    read instead of being buffered in full first
+
     """
 
     try:
@@ -779,6 +1175,8 @@ def get_response_stream(response):
         getheader = response.getheader
 
     if getheader("content-encoding") == "gzip":
+        if streaming and zlib:
+            return GzipStreamingResponse(response)
         return GzipDecodedResponse(response)
 
     return response
@@ -816,127 +1214,812 @@ def do_nothing(*args, **kwargs):
     pass
 
 
-class HTTPDownloader(threading.Thread):
-    """Thread class for retrieving a URL"""
+class SpeedtestProfile(object):
+    """Wall clock and CPU time spent in each phase of a test
 
-    def __init__(self, i, request, start, timeout, opener=None, shutdown_event=None):
-        threading.Thread.__init__(self)
-        self.request = request
-        self.result = [0]
-        self.starttime = start
-        self.timeout = timeout
-        self.i = i
-        if opener:
-            self._opener = opener.open
-        else:
-            self._opener = urlopen
+    ``phases`` maps the name of every phase stopped so far to its ``wall``
+    and ``cpu`` seconds, and the ``cpu_utilization`` of the whole process
+    over the phase, where 1.0 is one core kept busy. Phases that moved
+    data also have their ``bytes``, the CPU seconds spent per Gbit, the
+    most ``streams`` they ran at once and the most ``threads`` the
+    process was running meanwhile
+    """
 
-        if shutdown_event:
-            self._shutdown_event = shutdown_event
-        else:
-            self._shutdown_event = FakeShutdownEvent()
+    # CPU utilization from which a phase is considered limited by the
+    # client rather than the network, the GIL keeps most of the work on a
+    # single core
+    cpu_bound = 0.8
 
-    def run(self):
-        try:
-            if (timeit.default_timer() - self.starttime) <= self.timeout:
-                f = self._opener(self.request)
-                while (
-                    not event_is_set(self._shutdown_event)
-                    and (timeit.default_timer() - self.starttime) <= self.timeout
-                ):
-                    self.result.append(len(f.read(10240)))
-                    if self.result[-1] == 0:
-                        break
-                f.close()
-        except IOError:
-            pass
-        except HTTP_ERRORS:
-            pass
+    def __init__(self):
+        self.phases = {}
+        self._started = {}
 
+    def start(self, phase):
+        self._started[phase] = (timeit.default_timer(), cpu_time())
 
-class HTTPUploaderData(object):
-    """File like object to improve cutting off the upload once the timeout
-    has been reached
-    """
+    def stop(self, phase, bytes=None, streams=None, threads=None):
+        """Record ``phase`` as finished and return its entry, None if it
+        was not started
+        """
 
-    def __init__(self, length, start, timeout, shutdown_event=None):
-        self.length = length
-        self.start = start
-        self.timeout = timeout
+        try:
+            wall, cpu = self._started.pop(phase)
+        except KeyError:
+            return None
+        wall = timeit.default_timer() - wall
+        cpu = cpu_time() - cpu
+
+        entry = {"wall": round(wall, 4), "cpu": round(cpu, 4)}
+        if wall > 0:
+            entry["cpu_utilization"] = round(cpu / wall, 3)
+        if bytes is not None:
+            entry["bytes"] = bytes
+        if streams is not None:
+            entry["streams"] = streams
+            if bytes:
+                entry["cpu_per_gbit"] = round(cpu / (bytes * 8 / 1e9), 4)
+        if threads is not None:
+            entry["threads"] = threads
+        self.phases[phase] = entry
+        return entry
+
+    def bound(self):
+        """Return the transfer phases that were limited by the CPU"""
+
+        return [
+            phase
+            for phase, entry in sorted(self.phases.items())
+            if "streams" in entry and entry.get("cpu_utilization", 0) >= self.cpu_bound
+        ]
 
-        if shutdown_event:
-            self._shutdown_event = shutdown_event
-        else:
-            self._shutdown_event = FakeShutdownEvent()
 
-        self._data = None
+class SpeedtestProgress(object):
+    """Write the progress of a test as newline delimited JSON events to
+    the file descriptor ``fd``
 
-        self.total = [0]
+    Every event has ``event`` and ``time`` keys. Each phase is bracketed
+    by ``phase_start`` and ``phase_end`` events, while a transfer runs an
+    ``interval`` event reports its throughput every ``interval`` seconds,
+    and ``stream_error`` events report failed requests
+    """
 
-    def pre_allocate(self):
-        chars = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
-        multiplier = int(round(int(self.length) / 36.0))
-        IO = BytesIO or StringIO
+    def __init__(self, fd, interval=1.0):
+        self.fd = fd
+        self.interval = interval
+        self.phase = None
+        self._lock = threading.Lock()
+        self._reporter = None
+        self._stop = None
+
+    def emit(self, event, **fields):
+        fields["event"] = event
+        fields["time"] = round(timeit.time.time(), 3)
+        line = ("%s\n" % json.dumps(fields)).encode()
+        self._lock.acquire()
         try:
-            self._data = IO(
-                (
-                    "content1=%s" % (chars * multiplier)[0 : int(self.length) - 9]
-                ).encode()
+            while line:
+                line = line[os.write(self.fd, line) :]
+        finally:
+            self._lock.release()
+
+    def phase_start(self, phase, sampler=None):
+        """Start ``phase``, reporting the throughput of ``sampler``, if
+        any, until ``phase_end``
+        """
+
+        self.phase = phase
+        self.emit("phase_start", phase=phase)
+        if sampler is not None:
+            self._stop = threading.Event()
+            self._reporter = threading.Thread(
+                target=self._report, args=(phase, sampler, self._stop)
             )
-        except MemoryError:
-            raise SpeedtestCLIError(
-                "Insufficient memory to pre-allocate upload data. Please "
-                "use --no-pre-allocate"
+            self._reporter.daemon = True
+            self._reporter.start()
+
+    def phase_end(self, phase, **fields):
+        if self._reporter is not None:
+            self._stop.set()
+            while thread_is_alive(self._reporter):
+                self._reporter.join(timeout=0.1)
+            self._reporter = None
+        self.phase = None
+        fields["phase"] = phase
+        self.emit("phase_end", **fields)
+
+    def stream_error(self, i, error):
+        """Report the failure of request ``i`` of the current phase"""
+
+        self.emit(
+            "stream_error",
+            phase=self.phase,
+            stream=i,
+            error=("%s" % error) or error.__class__.__name__,
+        )
+
+    def _report(self, phase, sampler, stop):
+        start = last = timeit.default_timer()
+        moved = 0
+        while 1:
+            stop.wait(self.interval)
+            if event_is_set(stop):
+                break
+            now = timeit.default_timer()
+            total = sampler.total
+            self.emit(
+                "interval",
+                phase=phase,
+                elapsed=round(now - start, 3),
+                bytes=total,
+                bps=(total - moved) * 8.0 / (now - last),
             )
+            last, moved = now, total
 
-    @property
-    def data(self):
-        if not self._data:
-            self.pre_allocate()
-        return self._data
 
-    def read(self, n=10240):
-        if (timeit.default_timer() - self.start) <= self.timeout and not event_is_set(
-            self._shutdown_event
-        ):
-            chunk = self.data.read(n)
-            self.total.append(len(chunk))
-            return chunk
-        else:
-            raise SpeedtestUploadTimeout()
+class SpeedtestSampler(object):
+    """Thread safe accumulator of the bytes moved by every stream of a
+    transfer, bucketed into fixed ``interval`` second slots counted from
+    ``start``
 
-    def __len__(self):
-        return self.length
+    ``summary`` turns the buckets into a throughput time series, with the
+    TCP slow start ramp excluded from the steady state figure. Samples are
+    also added to ``parent``, if any, to track an aggregate of transfers
+    """
 
+    def __init__(self, start=None, interval=0.25, parent=None):
+        self.start = start
+        self.interval = interval
+        self.parent = parent
+        self.total = 0
+        self._buckets = []
+        self._lock = threading.Lock()
+
+    def add(self, size, now=None):
+        if now is None:
+            now = timeit.default_timer()
+        slot = max(0, int((now - self.start) / self.interval))
+        self._lock.acquire()
+        try:
+            buckets = self._buckets
+            if slot >= len(buckets):
+                buckets.extend([0] * (slot + 1 - len(buckets)))
+            buckets[slot] += size
+            self.total += size
+        finally:
+            self._lock.release()
+        if self.parent:
+            self.parent.add(size, now)
 
-class HTTPUploader(threading.Thread):
-    """Thread class for putting a URL"""
+    @staticmethod
+    def percentile(values, pct):
+        """Return the ``pct`` percentile of ``values``, interpolating
+        between the closest ranks
+        """
 
-    def __init__(
-        self, i, request, start, size, timeout, opener=None, shutdown_event=None
-    ):
-        threading.Thread.__init__(self)
-        self.request = request
-        self.request.data.start = self.starttime = start
-        self.size = size
-        self.result = 0
-        self.timeout = timeout
-        self.i = i
+        ordered = sorted(values)
+        if not ordered:
+            return 0
+        rank = (len(ordered) - 1) * (pct / 100.0)
+        low = int(math.floor(rank))
+        high = min(low + 1, len(ordered) - 1)
+        return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+    def summary(self, stop):
+        """Return a dict describing the throughput, in bits/s, of the
+        transfer that ran from ``start`` until ``stop``
+
+        The final partial interval is dropped. Each interval rate is
+        smoothed to the median of it and its neighbours, and the ramp up
+        is taken to end at the first smoothed rate reaching 80% of the
+        90th percentile smoothed rate, so a single burst, like bytes
+        counted late once acknowledged, can not end it
+        """
 
-        if opener:
-            self._opener = opener.open
+        self._lock.acquire()
+        try:
+            buckets = list(self._buckets)
+        finally:
+            self._lock.release()
+
+        interval = self.interval
+        complete = int((stop - self.start) / interval)
+        # With the final partial interval
+        counted = buckets[: complete + 1]
+        if complete:
+            buckets = buckets[:complete]
+            buckets.extend([0] * (complete - len(buckets)))
+        elif stop > self.start:
+            # Too short for a full interval, treat it as a single sample
+            buckets = [sum(buckets)]
+            interval = stop - self.start
         else:
-            self._opener = urlopen
+            return None
+
+        rates = [b * 8.0 / interval for b in buckets]
+        smoothed = []
+        for i in range(0, len(rates)):
+            window = sorted(rates[max(0, i - 1) : i + 2])
+            smoothed.append(window[(len(window) - 1) // 2])
+        reference = self.percentile(smoothed, 90)
+        ramp = 0
+        for i, rate in enumerate(smoothed):
+            if rate >= reference * 0.8:
+                ramp = i
+                break
+        steady = rates[ramp:]
+        mean = sum(steady) / len(steady)
+        stdev = math.sqrt(sum([(r - mean) ** 2 for r in steady]) / len(steady))
+        # Never above the rate of all bytes counted past the ramp up
+        moved = sum(counted[ramp:]) * 8.0
+        mean = min(mean, moved / (stop - self.start - ramp * interval))
+
+        per_second = max(1, int(round(1 / interval)))
+        curve = []
+        for i in range(0, len(buckets), per_second):
+            second = buckets[i : i + per_second]
+            curve.append(round(sum(second) * 8.0 / (len(second) * interval), 3))
+
+        return {
+            "interval": round(interval, 3),
+            "bytes": buckets,
+            "ramp_up": round(ramp * interval, 3),
+            "steady": round(mean, 3),
+            "stdev": round(stdev, 3),
+            "min": round(min(steady), 3),
+            "max": round(max(steady), 3),
+            "percentiles": {
+                "p10": round(self.percentile(steady, 10), 3),
+                "p25": round(self.percentile(steady, 25), 3),
+                "p50": round(self.percentile(steady, 50), 3),
+                "p75": round(self.percentile(steady, 75), 3),
+                "p90": round(self.percentile(steady, 90), 3),
+            },
+            "curve": curve,
+        }
+
+
+class SpeedtestTransferMeter(object):
+    """Count the bytes moved by a single stream and check its deadline and
+    shutdown event
+
+    Bytes are only added to ``sampler``, behind its lock, once every
+    ``interval`` seconds, when the rate of the stream is also measured to
+    size ``chunk``, the amount to read or send next: what is expected to
+    move in ``interval`` seconds, between ``min_chunk`` and ``chunk_size``,
+    so transfers use few large reads on fast links without blocking for
+    long on slow ones
+    """
+
+    chunk_size = 131072
+    min_chunk = 8192
+    interval = 0.05
+
+    def __init__(self, start, timeout, shutdown_event=None, sampler=None):
+        self.start = start
+        self.timeout = timeout
+        self.sampler = sampler
+        self.chunk = self.min_chunk
+        self.total = 0
+        self._pending = 0
+        self._last = None
 
         if shutdown_event:
             self._shutdown_event = shutdown_event
         else:
             self._shutdown_event = FakeShutdownEvent()
 
-    def run(self):
+    def add(self, size):
+        """Count ``size`` bytes, returns False once the deadline has passed
+        or the shutdown event is set
+        """
+
+        now = timeit.default_timer()
+        self._pending += size
+        if self._last is None:
+            self._last = now
+        elif now - self._last >= self.interval:
+            self._measure(now)
+        return (now - self.start) <= self.timeout and not event_is_set(
+            self._shutdown_event
+        )
+
+    def count(self, size):
+        """Count ``size`` bytes without checking the deadline"""
+
+        self._pending += size
+
+    def _measure(self, now):
+        pending = self._pending
+        self._pending = 0
+        self.total += pending
+        if self.sampler and pending:
+            self.sampler.add(pending, now)
+        if self._last is not None and now > self._last:
+            expected = int(pending / (now - self._last) * self.interval)
+            # Grow gradually, a burst into or out of the socket buffers
+            # would otherwise make reads block for far too long
+            self.chunk = max(
+                self.min_chunk, min(self.chunk_size, self.chunk * 2, expected)
+            )
+        self._last = now
+
+    def flush(self):
+        """Count the pending bytes and return the total"""
+
+        self._measure(timeit.default_timer())
+        return self.total
+
+
+class SpeedtestStreamRamp(object):
+    """Controller growing the number of concurrent streams of a transfer
+    until the aggregate throughput recorded by ``sampler`` plateaus
+
+    The rate is measured every ``window`` seconds, skipping the first
+    window after streams are opened, while they leave slow start and fill
+    their buffers. Each step adds as many streams as the measured gain of
+    the previous one warrants: the count doubles while every stream added
+    raises the rate as much as those already running, and grows less as
+    that share drops. Once a step gains less than ``gain`` the count is
+    held for the rest of the transfer, never going past ``limit``
+    """
+
+    max_streams = 32
+
+    def __init__(self, sampler, streams, limit=None, window=0.5, gain=0.1):
+        self.sampler = sampler
+        self.streams = max(1, int(streams))
+        self.limit = max(self.streams, int(limit or self.max_streams))
+        self.window = window
+        self.gain = gain
+        self.held = self.streams >= self.limit
+
+        self._rate = None
+        self._before = None
+        self._settle = True
+        self._last = None
+        self._total = 0
+
+    def update(self, now=None):
+        """Return the number of streams that should now be running"""
+
+        if self.held:
+            return self.streams
+        if now is None:
+            now = timeit.default_timer()
+        if self._last is None:
+            self._last = self.sampler.start
+        if now - self._last < self.window:
+            return self.streams
+
+        total = self.sampler.total
+        rate = (total - self._total) * 8.0 / (now - self._last)
+        self._last = now
+        self._total = total
+        if self._settle:
+            self._settle = False
+            return self.streams
+
+        previous, self._rate = self._rate, rate
+        if previous is None:
+            share = 1.0
+        elif previous and rate > previous * (1 + self.gain):
+            # Gain of the last step relative to what as many streams as
+            # were added would bring if they all moved the same
+            added = float(self.streams - self._before) / self._before
+            share = min(1.0, (rate / previous - 1) / added)
+        else:
+            share = 0
+        if share:
+            self._before = self.streams
+            step = max(1, int(round(self.streams * share)))
+            self.streams = min(self.limit, self.streams + step)
+            self._settle = True
+        if not share or self.streams >= self.limit:
+            self.held = True
+        printer(
+            "Ramp: %0.0f bits/s, %d streams%s"
+            % (rate, self.streams, ("", " (held)")[self.held]),
+            debug=True,
+        )
+        return self.streams
+
+
+class SpeedtestBudget(object):
+    """Controller ending a transfer early, once ``limit`` bytes have been
+    moved or once the steady state throughput recorded by ``sampler`` is
+    known to within ``tolerance``
+
+    Every ``window`` seconds the latest steady state intervals of the
+    sampler, past the ramp up found by ``SpeedtestSampler.summary`` and
+    at most ``max_intervals`` of them, are used to work out the 95%
+    confidence interval of their mean rate. Once there are at least
+    ``min_intervals``, their interval is within ``tolerance`` of the mean
+    and the means of their first and second halves are too, that mean
+    becomes the ``estimate`` and the transfer is stopped. The budget
+    stands in for the shutdown event of the streams of the transfer,
+    being set once it stops the transfer or ``shutdown_event`` is set
+    """
+
+    window = 0.25
+    min_intervals = 8
+    max_intervals = 12
+
+    def __init__(self, limit, tolerance=0.05, shutdown_event=None, sampler=None):
+        self.limit = max(0, int(limit))
+        self.tolerance = tolerance
+        self.sampler = sampler
+        self.stopped = None
+        self.estimate = None
+        self.error = None
+        self._last = None
+
+        if shutdown_event:
+            self._shutdown_event = shutdown_event
+        else:
+            self._shutdown_event = FakeShutdownEvent()
+
+    def is_set(self):
+        # Checked by the streams on every read and write, so the limit
+        # is enforced closer than ``window`` allows
+        if (
+            not self.stopped
+            and self.sampler is not None
+            and self.sampler.total >= self.limit
+        ):
+            self.stopped = "limit"
+        return bool(self.stopped) or event_is_set(self._shutdown_event)
+
+    isSet = is_set
+
+    def update(self, now=None):
+        """Return True once the transfer should stop"""
+
+        if self.stopped:
+            return True
+        if self.sampler is None or self.sampler.start is None:
+            return False
+        if now is None:
+            now = timeit.default_timer()
+        if self._last is not None and now - self._last < self.window:
+            return False
+        self._last = now
+
+        if self.sampler.total >= self.limit:
+            self.stopped = "limit"
+        elif self._converged(now):
+            self.stopped = "converged"
+        if self.stopped:
+            printer(
+                "Budget: %s after %d bytes" % (self.stopped, self.sampler.total),
+                debug=True,
+            )
+        return bool(self.stopped)
+
+    def _converged(self, now):
+        summary = self.sampler.summary(now)
+        if not summary:
+            return False
+        interval = summary["interval"]
+        ramp = int(round(summary["ramp_up"] / interval))
+        rates = [b * 8.0 / interval for b in summary["bytes"][ramp:]]
+        rates = rates[-self.max_intervals :]
+        count = len(rates)
+        mean = sum(rates) / count
+        if not mean:
+            return False
+        stdev = math.sqrt(sum([(r - mean) ** 2 for r in rates]) / count)
+        self.error = 1.96 * stdev / math.sqrt(count) / mean
+        if count < self.min_intervals or self.error > self.tolerance:
+            return False
+        # A rate still climbing, as streams are added or the congestion
+        # window grows, can give a narrow interval too
+        half = count // 2
+        first = sum(rates[:half]) / half
+        second = sum(rates[count - half :]) / half
+        if abs(second - first) > self.tolerance * mean:
+            return False
+        self.estimate = mean
+        return True
+
+    def dict(self):
+        result = {
+            "limit": self.limit,
+            "stopped": self.stopped,
+            "estimate": self.estimate,
+            "error": None,
+        }
+        if self.error is not None:
+            result["error"] = round(self.error, 4)
+        return result
+
+
+class SpeedtestDiscardSink(object):
+    """Destination of download response bodies, which are only counted
+
+    Each thread reads into a single buffer of its own, reused for every
+    read of every response, so memory stays constant whatever the number
+    and size of the requests. Payload bytes are never kept or decoded,
+    a body the server sent gzip encoded anyway is counted as received
+    """
+
+    def __init__(self, size=None):
+        self.size = size or SpeedtestTransferMeter.chunk_size
+        self._local = threading.local()
+
+    def buffer(self):
+        """Return the buffer of the calling thread, None where memoryview
+        is not available (Python 2.6 and older)
+        """
+
+        view = getattr(self._local, "view", None)
+        if view is None:
+            try:
+                view = self._local.view = memoryview(bytearray(self.size))
+            except NameError:
+                return None
+        return view
+
+    def drain(self, response, meter):
+        """Read ``response`` until its end, or until ``meter`` stops the
+        transfer
+        """
+
+        view = self.buffer()
+        readinto = view is not None and getattr(response, "readinto", None)
+        while 1:
+            if readinto:
+                size = readinto(view[0 : meter.chunk])
+            else:
+                size = len(response.read(meter.chunk))
+            if not size or not meter.add(size):
+                break
+
+
+class HTTPDownloader(object):
+    """Class for retrieving a URL, run by a ``SpeedtestWorkerPool`` worker
+
+    With ``repeat`` the URL is fetched again each time it completes, until
+    ``timeout`` seconds have passed. Bodies are drained into ``sink``, and
+    the bytes read are listed in ``result``
+    """
+
+    sink = SpeedtestDiscardSink()
+
+    def __init__(
+        self,
+        i,
+        request,
+        start,
+        timeout,
+        opener=None,
+        shutdown_event=None,
+        sampler=None,
+        repeat=False,
+    ):
+        self.request = request
+        self.result = [0]
+        self.error = None
+        self.starttime = start
+        self.timeout = timeout
+        self.sampler = sampler
+        self.repeat = repeat
+        self.i = i
+        if opener:
+            self._opener = opener.open
+        else:
+            self._opener = urlopen
+
+        if shutdown_event:
+            self._shutdown_event = shutdown_event
+        else:
+            self._shutdown_event = FakeShutdownEvent()
+
+    def run(self):
+        meter = SpeedtestTransferMeter(
+            self.starttime, self.timeout, self._shutdown_event, self.sampler
+        )
+        try:
+            try:
+                while meter.add(0):
+                    f = self._opener(self.request)
+                    try:
+                        self.sink.drain(f, meter)
+                    finally:
+                        f.close()
+                    if not self.repeat:
+                        break
+            except IOError:
+                self.error = get_exception()
+            except HTTP_ERRORS:
+                self.error = get_exception()
+        finally:
+            self.result.append(meter.flush())
+
+
+class HTTPUploaderPayload(object):
+    """Read-only upload body shared by every ``HTTPUploaderData``
+
+    The body for a given length is always a prefix of the body for any
+    larger length, so a single buffer sized for the largest request is
+    allocated and uploads read slices of it without copying
+    """
+
+    _buffer = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def get(cls, length):
+        """Return a read-only view of the first ``length`` bytes of the
+        shared upload body
+        """
+
+        length = int(length)
+        cls._lock.acquire()
+        try:
+            if cls._buffer is None or len(cls._buffer) < length:
+                chars = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ".encode()
+                try:
+                    body = (
+                        "content1=".encode()
+                        + (chars * (length // 36 + 1))[0 : length - 9]
+                    )
+                except MemoryError:
+                    raise SpeedtestCLIError(
+                        "Insufficient memory to allocate upload data"
+                    )
+                try:
+                    cls._buffer = memoryview(body)
+                except NameError:
+                    # Python 2.6 and older slice (and copy) the string
+                    cls._buffer = body
+            return cls._buffer[0:length]
+        finally:
+            cls._lock.release()
+
+    @classmethod
+    def clear(cls):
+        """Release the shared buffer"""
+
+        cls._lock.acquire()
+        try:
+            cls._buffer = None
+        finally:
+            cls._lock.release()
+
+
+class HTTPUploaderData(object):
+    """File like object to improve cutting off the upload once the timeout
+    has been reached
+
+    ``total`` lists the bytes of the body received by the server, as
+    ``sock``, the socket the body is sent over, reports them acknowledged
+    (Linux only) and once the server replies to the request, see
+    ``acknowledge``
+    """
+
+    def __init__(self, length, start, timeout, shutdown_event=None):
+        self.length = length
+        self.start = start
+        self.timeout = timeout
+
+        if shutdown_event:
+            self._shutdown_event = shutdown_event
+        else:
+            self._shutdown_event = FakeShutdownEvent()
+
+        self._data = None
+        self._pos = 0
+        self._acked = 0
+        self._meter = None
+
+        self.total = [0]
+        self.sampler = None
+        self.sock = None
+
+    def pre_allocate(self):
+        self._data = HTTPUploaderPayload.get(self.length)
+
+    @property
+    def data(self):
+        if self._data is None:
+            self.pre_allocate()
+        return self._data
+
+    @property
+    def meter(self):
+        if self._meter is None:
+            self._meter = SpeedtestTransferMeter(
+                self.start, self.timeout, self._shutdown_event, self.sampler
+            )
+        return self._meter
+
+    def acknowledge(self, received=None):
+        """Count the bytes of the payload received by the server:
+        ``received`` once it reports it, else those ``sock`` no longer
+        waits to have acknowledged
+        """
+        if received is None:
+            unacked = socket_unacked(self.sock)
+            if unacked is None:
+                return
+            # All that was read has been written to the socket
+            received = self._pos - unacked
+        received = min(received, self.length)
+        if received > self._acked:
+            self.meter.count(received - self._acked)
+            self.total.append(received - self._acked)
+            self._acked = received
+
+    def rewind(self):
+        """Start reading the payload from the beginning again, keeping
+        the running ``total``, either to post it again or to retry it on
+        a new connection
+        """
+        self._pos = 0
+        self._acked = 0
+
+    def read(self, n=None):
+        """Return up to ``n`` bytes of the payload, sized by the measured
+        rate like ``SpeedtestTransferMeter.chunk``
+        """
+
+        meter = self.meter
+        self.acknowledge()
+        if meter.add(0):
+            n = min(n or meter.chunk_size, meter.chunk)
+            chunk = self.data[self._pos : self._pos + n]
+            self._pos += len(chunk)
+            return chunk
+        else:
+            raise SpeedtestUploadTimeout()
+
+    def __len__(self):
+        return self.length
+
+
+class HTTPUploader(object):
+    """Class for putting a URL, run by a ``SpeedtestWorkerPool`` worker
+
+    With ``repeat`` the payload is posted again each time it completes,
+    until ``timeout`` seconds have passed
+    """
+
+    def __init__(
+        self,
+        i,
+        request,
+        start,
+        size,
+        timeout,
+        opener=None,
+        shutdown_event=None,
+        sampler=None,
+        repeat=False,
+    ):
+        self.request = request
+        self.request.data.start = self.starttime = start
+        self.request.data.sampler = sampler
+        self.size = size
+        self.result = 0
+        self.error = None
+        self.timeout = timeout
+        self.repeat = repeat
+        self.i = i
+
+        if opener:
+            self._opener = opener.open
+        else:
+            self._opener = urlopen
+
+        if shutdown_event:
+            self._shutdown_event = shutdown_event
+        else:
+            self._shutdown_event = FakeShutdownEvent()
+
+    def run(self):
         request = self.request
         try:
-            if (
+            while (
                 timeit.default_timer() - self.starttime
             ) <= self.timeout and not event_is_set(self._shutdown_event):
                 try:
@@ -945,79 +2028,869 @@ class HTTPUploader(threading.Thread):
                     # PY24 expects a string or buffer
                     # This also causes issues with Ctrl-C, but we will concede
                     # for the moment that Ctrl-C on PY24 isn't immediate
+                    body = []
+                    while 1:
+                        chunk = request.data.read(self.size)
+                        if not chunk:
+                            break
+                        body.append(chunk)
                     request = build_request(
-                        self.request.get_full_url(), data=request.data.read(self.size)
+                        self.request.get_full_url(), data="".encode().join(body)
                     )
                     f = self._opener(request)
-                f.read(11)
+                reply = f.read(64)
                 f.close()
-                self.result = sum(self.request.data.total)
-            else:
-                self.result = 0
-        except (IOError, SpeedtestUploadTimeout):
-            self.result = sum(self.request.data.total)
+                # upload.php replies with the size it received
+                match = re.search("size=([0-9]+)".encode(), reply)
+                if match:
+                    self.request.data.acknowledge(int(match.group(1)))
+                else:
+                    self.request.data.acknowledge(len(self.request.data))
+                self.result = self._total()
+                if not self.repeat:
+                    break
+                self.request.data.rewind()
+        except SpeedtestUploadTimeout:
+            self.result = self._total()
+        except IOError:
+            self.error = get_exception()
+            self.result = self._total()
         except HTTP_ERRORS:
-            self.result = 0
+            self.error = get_exception()
+            self.result = self._total()
 
+    def _total(self):
+        """Return the bytes received by the server so far"""
 
-class SpeedtestResults(object):
-    """Class for holding the results of a speedtest, including:
+        data = self.request.data
+        data.meter.flush()
+        return sum(data.total)
 
-    Download speed
-    Upload speed
-    Ping/Latency to test server
-    Data about server that the test was run against
 
-    Additionally this class can return a result data as a dictionary or CSV,
-    as well as submit a POST of the result data to the speedtest.net API
-    to get a share results image link.
+class HTTPLatencyProbe(object):
+    """Class for measuring the latency to a server by taking several
+    ``latency.txt`` samples over one connection, run by a
+    ``SpeedtestWorkerPool`` worker
+
+    With ``warm`` the connection is opened before the first sample, and
+    opened again before the next one should it be closed by an error, so
+    no sample includes the TCP (and TLS) handshake. Samples are spaced by
+    ``interval`` seconds, and no more are taken once ``stop_event`` is set
     """
 
     def __init__(
         self,
-        download=0,
-        upload=0,
-        ping=0,
-        server=None,
-        client=None,
-        opener=None,
-        secure=False,
+        i,
+        url,
+        deadline,
+        samples=3,
+        source_address=None,
+        user_agent=None,
+        shutdown_event=None,
+        warm=False,
+        interval=0,
+        stop_event=None,
+        family=0,
     ):
-        self.download = download
-        self.upload = upload
-        self.ping = ping
-        if server is None:
-            self.server = {}
-        else:
-            self.server = server
-        self.client = client or {}
+        self.i = i
+        self.url = url
+        self.deadline = deadline
+        self.samples = samples
+        self.warm = warm
+        self.interval = interval
+        self.stop_event = stop_event or FakeShutdownEvent()
+        self.source_address = source_address
+        self.family = family
+        self.user_agent = user_agent or build_user_agent()
+        self.result = []
 
-        self._share = None
-        self.timestamp = "%sZ" % datetime.datetime.utcnow().isoformat()
-        self.bytes_received = 0
-        self.bytes_sent = 0
+        if shutdown_event:
+            self._shutdown_event = shutdown_event
+        else:
+            self._shutdown_event = FakeShutdownEvent()
 
-        if opener:
-            self._opener = opener
+    def run(self):
+        urlparts = urlparse(self.url)
+        if urlparts[0] == "https":
+            connection = SpeedtestHTTPSConnection
         else:
-            self._opener = build_opener()
+            connection = SpeedtestHTTPConnection
+        h = connection(
+            urlparts[1], source_address=self.source_address, family=self.family
+        )
+        headers = {"User-Agent": self.user_agent}
+        path = "%s?%s" % (urlparts[2], urlparts[4])
 
-        self._secure = secure
+        try:
+            if self.warm:
+                try:
+                    h.timeout = max(0, self.deadline - timeit.default_timer())
+                    h.connect()
+                except HTTP_ERRORS:
+                    # The first sample will retry the connection
+                    h.close()
 
-    def __repr__(self):
-        return repr(self.dict())
+            for i in range(0, self.samples):
+                if i and self.interval:
+                    timeit.time.sleep(self.interval)
+                if event_is_set(self.stop_event):
+                    break
+                remaining = self.deadline - timeit.default_timer()
+                if remaining <= 0 or event_is_set(self._shutdown_event):
+                    self.result.append(3600)
+                    continue
 
-    def share(self):
-        """POST data to the speedtest.net API to obtain a share results
-        link
+                this_path = "%s.%s" % (path, i)
+                printer("%s %s" % ("GET", "%s.%s" % (self.url, i)), debug=True)
+                try:
+                    h.timeout = remaining
+                    if h.sock is not None:
+                        h.sock.settimeout(remaining)
+                    elif self.warm:
+                        # Reconnect outside of the timed request
+                        h.connect()
+                    start = timeit.default_timer()
+                    h.request("GET", this_path, headers=headers)
+                    r = h.getresponse()
+                    total = timeit.default_timer() - start
+                    # Read the whole body so the connection can be reused
+                    text = r.read()
+                except HTTP_ERRORS:
+                    e = get_exception()
+                    printer("ERROR: %r" % e, debug=True)
+                    h.close()
+                    self.result.append(3600)
+                    continue
+
+                if int(r.status) == 200 and text[:9] == "test=test".encode():
+                    self.result.append(total)
+                else:
+                    self.result.append(3600)
+        finally:
+            h.close()
+
+
+class SpeedtestWorkerPool(object):
+    """Fixed size pool of worker threads used to run ``HTTPDownloader``
+    and ``HTTPUploader`` requests
+
+    Threads are reused across requests instead of spawning one thread per
+    request, and completion is signalled by the workers themselves rather
+    than by polling each request. When given a ``SpeedtestStreamRamp`` the
+    pool starts with its stream count and adds workers as it grows, and a
+    ``SpeedtestBudget`` is kept up to date while the requests run.
+    Requests that finish with an ``error`` are passed to ``error_callback``
+
+    After ``run``, ``threads`` is the number of workers it started and
+    ``active`` the most threads the process was running while it waited
+    """
+
+    def __init__(
+        self,
+        workers,
+        callback=do_nothing,
+        shutdown_event=None,
+        ramp=None,
+        error_callback=do_nothing,
+        budget=None,
+    ):
+        self.workers = max(1, int(workers))
+        self.threads = 0
+        self.active = 0
+        self._callback = callback
+        self._error_callback = error_callback
+        self._lock = threading.Lock()
+        self._ramp = ramp
+        self._budget = budget
+        if ramp:
+            self.workers = ramp.streams
+
+        if shutdown_event:
+            self._shutdown_event = shutdown_event
+        else:
+            self._shutdown_event = FakeShutdownEvent()
+
+    def run(self, requests):
+        """Run every request in ``requests`` and block until all of them
+        have completed. Returns the requests in the order they finished
         """
 
-        if self._share:
-            return self._share
+        request_count = len(requests)
+        q = Queue()
+        for request in requests:
+            q.put(request)
 
-        download = int(round(self.download / 1000.0, 0))
-        ping = int(round(self.ping, 0))
-        upload = int(round(self.upload / 1000.0, 0))
+        self.finished = []
+        workers = []
+        self._spawn(q, workers, min(self.workers, request_count), request_count)
+
+        _is_alive = thread_is_alive
+        ramp = self._ramp
+        budget = self._budget
+        i = 0
+        while i < len(workers):
+            # A timeout is still used so that signals (Ctrl-C) are
+            # delivered to the main thread while we wait
+            while _is_alive(workers[i]):
+                self.active = max(self.active, threading.active_count())
+                workers[i].join(timeout=0.1)
+                if budget:
+                    budget.update()
+                if ramp and not ramp.held:
+                    target = min(ramp.update(), request_count)
+                    self._spawn(q, workers, target - len(workers), request_count)
+            i += 1
+
+        self.threads = len(workers)
+        return self.finished
+
+    def _spawn(self, q, workers, count, request_count):
+        for _ in range(0, count):
+            # One sentinel per worker so each one exits once drained,
+            # queued behind every request still waiting
+            q.put(None)
+            worker = threading.Thread(target=self._worker, args=(q, request_count))
+            worker.daemon = True
+            workers.append(worker)
+            worker.start()
+
+    def _worker(self, q, request_count):
+        while 1:
+            request = q.get(True)
+            if request is None:
+                break
+
+            self._lock.acquire()
+            try:
+                self._callback(request.i, request_count, start=True)
+            finally:
+                self._lock.release()
+
+            if not event_is_set(self._shutdown_event):
+                request.run()
+
+            self._lock.acquire()
+            try:
+                error = getattr(request, "error", None)
+                if error is not None:
+                    self._error_callback(request.i, error)
+                self.finished.append(request)
+                self._callback(len(self.finished) - 1, request_count, end=True)
+            finally:
+                self._lock.release()
+
+
+def _asyncio_transfers(asyncio):
+    """Build the classes moving the bytes of the asyncio engine over the
+    ``asyncio`` module, see ``asyncio_engine``. Returns the job and
+    transfer classes
+    """
+
+    class AsyncSpeedtestStream(asyncio.Protocol):
+        """Persistent HTTP/1.1 connection driven by an asyncio event loop
+
+        Requests handed out by the owning ``AsyncSpeedtestTransfer`` are sent
+        one at a time, and response bodies are counted and discarded as
+        they arrive, see ``AsyncSpeedtestBufferedStream``. Request bodies
+        are counted once the server has them, see ``acknowledge``
+        """
+
+        def __init__(self, transfer):
+            self.transfer = transfer
+            self.transport = None
+            self.job = None
+            self._paused = False
+            self._reset()
+
+        def _reset(self):
+            self._buffer = "".encode()
+            self._status = None
+            self._remaining = None
+            self._chunked = False
+            self._chunk_remaining = 0
+            self._chunk_crlf = False
+            self._trailer = False
+            self._body = None
+            self._body_offset = 0
+            self._acked = 0
+
+        def connection_made(self, transport):
+            self.transport = transport
+            self.transfer.stream_ready(self)
+
+        def connection_lost(self, exc):
+            job, self.job = self.job, None
+            if (
+                job is not None
+                and self._status
+                and self._remaining is None
+                and not self._chunked
+            ):
+                # Body delimited by the connection closing
+                self.transfer.job_done(self, job, self._status)
+                job = None
+            self.transfer.stream_lost(self, job, exc)
+
+        def pause_writing(self):
+            self._paused = True
+
+        def resume_writing(self):
+            self._paused = False
+            self._write_body()
+
+        def send(self, job):
+            """Send the request described by ``job``"""
+
+            self._reset()
+            self.job = job
+            method, netloc, path, body = job.request
+            headers = [
+                "%s %s HTTP/1.1" % (method, path),
+                "Host: %s" % netloc,
+                "User-Agent: %s" % self.transfer.user_agent,
+                "Cache-Control: no-cache",
+                "Accept-Encoding: identity",
+                "Connection: keep-alive",
+            ]
+            if body is not None:
+                headers.append("Content-Type: application/x-www-form-urlencoded")
+                headers.append("Content-Length: %d" % len(body))
+            job.sent = timeit.default_timer()
+            self.transport.write(("%s\r\n\r\n" % "\r\n".join(headers)).encode())
+            if body is not None:
+                self._body = body
+                self._write_body()
+
+        def _write_body(self):
+            body = self._body
+            if body is None:
+                return
+            size = len(body)
+            while self._body_offset < size and not self._paused:
+                chunk = body[
+                    self._body_offset : self._body_offset
+                    + SpeedtestTransferMeter.chunk_size
+                ]
+                self.transport.write(chunk)
+                self._body_offset += len(chunk)
+            self.acknowledge()
+
+        def acknowledge(self, received=None):
+            """Count the bytes of the request body received by the server:
+            ``received`` once it reports it, else those the socket no longer
+            waits to have acknowledged
+            """
+
+            body = self._body
+            if body is None:
+                return
+            if received is None:
+                unacked = socket_unacked(self.transport.get_extra_info("socket"))
+                if unacked is None:
+                    return
+                buffered = self.transport.get_write_buffer_size()
+                received = self._body_offset - buffered - unacked
+            received = min(received, len(body))
+            if received > self._acked:
+                self.transfer.count(received - self._acked)
+                self._acked = received
+
+        def data_received(self, data):
+            job = self.job
+            if job is None:
+                return
+
+            if self._status is None:
+                self._buffer += data
+                end = self._buffer.find("\r\n\r\n".encode())
+                if end < 0:
+                    return
+                head = self._buffer[:end].decode("latin-1").split("\r\n")
+                data = self._buffer[end + 4 :]
+                self._buffer = "".encode()
+                try:
+                    self._status = int(head[0].split()[1])
+                except (IndexError, ValueError):
+                    self.transport.abort()
+                    return
+                job.headers = timeit.default_timer()
+                headers = {}
+                for line in head[1:]:
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                if headers.get("transfer-encoding", "").lower() == "chunked":
+                    self._chunked = True
+                elif "content-length" in headers:
+                    self._remaining = int(headers["content-length"])
+                if headers.get("connection", "").lower() == "close":
+                    job.close = True
+                if self._remaining == 0:
+                    self._complete()
+                    return
+
+            if self._chunked:
+                self._feed_chunked(data)
+            else:
+                self._feed(data)
+
+        def _feed(self, data, size=None):
+            if size is None:
+                size = len(data)
+            if self._remaining is not None:
+                size = min(size, self._remaining)
+                self._remaining -= size
+            self._consume(data, size)
+            if self._remaining == 0:
+                self._complete()
+
+        def _feed_chunked(self, data):
+            self._buffer += data
+            while 1:
+                if self._chunk_remaining:
+                    size = min(self._chunk_remaining, len(self._buffer))
+                    self._consume(self._buffer, size)
+                    self._buffer = self._buffer[size:]
+                    self._chunk_remaining -= size
+                    if self._chunk_remaining:
+                        return
+                    self._chunk_crlf = True
+                end = self._buffer.find("\r\n".encode())
+                if end < 0:
+                    return
+                line = self._buffer[:end]
+                self._buffer = self._buffer[end + 2 :]
+                if self._chunk_crlf:
+                    self._chunk_crlf = False
+                elif self._trailer:
+                    if not line:
+                        self._complete()
+                        return
+                else:
+                    try:
+                        size = int(line.split(";".encode())[0], 16)
+                    except ValueError:
+                        self.transport.abort()
+                        return
+                    if size:
+                        self._chunk_remaining = size
+                    else:
+                        self._trailer = True
+
+        def _consume(self, data, size):
+            job = self.job
+            if job.capture is not None and len(job.capture) < 64:
+                job.capture += data[:size]
+            if 200 <= self._status < 300 and not job.request[3]:
+                self.transfer.count(size)
+
+        def _complete(self):
+            job, self.job = self.job, None
+            if self._body is not None and 200 <= self._status < 300:
+                # upload.php replies with the size it received
+                match = re.search("size=([0-9]+)".encode(), job.capture or "".encode())
+                if match:
+                    self.acknowledge(int(match.group(1)))
+                else:
+                    self.acknowledge(len(self._body))
+            self._body = None
+            self.transfer.job_done(self, job, self._status)
+
+    if hasattr(asyncio, "BufferedProtocol"):
+
+        class AsyncSpeedtestBufferedStream(
+            AsyncSpeedtestStream, asyncio.BufferedProtocol
+        ):
+            """``AsyncSpeedtestStream`` receiving into a single buffer per
+            stream instead of a new bytes object per read (Python 3.7+)
+            """
+
+            # asyncio reads at most 256 KiB at a time
+            buffer_size = 262144
+
+            def __init__(self, transfer):
+                AsyncSpeedtestStream.__init__(self, transfer)
+                self._view = None
+
+            def get_buffer(self, sizehint):
+                if self._view is None:
+                    self._view = memoryview(bytearray(self.buffer_size))
+                return self._view
+
+            def buffer_updated(self, nbytes):
+                job = self.job
+                if job is None:
+                    return
+                if self._status is None or self._chunked or job.capture is not None:
+                    self.data_received(self._view[:nbytes].tobytes())
+                else:
+                    # Plain body bytes are only counted, not copied out
+                    self._feed(None, nbytes)
+
+    else:
+        AsyncSpeedtestBufferedStream = AsyncSpeedtestStream
+
+    class AsyncSpeedtestJob(object):
+        """A single request run by an ``AsyncSpeedtestTransfer``"""
+
+        def __init__(self, i, url, data=None, capture=False):
+            self.url = url
+            urlparts = urlparse(url)
+            path = urlparts[2] or "/"
+            if urlparts[4]:
+                path = "%s?%s" % (path, urlparts[4])
+            self.i = i
+            self.request = (("GET", "POST")[data is not None], urlparts[1], path, data)
+            self.status = None
+            self.sent = None
+            self.headers = None
+            self.close = False
+            self.renewed = False
+            if capture:
+                self.capture = "".encode()
+            else:
+                self.capture = None
+
+        def renew(self):
+            """Return a fresh copy of this job, to send the same request
+            again
+            """
+            job = AsyncSpeedtestJob(
+                self.i, self.url, self.request[3], self.capture is not None
+            )
+            job.renewed = True
+            return job
+
+        @property
+        def elapsed(self):
+            """Seconds between sending the request and receiving the
+            response headers
+            """
+            if self.sent is None or self.headers is None:
+                return None
+            return self.headers - self.sent
+
+    class AsyncSpeedtestTransfer(object):
+        """Run a list of ``AsyncSpeedtestJob`` requests against a single
+        server over a fixed number of persistent connections on an asyncio
+        event loop, until the jobs are exhausted or ``length`` seconds pass
+
+        With ``repeat`` the jobs are sent again from the start once
+        exhausted, so the transfer always runs for ``length`` seconds,
+        unless ``budget``, a ``SpeedtestBudget``, stops it earlier.
+        Failed connections and requests are passed to ``error_callback``
+        """
+
+        def __init__(
+            self,
+            url,
+            jobs,
+            streams,
+            length,
+            callback=do_nothing,
+            shutdown_event=None,
+            source_address=None,
+            timeout=10,
+            context=None,
+            user_agent=None,
+            sampler=None,
+            ramp=None,
+            repeat=False,
+            error_callback=do_nothing,
+            budget=None,
+            family=0,
+        ):
+            urlparts = urlparse(url)
+            self.loop = None
+            self.scheme = urlparts[0]
+            self.host = urlparts.hostname
+            self.port = urlparts.port or (80, 443)[self.scheme == "https"]
+            self.jobs = jobs
+            self.streams = max(1, int(streams))
+            self.length = length
+            self.source_address = source_address
+            self.family = family
+            self.timeout = timeout
+            self.user_agent = user_agent or build_user_agent()
+
+            if self.scheme == "https" and context is None:
+                context = ssl.create_default_context()
+            self._context = context
+
+            self._callback = callback
+            self._error_callback = error_callback
+            if shutdown_event:
+                self._shutdown_event = shutdown_event
+            else:
+                self._shutdown_event = FakeShutdownEvent()
+
+            self.total = 0
+            self.sampler = sampler or SpeedtestSampler()
+            self.ramp = ramp
+            if ramp:
+                self.streams = ramp.streams
+            self.repeat = repeat
+            self.budget = budget
+            self.finished = []
+            self._next = 0
+            self._active = set()
+            self.connecting = set()
+            self._done = None
+            self._deadline = None
+
+        def start(self, loop):
+            """Open the connections on ``loop`` and return a future resolved
+            once the transfer has completed
+            """
+
+            self.loop = loop
+            self._done = self.loop.create_future()
+            self.starttime = self.sampler.start = timeit.default_timer()
+            self._deadline = self.loop.call_later(self.length, self.expire)
+            self._grower = None
+            if self.ramp:
+                self._grower = self.loop.call_later(self.ramp.window, self._grow)
+            self._checker = None
+            if self.budget:
+                self._checker = self.loop.call_later(self.budget.window, self._check)
+            for _ in range(0, min(self.streams, len(self.jobs))):
+                self._open()
+            if not self.jobs:
+                self._finish()
+            return self._done
+
+        def expire(self):
+            """Stop the transfer, discarding anything still in flight"""
+
+            if self._done.done():
+                return
+            for stream in list(self._active):
+                if stream.transport is not None:
+                    # Count what the server got of an upload cut off mid
+                    # body, and drop the rest rather than let it drain into
+                    # the next test
+                    stream.acknowledge()
+                    socket_discard(stream.transport.get_extra_info("socket"))
+                    stream.transport.abort()
+            self._finish()
+
+        def _acknowledge(self):
+            for stream in self._active:
+                stream.acknowledge()
+
+        def count(self, size):
+            if not self._done.done():
+                self.total += size
+                self.sampler.add(size)
+                if self.budget and self.budget.is_set():
+                    # Outside of the protocol callback, like the deadline
+                    self.loop.call_soon(self.expire)
+
+        def _finish(self):
+            if not self._done.done():
+                self.stoptime = timeit.default_timer()
+                self._deadline.cancel()
+                if self._grower:
+                    self._grower.cancel()
+                if self._checker:
+                    self._checker.cancel()
+                for task in self.connecting:
+                    task.cancel()
+                # Report the jobs cut off by the deadline as finished, like
+                # the threaded pool does
+                finished = set([id(job) for job in self.finished])
+                for job in self.jobs:
+                    if id(job) not in finished:
+                        self._job_finished(job)
+                self._done.set_result(self.total)
+
+        def _open(self):
+            kwargs = {}
+            if self.scheme == "https":
+                kwargs["ssl"] = self._context
+                kwargs["server_hostname"] = self.host
+            if self.source_address:
+                kwargs["local_addr"] = self.source_address
+            if self.family:
+                kwargs["family"] = self.family
+
+            task = self.loop.create_task(
+                self.loop.create_connection(
+                    lambda: AsyncSpeedtestBufferedStream(self),
+                    self.host,
+                    self.port,
+                    **kwargs
+                )
+            )
+            self.connecting.add(task)
+            handle = self.loop.call_later(self.timeout, task.cancel)
+
+            def opened(task):
+                handle.cancel()
+                self.connecting.discard(task)
+                if not task.cancelled() and task.exception() is not None:
+                    printer("ERROR: %r" % task.exception(), debug=True)
+                    self._error_callback(None, task.exception())
+                self._check_done()
+
+            task.add_done_callback(opened)
+
+        def _grow(self):
+            """Open the extra connections asked for by ``ramp``"""
+
+            self._acknowledge()
+            streams = self.ramp.update()
+            for _ in range(self.streams, streams):
+                if not self._pending():
+                    break
+                self._open()
+            self.streams = streams
+            if not self.ramp.held:
+                self._grower = self.loop.call_later(self.ramp.window, self._grow)
+
+        def _check(self):
+            """Stop the transfer once ``budget`` says so"""
+
+            self._acknowledge()
+            if self.budget.update():
+                self.expire()
+            else:
+                self._checker = self.loop.call_later(self.budget.window, self._check)
+
+        def _pending(self):
+            return self.repeat or self._next < len(self.jobs)
+
+        def _take(self):
+            if (
+                self._done.done()
+                or event_is_set(self._shutdown_event)
+                or not self._pending()
+            ):
+                return None
+            if self._next >= len(self.jobs):
+                job = self.jobs[self._next % len(self.jobs)].renew()
+            else:
+                job = self.jobs[self._next]
+                self._callback(job.i, len(self.jobs), start=True)
+            self._next += 1
+            return job
+
+        def _check_done(self):
+            if not self._active and not self.connecting:
+                self._finish()
+
+        def stream_ready(self, stream):
+            job = self._take()
+            if job is None:
+                stream.transport.close()
+                return
+            self._active.add(stream)
+            stream.send(job)
+
+        def stream_lost(self, stream, job, exc=None):
+            self._active.discard(stream)
+            if self._done.done():
+                return
+            if job is not None:
+                # Connection dropped mid request, count it as finished
+                self._error_callback(
+                    job.i, exc or SpeedtestHTTPError("Connection closed")
+                )
+                self._job_finished(job)
+            if self._pending():
+                self._open()
+            self._check_done()
+
+        def job_done(self, stream, job, status):
+            job.status = status
+            self._job_finished(job)
+            if job.close or stream.transport.is_closing():
+                stream.transport.close()
+                return
+            job = self._take()
+            if job is None:
+                self._active.discard(stream)
+                stream.transport.close()
+                self._check_done()
+                return
+            stream.send(job)
+
+        def _job_finished(self, job):
+            if job.renewed:
+                return
+            self.finished.append(job)
+            self._callback(len(self.finished) - 1, len(self.jobs), end=True)
+
+    return AsyncSpeedtestJob, AsyncSpeedtestTransfer
+
+
+class SpeedtestResults(object):
+    """Class for holding the results of a speedtest, including:
+
+    Download speed
+    Upload speed
+    Ping/Latency to test server
+    Data about server that the test was run against
+
+    Additionally this class can return a result data as a dictionary or CSV,
+    as well as submit a POST of the result data to the speedtest.net API
+    to get a share results image link.
+    """
+
+    def __init__(
+        self,
+        download=0,
+        upload=0,
+        ping=0,
+        server=None,
+        client=None,
+        opener=None,
+        secure=False,
+        profile=None,
+    ):
+        self.download = download
+        self.upload = upload
+        self.ping = ping
+        if server is None:
+            self.server = {}
+        else:
+            self.server = server
+        self.client = client or {}
+
+        self._share = None
+        self.timestamp = "%sZ" % datetime.datetime.utcnow().isoformat()
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.download_series = None
+        self.upload_series = None
+        self.per_server = []
+        self.latency = None
+        self.loaded_latency = None
+        self.budget = None
+        self.dual_stack = None
+        self.profile = profile or SpeedtestProfile()
+
+        if opener:
+            self._opener = opener
+        else:
+            self._opener = build_opener()
+
+        self._secure = secure
+
+    def __repr__(self):
+        return repr(self.dict())
+
+    def share(self):
+        """POST data to the speedtest.net API to obtain a share results
+        link
+        """
+
+        if self._share:
+            return self._share
+
+        self.profile.start("share")
+        download = int(round(self.download / 1000.0, 0))
+        ping = int(round(self.ping, 0))
+        upload = int(round(self.upload / 1000.0, 0))
 
         # Build the request to send results back to speedtest.net
         # We use a list instead of a dict because the API expects parameters
@@ -1071,674 +2944,2327 @@ class SpeedtestResults(object):
             )
 
         self._share = "http://www.speedtest.net/result/%s.png" % resultid[0]
+        self.profile.stop("share", bytes=len(response))
 
         return self._share
 
     def dict(self):
         """Return dictionary of result data"""
 
-        return {
-            "download": self.download,
-            "upload": self.upload,
-            "ping": self.ping,
-            "server": self.server,
-            "timestamp": self.timestamp,
-            "bytes_sent": self.bytes_sent,
-            "bytes_received": self.bytes_received,
-            "share": self._share,
-            "client": self.client,
-        }
+        return {
+            "download": self.download,
+            "upload": self.upload,
+            "ping": self.ping,
+            "server": self.server,
+            "timestamp": self.timestamp,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "share": self._share,
+            "client": self.client,
+            "download_series": self.download_series,
+            "upload_series": self.upload_series,
+            "per_server": self.per_server,
+            "latency": self.latency,
+            "loaded_latency": self.loaded_latency,
+            "budget": self.budget,
+            "dual_stack": self.dual_stack,
+            "profile": self.profile.phases,
+        }
+
+    @staticmethod
+    def csv_header(delimiter=","):
+        """Return CSV Headers"""
+
+        import csv
+
+        row = [
+            "Server ID",
+            "Sponsor",
+            "Server Name",
+            "Timestamp",
+            "Distance",
+            "Ping",
+            "Download",
+            "Upload",
+            "Share",
+            "IP Address",
+        ]
+        out = StringIO()
+        writer = csv.writer(out, delimiter=delimiter, lineterminator="")
+        writer.writerow([to_utf8(v) for v in row])
+        return out.getvalue()
+
+    def csv(self, delimiter=","):
+        """Return data in CSV format"""
+
+        import csv
+
+        data = self.dict()
+        out = StringIO()
+        writer = csv.writer(out, delimiter=delimiter, lineterminator="")
+        row = [
+            data["server"]["id"],
+            data["server"]["sponsor"],
+            data["server"]["name"],
+            data["timestamp"],
+            data["server"]["d"],
+            data["ping"],
+            data["download"],
+            data["upload"],
+            self._share or "",
+            self.client["ip"],
+        ]
+        writer.writerow([to_utf8(v) for v in row])
+        return out.getvalue()
+
+    def json(self, pretty=False):
+        """Return data in JSON format"""
+
+        kwargs = {}
+        if pretty:
+            kwargs.update({"indent": 4, "sort_keys": True})
+        return json.dumps(self.dict(), **kwargs)
+
+
+class SpeedtestServerIndex(object):
+    """k-d tree over the speedtest.net server list
+
+    Server coordinates are stored as points on the unit sphere, where the
+    nearest servers by straight line distance are also the nearest by
+    great circle distance, so nearest neighbour lookups do not need to
+    compute the distance to every server. The tree is stored in a plain
+    list so it can be persisted with the cached server list
+    """
+
+    def __init__(self):
+        self.servers = []
+        self._points = []
+        self._order = []
+
+    def __len__(self):
+        return len(self.servers)
+
+    def add(self, attrib):
+        """Add a server, ignoring those with unusable coordinates. ``build``
+        must be called once all servers have been added
+        """
+
+        try:
+            point = unit_vector(float(attrib.get("lat")), float(attrib.get("lon")))
+        except (TypeError, ValueError):
+            return
+        self.servers.append(attrib)
+        self._points.append(point)
+
+    def build(self):
+        """Arrange the servers into the k-d tree"""
+
+        self._order = list(range(0, len(self.servers)))
+        self._build(0, len(self._order), 0)
+
+    def _build(self, lo, hi, depth):
+        if hi - lo <= 1:
+            return
+        axis = depth % 3
+        points = self._points
+        self._order[lo:hi] = sorted(self._order[lo:hi], key=lambda i: points[i][axis])
+        mid = (lo + hi) // 2
+        self._build(lo, mid, depth + 1)
+        self._build(mid + 1, hi, depth + 1)
+
+    def to_dict(self):
+        return {"servers": self.servers, "points": self._points, "order": self._order}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Load an index from ``to_dict`` output, or build one from a plain
+        list of servers
+        """
+
+        index = cls()
+        try:
+            index.servers = data["servers"]
+            index._points = [tuple(p) for p in data["points"]]
+            index._order = data["order"]
+            if len(index.servers) == len(index._points) == len(index._order):
+                return index
+            servers = index.servers
+        except (KeyError, TypeError):
+            servers = data
+
+        index = cls()
+        for attrib in servers:
+            index.add(attrib)
+        index.build()
+        return index
+
+    def filter(self, accept=None):
+        """Iterate over the servers, in list order, that ``accept`` allows"""
+
+        for attrib in self.servers:
+            if accept is None or accept(attrib):
+                yield attrib
+
+    def first(self, accept=None):
+        """Return the first server that ``accept`` allows, or ``None``"""
+
+        for attrib in self.filter(accept):
+            return attrib
+        return None
+
+    def nearest(self, lat_lon, limit, accept=None):
+        """Return up to ``limit`` servers that ``accept`` allows, closest to
+        ``lat_lon`` first
+        """
+
+        if limit <= 0:
+            return []
+
+        target = unit_vector(*lat_lon)
+        points = self._points
+        order = self._order
+        servers = self.servers
+        found = []
+
+        def search(lo, hi, depth):
+            if lo >= hi:
+                return
+            mid = (lo + hi) // 2
+            i = order[mid]
+            point = points[i]
+            if accept is None or accept(servers[i]):
+                d2 = (
+                    (target[0] - point[0]) ** 2
+                    + (target[1] - point[1]) ** 2
+                    + (target[2] - point[2]) ** 2
+                )
+                if len(found) < limit:
+                    heapq.heappush(found, (-d2, -i))
+                elif d2 < -found[0][0]:
+                    heapq.heapreplace(found, (-d2, -i))
+
+            diff = target[depth % 3] - point[depth % 3]
+            if diff < 0:
+                near, far = (lo, mid), (mid + 1, hi)
+            else:
+                near, far = (mid + 1, hi), (lo, mid)
+            search(near[0], near[1], depth + 1)
+            if len(found) < limit or diff * diff < -found[0][0]:
+                search(far[0], far[1], depth + 1)
+
+        search(0, len(order), 0)
+        # Closest first, servers at equal distance in list order
+        found.sort(key=lambda item: (-item[0], -item[1]))
+        return [servers[-i] for _, i in found]
+
+
+class SpeedtestCache(object):
+    """JSON file backed cache of the speedtest.net configuration, server
+    list and best server, so repeated runs can skip retrieving them
+
+    Entries older than ``ttl`` seconds are ignored
+    """
+
+    def __init__(self, path=None, ttl=21600):
+        if not path:
+            import tempfile
+
+            path = os.path.join(tempfile.gettempdir(), "speedtest-cli-cache.json")
+        self.path = path
+        self.ttl = ttl
+        self._data = None
+
+    @staticmethod
+    def _copy(data):
+        # Round trip through JSON so callers can never mutate cached data
+        return json.loads(json.dumps(data))
+
+    def _load(self):
+        if self._data is None:
+            try:
+                f = open(self.path)
+                try:
+                    self._data = json.load(f)
+                finally:
+                    f.close()
+            except (IOError, OSError, ValueError):
+                self._data = {}
+            if not isinstance(self._data, dict):
+                self._data = {}
+        return self._data
+
+    def _save(self):
+        tmp = "%s.%s.tmp" % (self.path, os.getpid())
+        try:
+            f = open(tmp, "w")
+            try:
+                json.dump(self._data, f)
+            finally:
+                f.close()
+            try:
+                os.replace(tmp, self.path)
+            except AttributeError:
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+                os.rename(tmp, self.path)
+        except (IOError, OSError):
+            e = get_exception()
+            printer("Could not write cache %s: %r" % (self.path, e), debug=True)
+
+    def get(self, name, key="default"):
+        """Return the cached ``name`` entry for ``key``, or ``None`` if it
+        is missing or has expired
+        """
+
+        try:
+            entry = self._load().get(name, {}).get(key)
+            age = timeit.time.time() - float(entry["time"])
+            data = entry["data"]
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return None
+        if age < 0 or age > self.ttl:
+            return None
+        printer("Using cached %s (%0.0fs old)" % (name, age), debug=True)
+        return self._copy(data)
+
+    def set(self, name, data, key="default"):
+        """Store ``data`` as the ``name`` entry for ``key``"""
+
+        entries = self._load().setdefault(name, {})
+        entries[key] = {"time": timeit.time.time(), "data": self._copy(data)}
+        self._save()
+
+    def invalidate(self, name, key=None):
+        """Drop the ``name`` entry for ``key``, or all of them"""
+
+        data = self._load()
+        if key is None:
+            data.pop(name, None)
+        else:
+            data.get(name, {}).pop(key, None)
+        self._save()
+
+
+class SpeedtestHistory(object):
+    """Append-only SQLite store of speedtest results, used to compare a
+    result with the previous ones from the same machine
+
+    By default the database is kept in the home directory of the user
+    running the test, so it survives reboots
+    """
+
+    metrics = ("download", "upload", "ping")
+
+    def __init__(self, path=None):
+        if not path:
+            path = os.path.join(
+                os.path.expanduser("~"), ".speedtest-cli-history.sqlite"
+            )
+        self.path = path
+
+    def _connect(self):
+        import sqlite3
+
+        db = sqlite3.connect(self.path)
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "id INTEGER PRIMARY KEY, time REAL, timestamp TEXT, "
+            "server_id TEXT, ping REAL, download REAL, upload REAL, "
+            "bytes_sent INTEGER, bytes_received INTEGER, data TEXT)"
+        )
+        return db
+
+    def add(self, results):
+        """Append a ``SpeedtestResults``"""
+
+        data = results.dict()
+        db = self._connect()
+        try:
+            db.execute(
+                "INSERT INTO results (time, timestamp, server_id, ping, "
+                "download, upload, bytes_sent, bytes_received, data) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    timeit.time.time(),
+                    data["timestamp"],
+                    "%s" % data["server"].get("id", ""),
+                    data["ping"],
+                    data["download"],
+                    data["upload"],
+                    data["bytes_sent"],
+                    data["bytes_received"],
+                    json.dumps(data),
+                ),
+            )
+            db.commit()
+        finally:
+            db.close()
+
+    def query(self, days=7):
+        """Return the results from the last ``days`` days, oldest first, as
+        dicts of timestamp and metrics
+        """
+
+        db = self._connect()
+        try:
+            rows = db.execute(
+                "SELECT timestamp, download, upload, ping FROM results "
+                "WHERE time >= ? ORDER BY time",
+                (timeit.time.time() - days * 86400,),
+            ).fetchall()
+        finally:
+            db.close()
+        return [dict(zip(("timestamp",) + self.metrics, row)) for row in rows]
+
+    def summary(self, days=7):
+        """Return statistics of each metric over the last ``days`` days,
+        per day medians, and the change of the latest result against the
+        median of the results before it (the baseline)
+
+        Metrics recorded as 0, from a skipped test, are ignored
+        """
+
+        rows = self.query(days)
+        summary = {"days": days, "count": len(rows)}
+        if not rows:
+            return summary
+        summary["latest"] = rows[-1]["timestamp"]
+
+        percentile = SpeedtestSampler.percentile
+        for metric in self.metrics:
+            values = [row[metric] for row in rows if row[metric]]
+            if not values:
+                continue
+            stats = {
+                "min": min(values),
+                "max": max(values),
+                "mean": sum(values) / len(values),
+                "median": percentile(values, 50),
+                "p10": percentile(values, 10),
+                "p90": percentile(values, 90),
+                "latest": rows[-1][metric],
+            }
+            baseline = [row[metric] for row in rows[:-1] if row[metric]]
+            if baseline and rows[-1][metric]:
+                stats["baseline"] = percentile(baseline, 50)
+                stats["change"] = round(
+                    (rows[-1][metric] - stats["baseline"]) / stats["baseline"] * 100,
+                    1,
+                )
+            summary[metric] = stats
+
+        daily = {}
+        for row in rows:
+            daily.setdefault(row["timestamp"][:10], []).append(row)
+        summary["daily"] = []
+        for day in sorted(daily.keys()):
+            entry = {"date": day, "count": len(daily[day])}
+            for metric in self.metrics:
+                values = [row[metric] for row in daily[day] if row[metric]]
+                if values:
+                    entry[metric] = percentile(values, 50)
+            summary["daily"].append(entry)
+        return summary
+
+
+class SpeedtestSiteLock(object):
+    """A slot in a lock shared by the agents of a site, so that they take
+    turns testing the uplink instead of measuring each other
+
+    The lock is made of ``slots`` files named ``path.0`` to
+    ``path.<slots - 1>``, created exclusively on a path every agent can
+    reach, such as a network share. The holder touches its file every
+    ``stale / 4`` seconds, and a file that has not changed for ``stale``
+    seconds, as timed by the waiting agent's own clock so that clock skew
+    between machines does not matter, is taken to be left behind by a
+    crashed agent and removed. Shares that cache file attributes, as SMB
+    clients do, can delay the heartbeat being seen, ``stale`` must stay
+    well above that delay
+    """
+
+    stale = 120.0
+    backoff = 1.0
+    max_backoff = 30.0
+
+    def __init__(self, path, slots=1, timeout=900):
+        self.path = path
+        self.slots = max(1, int(slots))
+        self.timeout = timeout
+        self.slot = None
+        self.waited = 0
+        self._token = "%s %s %s" % (
+            socket.gethostname(),
+            os.getpid(),
+            timeit.time.time(),
+        )
+        self._seen = {}
+        self._stop = None
+
+    def _file(self, slot):
+        return "%s.%d" % (self.path, slot)
+
+    def _owner(self, path):
+        """Modification time and content of the lock file ``path``, or None
+        if it cannot be read
+        """
+
+        try:
+            f = open(path)
+            try:
+                return os.fstat(f.fileno()).st_mtime, f.read()
+            finally:
+                f.close()
+        except (IOError, OSError):
+            return None
+
+    def _take(self, slot):
+        path = self._file(slot)
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, int("644", 8))
+        except OSError:
+            e = get_exception()
+            # Windows reports a file being deleted as EACCES
+            if e.errno not in (errno.EEXIST, errno.EACCES):
+                raise
+            self._expire(path)
+            return False
+        try:
+            os.write(fd, self._token.encode())
+        finally:
+            os.close(fd)
+        return True
+
+    def _expire(self, path):
+        """Remove the lock file ``path`` if it has not changed for
+        ``stale`` seconds since this agent first saw it
+        """
+
+        owner = self._owner(path)
+        if owner is None:
+            return
+        now = timeit.default_timer()
+        seen = self._seen.get(path)
+        if seen is None or seen[0] != owner:
+            self._seen[path] = (owner, now)
+            return
+        if now - seen[1] < self.stale:
+            return
+        del self._seen[path]
+
+        # Another agent may expire the same file and take the slot between
+        # our check and the removal, so the file is first moved aside,
+        # atomically, and only removed if it is still the stale one
+        moved = "%s.%s.stale" % (path, md5(self._token.encode()).hexdigest())
+        try:
+            os.rename(path, moved)
+        except OSError:
+            return
+        if self._owner(moved) == owner:
+            printer("Removing stale site lock %s (%s)" % (path, owner[1]), debug=True)
+            try:
+                os.remove(moved)
+            except OSError:
+                pass
+            return
+
+        # A fresh lock was moved instead, put it back unless the slot was
+        # taken again in the meantime
+        try:
+            os.link(moved, path)
+        except (AttributeError, OSError):
+            # No hard links (older Windows Pythons, some shares). Renaming
+            # onto an existing file fails on Windows, elsewhere the check
+            # beforehand has to do
+            if not os.path.exists(path):
+                try:
+                    os.rename(moved, path)
+                    return
+                except OSError:
+                    pass
+        try:
+            os.remove(moved)
+        except OSError:
+            pass
+
+    def acquire(self):
+        """Wait for a free slot, retrying with jittered exponential
+        backoff, and return the number of seconds waited
+        """
+
+        import random
+
+        start = timeit.default_timer()
+        attempt = 0
+        while 1:
+            slots = list(range(self.slots))
+            random.shuffle(slots)
+            for slot in slots:
+                if self._take(slot):
+                    self.slot = slot
+                    self.waited = timeit.default_timer() - start
+                    self._stop = threading.Event()
+                    heartbeat = threading.Thread(
+                        target=self._heartbeat, args=(self._file(slot), self._stop)
+                    )
+                    heartbeat.daemon = True
+                    heartbeat.start()
+                    return self.waited
+            waited = timeit.default_timer() - start
+            if waited >= self.timeout:
+                raise SpeedtestSiteLockTimeout(
+                    "No site slot became free in %s after %d seconds"
+                    % (self.path, waited)
+                )
+            delay = min(self.max_backoff, self.backoff * 2 ** min(attempt, 16))
+            attempt += 1
+            timeit.time.sleep(
+                min(random.uniform(delay / 2, delay), self.timeout - waited)
+            )
+
+    def _heartbeat(self, path, stop):
+        while 1:
+            stop.wait(self.stale / 4)
+            if event_is_set(stop):
+                break
+            try:
+                os.utime(path, None)
+            except OSError:
+                pass
+
+    def release(self):
+        """Free the slot, leaving it alone if another agent expired and
+        took it in the meantime
+        """
+
+        if self.slot is None:
+            return
+        self._stop.set()
+        path = self._file(self.slot)
+        self.slot = None
+        owner = self._owner(path)
+        if owner is not None and owner[1] == self._token:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class Speedtest(object):
+    """Class for performing standard speedtest.net testing operations
+
+    With ``duration`` the download and upload tests each stream for that
+    many seconds, repeating requests as they complete, instead of working
+    through the fixed list of sizes from the configuration
+
+    With ``loaded_latency`` the latency to the best server is sampled
+    while the download and upload tests run, and compared to the idle
+    latency in ``results.loaded_latency``, taken from the latency phase
+    if it ran or from ``idle_samples`` samples otherwise
+
+    With ``budget`` the download and upload tests together move at most
+    that many bytes, the download test getting half of them, and each
+    test ends as soon as its steady state throughput is known to within
+    ``budget_tolerance``, that throughput being the result of the test
+
+    With ``family``, ``socket.AF_INET`` or ``socket.AF_INET6``, every
+    connection is made over that address family only, see also ``pin``
+    and ``dual_stack``
+
+    With ``progress``, a ``SpeedtestProgress``, the start and end of each
+    phase, the throughput while transferring and stream errors are
+    reported as they happen. The time spent in each phase is recorded in
+    ``profile``, also found in ``results.profile``
+    """
+
+    loaded_interval = 0.1
+
+    def __init__(
+        self,
+        config=None,
+        source_address=None,
+        timeout=10,
+        secure=False,
+        shutdown_event=None,
+        cache=None,
+        duration=None,
+        loaded_latency=False,
+        progress=None,
+        budget=None,
+        budget_tolerance=0.05,
+        family=0,
+        idle_samples=30,
+    ):
+        self.config = {}
+
+        self._cache = cache
+        self._duration = duration
+        self._loaded_latency = loaded_latency
+        self._idle_samples = idle_samples
+        self._budget = budget
+        self._budget_tolerance = budget_tolerance
+        self._events = progress
+        self.profile = SpeedtestProfile()
+        self._servers_filtered = False
+        self._network = None
+        self._cached_best = None
+
+        self._source_address = source_address
+        self._timeout = timeout
+        self._family = family
+        self._build_openers()
+
+        self._secure = secure
+
+        if shutdown_event:
+            self._shutdown_event = shutdown_event
+        else:
+            self._shutdown_event = FakeShutdownEvent()
+
+        self.get_config()
+        if config is not None:
+            self.config.update(config)
+        if duration:
+            self.config["length"] = {"upload": duration, "download": duration}
+
+        self._servers = {}
+        self._index = None
+        self._servers_include = []
+        self._servers_exclude = []
+        self.closest = []
+        self._best = {}
+
+        self.results = SpeedtestResults(
+            client=self.config["client"],
+            opener=self._opener,
+            secure=secure,
+            profile=self.profile,
+        )
+
+    def _build_openers(self):
+        source_address = self._source_address
+        timeout = self._timeout
+        self._opener = build_opener(source_address, timeout, family=self._family)
+
+        if source_address:
+            source_address_tuple = (source_address, 0)
+        else:
+            source_address_tuple = None
+
+        # Download and upload requests are sent over persistent connections
+        # so handshakes are not counted as transfer time
+        self._pool = SpeedtestConnectionPool(
+            source_address_tuple, timeout, family=self._family
+        )
+        self._transfer_opener = build_opener(
+            source_address, timeout, pool=self._pool, family=self._family
+        )
+
+    @property
+    def best(self):
+        if not self._best:
+            self.get_best_server()
+        return self._best
+
+    def _network_key(self):
+        """Return the local address of the route towards speedtest.net,
+        used to key the cached config and server list so that a machine
+        moving to another network does not reuse those of the previous one
+
+        Connecting a UDP socket only selects the route, nothing is sent
+        """
+
+        if self._network is not None:
+            return self._network
+        self._network = "default"
+        sock = None
+        try:
+            family, _, _, _, address = socket.getaddrinfo(
+                "www.speedtest.net", 443, self._family, socket.SOCK_DGRAM
+            )[0]
+            sock = socket.socket(family, socket.SOCK_DGRAM)
+            if self._source_address:
+                sock.bind((self._source_address, 0))
+            sock.connect(address)
+            self._network = sock.getsockname()[0]
+        except socket.error:
+            pass
+        if sock is not None:
+            sock.close()
+        printer("Network key: %s" % self._network, debug=True)
+        return self._network
+
+    def _check_cached_best(self, servers, moved):
+        """Drop the cached best server, and the config its key was built
+        from, when a test against it alone moved no data
+        """
+
+        if self._cached_best is None or moved or servers != [self._best]:
+            return
+        if event_is_set(self._shutdown_event):
+            return
+        printer("Cached best server failed the test, invalidating", debug=True)
+        self._cache.invalidate("best", self._cached_best)
+        self._cache.invalidate("config", self._network_key())
+        self._cached_best = None
+
+    def get_config(self):
+        """Download the speedtest.net configuration and return only the data
+        we are interested in
+        """
+
+        self._phase_start("config")
+        if self._cache:
+            cached = self._cache.get("config", self._network_key())
+            if cached:
+                self.config.update(cached["config"])
+                self.lat_lon = tuple(cached["lat_lon"])
+                printer("Config:\n%r" % self.config, debug=True)
+                self._phase_end("config", bytes=0)
+                return self.config
+
+        headers = {}
+        if gzip:
+            headers["Accept-Encoding"] = "gzip"
+        request = build_request(
+            "https://www.speedtest.net/speedtest-config.php",
+            headers=headers,
+            secure=self._secure,
+        )
+        uh, e = catch_request(request, opener=self._opener)
+        if e:
+            raise ConfigRetrievalError(e)
+        configxml_list = []
+
+        stream = get_response_stream(uh)
+
+        while 1:
+            try:
+                configxml_list.append(stream.read(1024))
+            except (OSError, EOFError):
+                raise ConfigRetrievalError(get_exception())
+            if len(configxml_list[-1]) == 0:
+                break
+        stream.close()
+        uh.close()
+
+        if int(uh.code) != 200:
+            return None
+
+        configxml = "".encode().join(configxml_list)
+
+        printer("Config XML:\n%s" % configxml, debug=True)
+
+        try:
+            import xml.etree.ElementTree as ET
+        except ImportError:
+            ET = None
+
+        try:
+            try:
+                root = ET.fromstring(configxml)
+            except ET.ParseError:
+                e = get_exception()
+                raise SpeedtestConfigError(
+                    "Malformed speedtest.net configuration: %s" % e
+                )
+            server_config = root.find("server-config").attrib
+            download = root.find("download").attrib
+            upload = root.find("upload").attrib
+            # times = root.find('times').attrib
+            client = root.find("client").attrib
+
+        except AttributeError:
+            from xml.dom import minidom as DOM
+
+            try:
+                root = DOM.parseString(configxml)
+            except xml.parsers.expat.ExpatError:
+                e = get_exception()
+                raise SpeedtestConfigError(
+                    "Malformed speedtest.net configuration: %s" % e
+                )
+            server_config = get_attributes_by_tag_name(root, "server-config")
+            download = get_attributes_by_tag_name(root, "download")
+            upload = get_attributes_by_tag_name(root, "upload")
+            # times = get_attributes_by_tag_name(root, 'times')
+            client = get_attributes_by_tag_name(root, "client")
+
+        ignore_servers = [int(i) for i in server_config["ignoreids"].split(",") if i]
+
+        ratio = int(upload["ratio"])
+        upload_max = int(upload["maxchunkcount"])
+        up_sizes = [32768, 65536, 131072, 262144, 524288, 1048576, 7340032]
+        sizes = {
+            "upload": up_sizes[ratio - 1 :],
+            "download": [350, 500, 750, 1000, 1500, 2000, 2500, 3000, 3500, 4000],
+        }
+
+        size_count = len(sizes["upload"])
+
+        upload_count = int(math.ceil(upload_max / size_count))
+
+        counts = {"upload": upload_count, "download": int(download["threadsperurl"])}
+
+        threads = {
+            "upload": int(upload["threads"]),
+            "download": int(server_config["threadcount"]) * 2,
+        }
+
+        length = {
+            "upload": int(upload["testlength"]),
+            "download": int(download["testlength"]),
+        }
+
+        self.config.update(
+            {
+                "client": client,
+                "ignore_servers": ignore_servers,
+                "sizes": sizes,
+                "counts": counts,
+                "threads": threads,
+                "length": length,
+                "upload_max": upload_count * size_count,
+            }
+        )
+
+        try:
+            self.lat_lon = (float(client["lat"]), float(client["lon"]))
+        except ValueError:
+            raise SpeedtestConfigError(
+                "Unknown location: lat=%r lon=%r"
+                % (client.get("lat"), client.get("lon"))
+            )
+
+        printer("Config:\n%r" % self.config, debug=True)
+
+        if self._cache:
+            self._cache.set(
+                "config",
+                {"config": self.config, "lat_lon": self.lat_lon},
+                self._network_key(),
+            )
+
+        self._phase_end("config", bytes=len(configxml))
+        return self.config
+
+    @property
+    def servers(self):
+        """dict of distance to a list of servers at that distance, built
+        from the server index the first time it is needed
+        """
+
+        if self._servers is None:
+            self._servers = {}
+            for attrib in self._index.filter(self._accept_server):
+                try:
+                    d = distance(
+                        self.lat_lon,
+                        (float(attrib.get("lat")), float(attrib.get("lon"))),
+                    )
+                except Exception:
+                    continue
+
+                attrib = dict(attrib)
+                attrib["d"] = d
+
+                try:
+                    self._servers[d].append(attrib)
+                except KeyError:
+                    self._servers[d] = [attrib]
+        return self._servers
+
+    @servers.setter
+    def servers(self, servers):
+        self._servers = servers
+        self._index = None
+
+    def get_servers(self, servers=None, exclude=None):
+        """Retrieve a the list of speedtest.net servers, optionally filtered
+        to servers matching those specified in the ``servers`` argument
+        """
+
+        self.index_servers(servers=servers, exclude=exclude)
+        return self.servers
+
+    def index_servers(self, servers=None, exclude=None):
+        """Retrieve the list of speedtest.net servers into a
+        ``SpeedtestServerIndex``, without computing the distance to every
+        server, optionally filtered to servers matching those specified
+        in the ``servers`` argument
+        """
+
+        if servers is None:
+            servers = []
+
+        if exclude is None:
+            exclude = []
+
+        for server_list in (servers, exclude):
+            for i, s in enumerate(server_list):
+                try:
+                    server_list[i] = int(s)
+                except ValueError:
+                    raise InvalidServerIDType(
+                        "%s is an invalid server type, must be int" % s
+                    )
+
+        self.servers = {}
+        self._servers_include = servers
+        self._servers_exclude = exclude
+        self._servers_filtered = bool(servers or exclude)
+
+        self._phase_start("servers")
+        if self._cache:
+            cached = self._cache.get("servers", self._network_key())
+            if cached:
+                index = SpeedtestServerIndex.from_dict(cached)
+                # Fall back to the live list if the cached one has nothing
+                # matching, it may simply be out of date
+                if index.first(self._accept_server):
+                    self._index = index
+                    self._servers = None
+                    self._phase_end("servers", bytes=0)
+                    return self._index
+
+        urls = [
+            "://www.speedtest.net/speedtest-servers-static.php",
+            "http://c.speedtest.net/speedtest-servers-static.php",
+            "://www.speedtest.net/speedtest-servers.php",
+            "http://c.speedtest.net/speedtest-servers.php",
+        ]
+
+        headers = {}
+        if gzip:
+            headers["Accept-Encoding"] = "gzip"
+
+        index = SpeedtestServerIndex()
+        errors = []
+        received = 0
+        for url in urls:
+            try:
+                request = build_request(
+                    "%s?threads=%s" % (url, self.config["threads"]["download"]),
+                    headers=headers,
+                    secure=self._secure,
+                )
+                uh, e = catch_request(request, opener=self._opener)
+                if e:
+                    errors.append("%s" % e)
+                    raise ServersRetrievalError()
+
+                if int(uh.code) != 200:
+                    uh.close()
+                    raise ServersRetrievalError()
+
+                stream = get_response_stream(uh, streaming=True)
+
+                # Servers are added to the index as the XML arrives, instead
+                # of parsing the document at the end
+                index = SpeedtestServerIndex()
+
+                def start_element(name, attrib):
+                    if name == "server":
+                        index.add(dict(attrib))
+
+                parser = xml.parsers.expat.ParserCreate()
+                parser.StartElementHandler = start_element
+
+                try:
+                    while 1:
+                        try:
+                            chunk = stream.read(1024)
+                        except (OSError, EOFError):
+                            raise ServersRetrievalError(get_exception())
+                        received += len(chunk)
+                        try:
+                            parser.Parse(chunk, len(chunk) == 0)
+                        except xml.parsers.expat.ExpatError:
+                            e = get_exception()
+                            raise SpeedtestServersError(
+                                "Malformed speedtest.net server list: %s" % e
+                            )
+                        if len(chunk) == 0:
+                            break
+                finally:
+                    stream.close()
+                    uh.close()
+
+                index.build()
+                printer("Servers XML parsed: %d servers" % len(index), debug=True)
+
+                if self._cache:
+                    self._cache.set("servers", index.to_dict(), self._network_key())
+
+                break
+
+            except ServersRetrievalError:
+                # Drop anything parsed from a partial response before
+                # falling back to the next URL
+                index = SpeedtestServerIndex()
+                continue
+
+        self._index = index
+        self._servers = None
+        self._phase_end("servers", bytes=received)
+
+        if (servers or exclude) and not index.first(self._accept_server):
+            raise NoMatchedServers()
+
+        return self._index
+
+    def _accept_server(self, attrib):
+        """Determine if a server from the server list passes the filters
+        given to ``index_servers``
+        """
+
+        try:
+            server_id = int(attrib.get("id"))
+        except (TypeError, ValueError):
+            return False
+
+        if self._servers_include and server_id not in self._servers_include:
+            return False
+
+        return (
+            server_id not in self.config["ignore_servers"]
+            and server_id not in self._servers_exclude
+        )
+
+    def set_mini_server(self, server):
+        """Instead of querying for a list of servers, set a link to a
+        speedtest mini server
+        """
+
+        urlparts = urlparse(server)
+
+        name, ext = os.path.splitext(urlparts[2])
+        if ext:
+            url = os.path.dirname(server)
+        else:
+            url = server
+
+        request = build_request(url)
+        uh, e = catch_request(request, opener=self._opener)
+        if e:
+            raise SpeedtestMiniConnectFailure("Failed to connect to %s" % server)
+        else:
+            text = uh.read()
+            uh.close()
+
+        extension = re.findall('upload_?[Ee]xtension: "([^"]+)"', text.decode())
+        if not extension:
+            for ext in ["php", "asp", "aspx", "jsp"]:
+                try:
+                    f = self._opener.open("%s/speedtest/upload.%s" % (url, ext))
+                except Exception:
+                    pass
+                else:
+                    data = f.read().strip().decode()
+                    if (
+                        f.code == 200
+                        and len(data.splitlines()) == 1
+                        and re.match("size=[0-9]", data)
+                    ):
+                        extension = [ext]
+                        break
+        if not urlparts or not extension:
+            raise InvalidSpeedtestMiniServer(
+                "Invalid Speedtest Mini Server: " "%s" % server
+            )
+
+        self.servers = [
+            {
+                "sponsor": "Speedtest Mini",
+                "name": urlparts[1],
+                "d": 0,
+                "url": "%s/speedtest/upload.%s" % (url.rstrip("/"), extension[0]),
+                "latency": 0,
+                "id": 0,
+            }
+        ]
+
+        return self.servers
+
+    def get_closest_servers(self, limit=5):
+        """Limit servers to the closest speedtest.net servers based on
+        geographic distance
+        """
+
+        if self._index is None and not self._servers:
+            self.index_servers()
+
+        if self._index is not None:
+            # Only the servers returned by the index need their distance
+            # computed
+            for attrib in self._index.nearest(
+                self.lat_lon, limit - len(self.closest), self._accept_server
+            ):
+                attrib = dict(attrib)
+                attrib["d"] = distance(
+                    self.lat_lon, (float(attrib["lat"]), float(attrib["lon"]))
+                )
+                self.closest.append(attrib)
+        else:
+            for d in sorted(self.servers.keys()):
+                for s in self.servers[d]:
+                    self.closest.append(s)
+                    if len(self.closest) == limit:
+                        break
+                else:
+                    continue
+                break
+
+        printer("Closest Servers:\n%r" % self.closest, debug=True)
+        return self.closest
+
+    def get_best_server(self, servers=None):
+        """Perform a speedtest.net "ping" to determine which speedtest.net
+        server has the lowest latency
+        """
+
+        self._phase_start("ping")
+        self._cached_best = None
+        cache_key = None
+        if not servers:
+            if self._cache and not self._servers_filtered:
+                cache_key = "%(ip)s|%(isp)s" % self.config["client"]
+                best = self._get_cached_best_server(cache_key)
+                if best:
+                    results = self._probe_servers([best])
+                    # A failed sample counts as 3600s, so any failure puts
+                    # the average at 600000ms or more
+                    if results and results[0][0] < 600000:
+                        self._cached_best = cache_key
+                        return self._select_best_server(results)
+                    printer("Cached best server failed, re-selecting", debug=True)
+                    self._cache.invalidate("best", cache_key)
+                    self._cache.invalidate("config", self._network_key())
+
+            if not self.closest:
+                servers = self.get_closest_servers()
+            servers = self.closest
+
+        best = self._select_best_server(self._probe_servers(servers))
+        if cache_key:
+            self._cache.set("best", best, cache_key)
+        return best
 
-    @staticmethod
-    def csv_header(delimiter=","):
-        """Return CSV Headers"""
+    def _get_cached_best_server(self, cache_key):
+        """Return the cached best server for ``cache_key`` if it is still
+        part of the server list
+        """
 
-        row = [
-            "Server ID",
-            "Sponsor",
-            "Server Name",
-            "Timestamp",
-            "Distance",
-            "Ping",
-            "Download",
-            "Upload",
-            "Share",
-            "IP Address",
-        ]
-        out = StringIO()
-        writer = csv.writer(out, delimiter=delimiter, lineterminator="")
-        writer.writerow([to_utf8(v) for v in row])
-        return out.getvalue()
+        best = self._cache.get("best", cache_key)
+        if not best:
+            return None
+        if self._index is not None:
+            server = self._index.first(
+                lambda attrib: attrib.get("id") == best["id"]
+                and self._accept_server(attrib)
+            )
+            if server:
+                return best
+            return None
+        if not self._servers:
+            return best
+        for servers in self._servers.values():
+            for server in servers:
+                if server["id"] == best["id"]:
+                    return best
+        return None
 
-    def csv(self, delimiter=","):
-        """Return data in CSV format"""
+    def _probe_servers(self, servers):
+        """Measure the latency to each of ``servers`` and return a list of
+        (average latency, index, server) tuples, lowest latency first
+        """
 
-        data = self.dict()
-        out = StringIO()
-        writer = csv.writer(out, delimiter=delimiter, lineterminator="")
-        row = [
-            data["server"]["id"],
-            data["server"]["sponsor"],
-            data["server"]["name"],
-            data["timestamp"],
-            data["server"]["d"],
-            data["ping"],
-            data["download"],
-            data["upload"],
-            self._share or "",
-            self.client["ip"],
-        ]
-        writer.writerow([to_utf8(v) for v in row])
-        return out.getvalue()
+        if self._source_address:
+            source_address_tuple = (self._source_address, 0)
+        else:
+            source_address_tuple = None
 
-    def json(self, pretty=False):
-        """Return data in JSON format"""
+        user_agent = build_user_agent()
 
-        kwargs = {}
-        if pretty:
-            kwargs.update({"indent": 4, "sort_keys": True})
-        return json.dumps(self.dict(), **kwargs)
+        # All servers are probed at once and share a single deadline
+        deadline = timeit.default_timer() + self._timeout
 
+        probes = []
+        for i, server in enumerate(servers):
+            url = os.path.dirname(server["url"])
+            stamp = int(timeit.time.time() * 1000)
+            probes.append(
+                HTTPLatencyProbe(
+                    i,
+                    "%s/latency.txt?x=%s" % (url, stamp),
+                    deadline,
+                    source_address=source_address_tuple,
+                    user_agent=user_agent,
+                    shutdown_event=self._shutdown_event,
+                    # Only the first sample would include the handshake
+                    warm=True,
+                    family=self._family,
+                )
+            )
 
-class Speedtest(object):
-    """Class for performing standard speedtest.net testing operations"""
+        pool = SpeedtestWorkerPool(len(probes), shutdown_event=self._shutdown_event)
+        pool.run(probes)
 
-    def __init__(
-        self,
-        config=None,
-        source_address=None,
-        timeout=10,
-        secure=False,
-        shutdown_event=None,
-    ):
-        self.config = {}
+        results = []
+        for i, (server, probe) in enumerate(zip(servers, probes)):
+            # A probe that never ran, as the test was interrupted, has no
+            # samples and must not rank as the fastest server
+            samples = probe.result or [3600] * probe.samples
+            avg = round((sum(samples) / 6) * 1000.0, 3)
+            results.append((avg, i, server))
+        # The index keeps servers with the same latency apart
+        results.sort()
 
-        self._source_address = source_address
-        self._timeout = timeout
-        self._opener = build_opener(source_address, timeout)
+        return results
 
-        self._secure = secure
+    def _select_best_server(self, results):
+        """Record the server with the lowest average latency from
+        ``results``, as returned by ``_probe_servers``, as the best server
+        """
 
-        if shutdown_event:
-            self._shutdown_event = shutdown_event
-        else:
-            self._shutdown_event = FakeShutdownEvent()
+        try:
+            fastest, _, best = results[0]
+        except IndexError:
+            raise SpeedtestBestServerFailure(
+                "Unable to connect to servers to " "test latency."
+            )
+        for latency, _, server in results:
+            server["latency"] = latency
 
-        self.get_config()
-        if config is not None:
-            self.config.update(config)
+        self.results.ping = fastest
+        self.results.server = best
 
-        self.servers = {}
-        self.closest = []
-        self._best = {}
+        self._best.update(best)
+        printer("Best Server:\n%r" % best, debug=True)
+        self._phase_end("ping", ping=fastest, server=best.get("id"))
+        return best
 
-        self.results = SpeedtestResults(
-            client=self.config["client"],
-            opener=self._opener,
-            secure=secure,
-        )
+    def get_best_servers(self, limit, servers=None):
+        """Perform a speedtest.net "ping" against ``servers``, or the
+        ``limit`` closest servers, and return up to ``limit`` of those that
+        answered every probe, lowest latency first
 
-    @property
-    def best(self):
-        if not self._best:
-            self.get_best_server()
-        return self._best
+        The lowest latency server also becomes the best server
+        """
 
-    def get_config(self):
-        """Download the speedtest.net configuration and return only the data
-        we are interested in
+        self._phase_start("ping")
+        if not servers:
+            servers = self.get_closest_servers(limit)
+        results = self._probe_servers(servers)
+        self._select_best_server(results)
+        # A failed sample counts as 3600s, so any failure puts the average
+        # at 600000ms or more
+        return [server for latency, _, server in results if latency < 600000][:limit]
+
+    def latency(self, samples=30, connect=False):
+        """Measure the latency to the best server with ``samples`` requests
+        over one persistent connection, and with ``connect`` as many TCP
+        connects, storing their distribution in ``results.latency``
         """
 
-        headers = {}
-        if gzip:
-            headers["Accept-Encoding"] = "gzip"
-        request = build_request(
-            "https://www.speedtest.net/speedtest-config.php",
-            headers=headers,
-            secure=self._secure,
+        self._phase_start("latency")
+        url = self._latency_url()
+        deadline = timeit.default_timer() + self._timeout * 2
+        self.results.latency = self._latency_profile(
+            self._latency_samples(url, samples, deadline)
+        )
+        if connect:
+            deadline = timeit.default_timer() + self._timeout * 2
+            self.results.latency["connect"] = self._latency_profile(
+                self._connect_samples(url, samples, deadline)
+            )
+        self._phase_end("latency", median=self.results.latency.get("median"))
+        return self.results.latency
+
+    def _phase_start(self, phase, sampler=None):
+        self.profile.start(phase)
+        if self._events:
+            self._events.phase_start(phase, sampler)
+
+    def _phase_end(self, phase, **fields):
+        entry = self.profile.stop(
+            phase,
+            bytes=fields.get("bytes"),
+            streams=fields.get("streams"),
+            threads=fields.get("threads"),
+        )
+        if self._events:
+            fields.update(entry or {})
+            self._events.phase_end(phase, **fields)
+
+    def _error_callback(self):
+        if self._events:
+            return self._events.stream_error
+        return do_nothing
+
+    def _latency_url(self):
+        return "%s/latency.txt?x=%s" % (
+            os.path.dirname(self.best["url"]),
+            int(timeit.time.time() * 1000),
         )
-        uh, e = catch_request(request, opener=self._opener)
-        if e:
-            raise ConfigRetrievalError(e)
-        configxml_list = []
-
-        stream = get_response_stream(uh)
 
-        while 1:
-            try:
-                configxml_list.append(stream.read(1024))
-            except (OSError, EOFError):
-                raise ConfigRetrievalError(get_exception())
-            if len(configxml_list[-1]) == 0:
-                break
-        stream.close()
-        uh.close()
+    def _start_loaded_probe(self, direction):
+        """Start sampling the latency to the best server in a thread while
+        the ``direction`` test loads the link, taking the idle latency
+        first if it is not known yet
+        """
 
-        if int(uh.code) != 200:
+        if not self._loaded_latency:
             return None
 
-        configxml = "".encode().join(configxml_list)
+        if self.results.loaded_latency is None:
+            if self.results.latency:
+                idle = dict(self.results.latency)
+                idle.pop("connect", None)
+            else:
+                deadline = timeit.default_timer() + self._timeout
+                idle = self._latency_profile(
+                    self._latency_samples(
+                        self._latency_url(), self._idle_samples, deadline
+                    )
+                )
+            self.results.loaded_latency = {"idle": idle}
 
-        printer("Config XML:\n%s" % configxml, debug=True)
+        if self._source_address:
+            source_address_tuple = (self._source_address, 0)
+        else:
+            source_address_tuple = None
 
-        try:
-            try:
-                root = ET.fromstring(configxml)
-            except ET.ParseError:
-                e = get_exception()
-                raise SpeedtestConfigError(
-                    "Malformed speedtest.net configuration: %s" % e
-                )
-            server_config = root.find("server-config").attrib
-            download = root.find("download").attrib
-            upload = root.find("upload").attrib
-            # times = root.find('times').attrib
-            client = root.find("client").attrib
+        length = self.config["length"][direction]
+        probe = HTTPLatencyProbe(
+            0,
+            self._latency_url(),
+            timeit.default_timer() + length + self._timeout,
+            samples=int(math.ceil(length / self.loaded_interval)) + 1,
+            source_address=source_address_tuple,
+            shutdown_event=self._shutdown_event,
+            warm=True,
+            interval=self.loaded_interval,
+            stop_event=threading.Event(),
+            family=self._family,
+        )
+        thread = threading.Thread(target=probe.run)
+        thread.daemon = True
+        thread.start()
+        return probe, thread
+
+    def _stop_loaded_probe(self, loaded, direction):
+        """Stop the probe from ``_start_loaded_probe`` and record the
+        loaded latency of the ``direction`` test against the idle latency
+        """
 
-        except AttributeError:
-            try:
-                root = DOM.parseString(configxml)
-            except ExpatError:
-                e = get_exception()
-                raise SpeedtestConfigError(
-                    "Malformed speedtest.net configuration: %s" % e
-                )
-            server_config = get_attributes_by_tag_name(root, "server-config")
-            download = get_attributes_by_tag_name(root, "download")
-            upload = get_attributes_by_tag_name(root, "upload")
-            # times = get_attributes_by_tag_name(root, 'times')
-            client = get_attributes_by_tag_name(root, "client")
+        if loaded is None:
+            return
+        probe, thread = loaded
+        probe.stop_event.set()
+        while thread_is_alive(thread):
+            thread.join(timeout=0.1)
+
+        profile = self._latency_profile(probe.result)
+        idle = self.results.loaded_latency["idle"]
+        if "median" in profile and "median" in idle:
+            profile["delta_median"] = round(profile["median"] - idle["median"], 3)
+            profile["delta_p95"] = round(profile["p95"] - idle["p95"], 3)
+        self.results.loaded_latency[direction] = profile
+
+    def _latency_samples(self, url, samples, deadline):
+        """Return the round trip time in seconds of ``samples`` requests
+        for ``url`` over one persistent connection, 3600 for each failure
+        """
 
-        ignore_servers = [int(i) for i in server_config["ignoreids"].split(",") if i]
+        if self._source_address:
+            source_address_tuple = (self._source_address, 0)
+        else:
+            source_address_tuple = None
 
-        ratio = int(upload["ratio"])
-        upload_max = int(upload["maxchunkcount"])
-        up_sizes = [32768, 65536, 131072, 262144, 524288, 1048576, 7340032]
-        sizes = {
-            "upload": up_sizes[ratio - 1 :],
-            "download": [350, 500, 750, 1000, 1500, 2000, 2500, 3000, 3500, 4000],
-        }
+        probe = HTTPLatencyProbe(
+            0,
+            url,
+            deadline,
+            samples=samples,
+            source_address=source_address_tuple,
+            shutdown_event=self._shutdown_event,
+            warm=True,
+            family=self._family,
+        )
+        probe.run()
+        return probe.result
 
-        size_count = len(sizes["upload"])
+    # Seconds between TCP connects. Back to back, they can overflow the
+    # listen backlog of the server and wait on SYN retransmits
+    connect_interval = 0.05
 
-        upload_count = int(math.ceil(upload_max / size_count))
+    def _connect_samples(self, url, samples, deadline):
+        """Return the time in seconds taken by each of ``samples`` TCP
+        connects to the host of ``url``, 3600 for each failure
 
-        counts = {"upload": upload_count, "download": int(download["threadsperurl"])}
+        A first connect, which also resolves the host, is not counted and
+        connects are spaced by ``connect_interval`` seconds
+        """
 
-        threads = {
-            "upload": int(upload["threads"]),
-            "download": int(server_config["threadcount"]) * 2,
-        }
+        if self._source_address:
+            source_address_tuple = (self._source_address, 0)
+        else:
+            source_address_tuple = None
 
-        length = {
-            "upload": int(upload["testlength"]),
-            "download": int(download["testlength"]),
-        }
+        urlparts = urlparse(url)
+        port = urlparts.port or (80, 443)[urlparts[0] == "https"]
+        address = (urlparts.hostname, port)
 
-        self.config.update(
+        def connect():
+            remaining = deadline - timeit.default_timer()
+            if remaining <= 0 or event_is_set(self._shutdown_event):
+                return 3600
+            start = timeit.default_timer()
+            try:
+                if self._family:
+                    sock = create_connection(
+                        address, remaining, source_address_tuple, self._family
+                    )
+                else:
+                    try:
+                        sock = socket.create_connection(
+                            address, remaining, source_address_tuple
+                        )
+                    except (AttributeError, TypeError):
+                        sock = create_connection(
+                            address, remaining, source_address_tuple
+                        )
+            except socket.error:
+                e = get_exception()
+                printer("ERROR: %r" % e, debug=True)
+                return 3600
+            elapsed = timeit.default_timer() - start
+            sock.close()
+            return elapsed
+
+        connect()
+        result = []
+        for _ in range(0, samples):
+            if not event_is_set(self._shutdown_event):
+                timeit.time.sleep(self.connect_interval)
+            result.append(connect())
+        return result
+
+    latency_buckets = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+    @classmethod
+    def _latency_profile(cls, samples):
+        """Summarize round trip ``samples`` in seconds, 3600 marking a
+        failure, as a dict of milliseconds including the jitter (mean
+        difference between consecutive samples) and a histogram counting
+        the samples up to each of ``latency_buckets``, plus those above
+        """
+
+        valid = [sample * 1000.0 for sample in samples if sample < 3600]
+        profile = {"samples": len(samples), "lost": len(samples) - len(valid)}
+        if not valid:
+            return profile
+
+        jitter = 0
+        if len(valid) > 1:
+            jitter = sum(
+                [abs(valid[i] - valid[i - 1]) for i in range(1, len(valid))]
+            ) / (len(valid) - 1)
+
+        counts = [0] * (len(cls.latency_buckets) + 1)
+        for sample in valid:
+            for i, bucket in enumerate(cls.latency_buckets):
+                if sample <= bucket:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+
+        percentile = SpeedtestSampler.percentile
+        profile.update(
             {
-                "client": client,
-                "ignore_servers": ignore_servers,
-                "sizes": sizes,
-                "counts": counts,
-                "threads": threads,
-                "length": length,
-                "upload_max": upload_count * size_count,
+                "min": round(min(valid), 3),
+                "mean": round(sum(valid) / len(valid), 3),
+                "median": round(percentile(valid, 50), 3),
+                "p95": round(percentile(valid, 95), 3),
+                "p99": round(percentile(valid, 99), 3),
+                "max": round(max(valid), 3),
+                "jitter": round(jitter, 3),
+                "histogram": {"le": list(cls.latency_buckets), "counts": counts},
             }
         )
+        return profile
 
-        try:
-            self.lat_lon = (float(client["lat"]), float(client["lon"]))
-        except ValueError:
-            raise SpeedtestConfigError(
-                "Unknown location: lat=%r lon=%r"
-                % (client.get("lat"), client.get("lon"))
+    def _streams(self, direction):
+        """Number of requests needed to keep every stream busy for a
+        ``duration`` test, each stream repeating its own request
+        """
+
+        return max(self.config["threads"][direction], SpeedtestStreamRamp.max_streams)
+
+    def _download_urls(self, server=None):
+        """Build the list of image URLs fetched from ``server``, by default
+        the best server, during the download test
+        """
+
+        url = os.path.dirname((server or self.best)["url"])
+        if self._duration:
+            size = self.config["sizes"]["download"][-1]
+            return ["%s/random%sx%s.jpg" % (url, size, size)] * self._streams(
+                "download"
             )
 
-        printer("Config:\n%r" % self.config, debug=True)
+        urls = []
+        for size in self.config["sizes"]["download"]:
+            for _ in range(0, self.config["counts"]["download"]):
+                urls.append("%s/random%sx%s.jpg" % (url, size, size))
+        return urls
+
+    def _upload_sizes(self):
+        """Build the list of payload sizes sent during the upload test"""
+
+        if self._duration:
+            return [self.config["sizes"]["upload"][-1]] * self._streams("upload")
 
-        return self.config
+        sizes = []
+        for size in self.config["sizes"]["upload"]:
+            for _ in range(0, self.config["counts"]["upload"]):
+                sizes.append(size)
+        return sizes
 
-    def get_servers(self, servers=None, exclude=None):
-        """Retrieve a the list of speedtest.net servers, optionally filtered
-        to servers matching those specified in the ``servers`` argument
+    @staticmethod
+    def _ramp(sampler, threads, streams, servers=1):
+        """Return the ``SpeedtestStreamRamp`` for a transfer starting with
+        ``streams`` streams, or ``None`` when ``threads`` fixes the count
         """
-        if servers is None:
-            servers = []
 
-        if exclude is None:
-            exclude = []
+        if threads:
+            return None
+        return SpeedtestStreamRamp(
+            sampler, streams, SpeedtestStreamRamp.max_streams * servers
+        )
 
-        self.servers.clear()
+    @staticmethod
+    def _round_robin(items):
+        """Interleave the lists in ``items``, one per server, returning
+        ``(index, item)`` tuples so every server gets streams from the start
+        """
 
-        for server_list in (servers, exclude):
-            for i, s in enumerate(server_list):
-                try:
-                    server_list[i] = int(s)
-                except ValueError:
-                    raise InvalidServerIDType(
-                        "%s is an invalid server type, must be int" % s
-                    )
+        out = []
+        for i in range(0, max([len(item) for item in items])):
+            for index, item in enumerate(items):
+                if i < len(item):
+                    out.append((index, item[i]))
+        return out
 
-        urls = [
-            "://www.speedtest.net/speedtest-servers-static.php",
-            "http://c.speedtest.net/speedtest-servers-static.php",
-            "://www.speedtest.net/speedtest-servers.php",
-            "http://c.speedtest.net/speedtest-servers.php",
-        ]
+    def _record_servers(self, servers, samplers, direction, elapsed):
+        """Store the throughput of each of ``servers`` in
+        ``results.per_server`` when a test ran against more than one
+        """
 
-        headers = {}
-        if gzip:
-            headers["Accept-Encoding"] = "gzip"
+        if len(servers) < 2:
+            return
+        key = ("bytes_received", "bytes_sent")[direction == "upload"]
+        entries = dict([(e["server"]["id"], e) for e in self.results.per_server])
+        for server, sampler in zip(servers, samplers):
+            entry = entries.get(server["id"])
+            if entry is None:
+                entry = {
+                    "server": server,
+                    "download": 0,
+                    "upload": 0,
+                    "bytes_received": 0,
+                    "bytes_sent": 0,
+                }
+                self.results.per_server.append(entry)
+            entry[key] = sampler.total
+            entry[direction] = (sampler.total / elapsed) * 8.0
+
+    def _transfer_budget(self, direction, sampler=None):
+        """Return the ``SpeedtestBudget`` of the ``direction`` test, or
+        ``None`` without a ``budget``
+        """
 
-        errors = []
-        for url in urls:
-            try:
-                request = build_request(
-                    "%s?threads=%s" % (url, self.config["threads"]["download"]),
-                    headers=headers,
-                    secure=self._secure,
-                )
-                uh, e = catch_request(request, opener=self._opener)
-                if e:
-                    errors.append("%s" % e)
-                    raise ServersRetrievalError()
+        if not self._budget:
+            return None
+        limit = self._budget - self.results.bytes_received - self.results.bytes_sent
+        if direction == "download":
+            limit = min(limit, self._budget / 2)
+        return SpeedtestBudget(
+            limit, self._budget_tolerance, self._shutdown_event, sampler
+        )
 
-                stream = get_response_stream(uh)
+    def _budget_rate(self, direction, budget, rate):
+        """Record how ``budget`` ended the ``direction`` test in
+        ``results.budget`` and return the throughput of the test: the
+        estimate the budget converged on, or else ``rate``, the bytes
+        moved over the time taken
+        """
 
-                serversxml_list = []
-                while 1:
-                    try:
-                        serversxml_list.append(stream.read(1024))
-                    except (OSError, EOFError):
-                        raise ServersRetrievalError(get_exception())
-                    if len(serversxml_list[-1]) == 0:
-                        break
+        if budget is None:
+            return rate
+        if self.results.budget is None:
+            self.results.budget = {}
+        self.results.budget[direction] = budget.dict()
+        if budget.estimate:
+            return budget.estimate
+        return rate
 
-                stream.close()
-                uh.close()
+    def download(self, callback=do_nothing, threads=None, servers=None):
+        """Test download speed against speedtest.net
 
-                if int(uh.code) != 200:
-                    raise ServersRetrievalError()
+        A ``threads`` value of ``None`` will start with the threads
+        dictated by the speedtest.net configuration and add more until
+        the throughput stops improving
 
-                serversxml = "".encode().join(serversxml_list)
+        With ``servers`` the test runs against all of them at once, each
+        with its own streams, the result being their aggregate throughput
+        """
 
-                printer("Servers XML:\n%s" % serversxml, debug=True)
+        servers = servers or [self.best]
+        urls = self._round_robin([self._download_urls(server) for server in servers])
 
-                try:
-                    try:
-                        try:
-                            root = ET.fromstring(serversxml)
-                        except ET.ParseError:
-                            e = get_exception()
-                            raise SpeedtestServersError(
-                                "Malformed speedtest.net server list: %s" % e
-                            )
-                        elements = etree_iter(root, "server")
-                    except AttributeError:
-                        try:
-                            root = DOM.parseString(serversxml)
-                        except ExpatError:
-                            e = get_exception()
-                            raise SpeedtestServersError(
-                                "Malformed speedtest.net server list: %s" % e
-                            )
-                        elements = root.getElementsByTagName("server")
-                except (SyntaxError, xml.parsers.expat.ExpatError):
-                    raise ServersRetrievalError()
+        requests = []
+        for i, (index, url) in enumerate(urls):
+            # Ask for the body as is, so it is never compressed on the way
+            headers = {"Accept-Encoding": "identity"}
+            request = build_request(url, bump=i, secure=self._secure, headers=headers)
+            requests.append((index, request))
 
-                for server in elements:
-                    try:
-                        attrib = server.attrib
-                    except AttributeError:
-                        attrib = dict(list(server.attributes.items()))
+        max_threads = (threads or self.config["threads"]["download"]) * len(servers)
 
-                    if servers and int(attrib.get("id")) not in servers:
-                        continue
+        budget = self._transfer_budget("download")
+        loaded = self._start_loaded_probe("download")
+        start = timeit.default_timer()
+        sampler = SpeedtestSampler(start)
+        samplers = [SpeedtestSampler(start, parent=sampler) for _ in servers]
+        if budget:
+            budget.sampler = sampler
+        self._phase_start("download", sampler)
+        downloaders = []
+        for i, (index, request) in enumerate(requests):
+            downloaders.append(
+                HTTPDownloader(
+                    i,
+                    request,
+                    start,
+                    self.config["length"]["download"],
+                    opener=self._transfer_opener,
+                    shutdown_event=budget or self._shutdown_event,
+                    sampler=samplers[index],
+                    repeat=bool(self._duration),
+                )
+            )
 
-                    if (
-                        int(attrib.get("id")) in self.config["ignore_servers"]
-                        or int(attrib.get("id")) in exclude
-                    ):
-                        continue
+        pool = SpeedtestWorkerPool(
+            max_threads,
+            callback=callback,
+            shutdown_event=self._shutdown_event,
+            ramp=self._ramp(sampler, threads, max_threads, len(servers)),
+            error_callback=self._error_callback(),
+            budget=budget,
+        )
+        finished = [sum(d.result) for d in pool.run(downloaders)]
 
-                    try:
-                        d = distance(
-                            self.lat_lon,
-                            (float(attrib.get("lat")), float(attrib.get("lon"))),
-                        )
-                    except Exception:
-                        continue
+        stop = timeit.default_timer()
+        self.results.bytes_received = sum(finished)
+        self._check_cached_best(servers, self.results.bytes_received)
+        self.results.download = (self.results.bytes_received / (stop - start)) * 8.0
+        self.results.download_series = sampler.summary(stop)
+        self.results.download = self._budget_rate(
+            "download", budget, self.results.download
+        )
+        self._record_servers(servers, samplers, "download", stop - start)
+        self._stop_loaded_probe(loaded, "download")
+        self._phase_end(
+            "download",
+            bps=self.results.download,
+            bytes=self.results.bytes_received,
+            streams=pool.threads,
+            threads=pool.active,
+        )
+        return self.results.download
 
-                    attrib["d"] = d
+    def upload(
+        self, callback=do_nothing, pre_allocate=True, threads=None, servers=None
+    ):
+        """Test upload speed against speedtest.net
 
-                    try:
-                        self.servers[d].append(attrib)
-                    except KeyError:
-                        self.servers[d] = [attrib]
+        A ``threads`` value of ``None`` will start with the threads
+        dictated by the speedtest.net configuration and add more until
+        the throughput stops improving
 
-                break
+        With ``servers`` the test runs against all of them at once, each
+        with its own streams, the result being their aggregate throughput
+        """
 
-            except ServersRetrievalError:
-                continue
+        servers = servers or [self.best]
+        sizes = self._upload_sizes()
 
-        if (servers or exclude) and not self.servers:
-            raise NoMatchedServers()
+        # request_count = len(sizes)
+        request_count = self.config["upload_max"]
+        if self._duration:
+            request_count = len(sizes)
 
-        return self.servers
+        budget = self._transfer_budget("upload")
+        requests = []
+        sizes = self._round_robin([sizes[:request_count]] * len(servers))
+        for index, size in sizes:
+            # We set ``0`` for ``start`` and handle setting the actual
+            # ``start`` in ``HTTPUploader`` to get better measurements
+            data = HTTPUploaderData(
+                size,
+                0,
+                self.config["length"]["upload"],
+                shutdown_event=budget or self._shutdown_event,
+            )
+            if pre_allocate:
+                data.pre_allocate()
 
-    def set_mini_server(self, server):
-        """Instead of querying for a list of servers, set a link to a
-        speedtest mini server
-        """
+            headers = {"Content-length": size}
+            requests.append(
+                (
+                    index,
+                    build_request(
+                        servers[index]["url"],
+                        data,
+                        secure=self._secure,
+                        headers=headers,
+                    ),
+                    size,
+                )
+            )
 
-        urlparts = urlparse(server)
+        max_threads = (threads or self.config["threads"]["upload"]) * len(servers)
 
-        name, ext = os.path.splitext(urlparts[2])
-        if ext:
-            url = os.path.dirname(server)
-        else:
-            url = server
+        loaded = self._start_loaded_probe("upload")
+        start = timeit.default_timer()
+        sampler = SpeedtestSampler(start)
+        samplers = [SpeedtestSampler(start, parent=sampler) for _ in servers]
+        if budget:
+            budget.sampler = sampler
+        self._phase_start("upload", sampler)
+        uploaders = []
+        for i, (index, request, size) in enumerate(requests):
+            uploaders.append(
+                HTTPUploader(
+                    i,
+                    request,
+                    start,
+                    size,
+                    self.config["length"]["upload"],
+                    opener=self._transfer_opener,
+                    shutdown_event=budget or self._shutdown_event,
+                    sampler=samplers[index],
+                    repeat=bool(self._duration),
+                )
+            )
 
-        request = build_request(url)
-        uh, e = catch_request(request, opener=self._opener)
-        if e:
-            raise SpeedtestMiniConnectFailure("Failed to connect to %s" % server)
-        else:
-            text = uh.read()
-            uh.close()
+        pool = SpeedtestWorkerPool(
+            max_threads,
+            callback=callback,
+            shutdown_event=self._shutdown_event,
+            ramp=self._ramp(sampler, threads, max_threads, len(servers)),
+            error_callback=self._error_callback(),
+            budget=budget,
+        )
+        finished = [u.result for u in pool.run(uploaders)]
 
-        extension = re.findall('upload_?[Ee]xtension: "([^"]+)"', text.decode())
-        if not extension:
-            for ext in ["php", "asp", "aspx", "jsp"]:
-                try:
-                    f = self._opener.open("%s/speedtest/upload.%s" % (url, ext))
-                except Exception:
-                    pass
-                else:
-                    data = f.read().strip().decode()
-                    if (
-                        f.code == 200
-                        and len(data.splitlines()) == 1
-                        and re.match("size=[0-9]", data)
-                    ):
-                        extension = [ext]
-                        break
-        if not urlparts or not extension:
-            raise InvalidSpeedtestMiniServer(
-                "Invalid Speedtest Mini Server: " "%s" % server
-            )
+        stop = timeit.default_timer()
+        self.results.bytes_sent = sum(finished)
+        self._check_cached_best(servers, self.results.bytes_sent)
+        self.results.upload = (self.results.bytes_sent / (stop - start)) * 8.0
+        self.results.upload_series = sampler.summary(stop)
+        self.results.upload = self._budget_rate("upload", budget, self.results.upload)
+        self._record_servers(servers, samplers, "upload", stop - start)
+        self._stop_loaded_probe(loaded, "upload")
+        self._phase_end(
+            "upload",
+            bps=self.results.upload,
+            bytes=self.results.bytes_sent,
+            streams=pool.threads,
+            threads=pool.active,
+        )
+        return self.results.upload
 
-        self.servers = [
-            {
-                "sponsor": "Speedtest Mini",
-                "name": urlparts[1],
-                "d": 0,
-                "url": "%s/speedtest/upload.%s" % (url.rstrip("/"), extension[0]),
-                "latency": 0,
-                "id": 0,
-            }
-        ]
+    dual_stack_families = (("ipv4", socket.AF_INET), ("ipv6", socket.AF_INET6))
 
-        return self.servers
+    def pin(self, family, budget=None):
+        """Return a new ``Speedtest`` with the settings, test configuration
+        and best server of this one, that only connects over the address
+        ``family``, and ``budget`` instead of the budget of this one if
+        given
 
-    def get_closest_servers(self, limit=5):
-        """Limit servers to the closest speedtest.net servers based on
-        geographic distance
+        Its client details are those speedtest.net sees over ``family``,
+        retrieving them raises like creating any ``Speedtest`` does
         """
 
-        if not self.servers:
-            self.get_servers()
-
-        for d in sorted(self.servers.keys()):
-            for s in self.servers[d]:
-                self.closest.append(s)
-                if len(self.closest) == limit:
-                    break
-            else:
-                continue
-            break
+        import copy
 
-        printer("Closest Servers:\n%r" % self.closest, debug=True)
-        return self.closest
+        config = copy.deepcopy(self.config)
+        config.pop("client", None)
+        pinned = self.__class__(
+            config=config,
+            source_address=self._source_address,
+            timeout=self._timeout,
+            secure=self._secure,
+            shutdown_event=self._shutdown_event,
+            cache=self._cache,
+            duration=self._duration,
+            loaded_latency=self._loaded_latency,
+            budget=budget or self._budget,
+            budget_tolerance=self._budget_tolerance,
+            family=family,
+            idle_samples=self._idle_samples,
+        )
+        pinned._best = copy.deepcopy(self.best)
+        pinned.results.server = pinned._best
+        return pinned
 
-    def get_best_server(self, servers=None):
-        """Perform a speedtest.net "ping" to determine which speedtest.net
-        server has the lowest latency
+    def dual_stack(
+        self,
+        samples=10,
+        download=True,
+        upload=True,
+        callback=do_nothing,
+        threads=None,
+        pre_allocate=True,
+        connect=False,
+    ):
+        """Run the latency, download and upload tests against the best
+        server once over IPv4 and once over IPv6, storing what each family
+        got in ``results.dual_stack``, see ``latency`` for ``samples`` and
+        ``connect``
+
+        The latency of both families is measured at the same time, while
+        the transfers run one family after the other so they do not share
+        the link. A family the server can not be reached over, or whose
+        copy of this ``Speedtest`` fails, see ``pin``, is reported with an
+        ``error``. The family connections use by default, the
+        first one the server name resolves to, also provides the main
+        results. A ``budget`` is shared equally by the families
         """
 
-        if not servers:
-            if not self.closest:
-                servers = self.get_closest_servers()
-            servers = self.closest
+        self._phase_start("dual_stack")
+        urlparts = urlparse(self.best["url"])
+        port = urlparts.port or (80, 443)[urlparts[0] == "https"]
+        try:
+            default = socket.getaddrinfo(
+                urlparts.hostname, port, 0, socket.SOCK_STREAM
+            )[0][0]
+        except socket.error:
+            default = None
 
-        if self._source_address:
-            source_address_tuple = (self._source_address, 0)
-        else:
-            source_address_tuple = None
+        report = {}
+        families = []
+        for name, family in self.dual_stack_families:
+            try:
+                address = socket.getaddrinfo(
+                    urlparts.hostname, port, family, socket.SOCK_STREAM
+                )[0][4][0]
+            except socket.error:
+                report[name] = {"error": "%s" % get_exception()}
+                continue
+            report[name] = {"address": address, "default": family == default}
+            families.append((name, family))
+
+        # The families split the budget, so both together stay within it
+        budget = None
+        if self._budget and families:
+            budget = self._budget / len(families)
+        pinned = []
+        for name, family in families:
+            try:
+                pinned.append((name, self.pin(family, budget)))
+            except (SpeedtestException,) + HTTP_ERRORS:
+                report[name]["error"] = "%s" % get_exception()
 
-        user_agent = build_user_agent()
+        def latency(name, speedtest):
+            try:
+                speedtest.latency(samples, connect)
+            except Exception:
+                report[name]["error"] = "%s" % get_exception()
+
+        workers = []
+        for name, speedtest in pinned:
+            worker = threading.Thread(target=latency, args=(name, speedtest))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            while thread_is_alive(worker):
+                worker.join(timeout=0.1)
+
+        for name, speedtest in pinned:
+            entry = report[name]
+            if "error" in entry:
+                continue
+            results = speedtest.results
+            entry["latency"] = results.latency
+            if not results.latency or "min" not in results.latency:
+                entry["error"] = "%s unreachable" % urlparts.hostname
+                continue
+            if download:
+                entry["download"] = speedtest.download(
+                    callback=callback, threads=threads
+                )
+                entry["bytes_received"] = results.bytes_received
+            if upload:
+                entry["upload"] = speedtest.upload(
+                    callback=callback, pre_allocate=pre_allocate, threads=threads
+                )
+                entry["bytes_sent"] = results.bytes_sent
+            for phase, phase_entry in speedtest.profile.phases.items():
+                self.profile.phases["%s_%s" % (name, phase)] = phase_entry
+            if entry["default"]:
+                for key in (
+                    "download",
+                    "upload",
+                    "bytes_received",
+                    "bytes_sent",
+                    "download_series",
+                    "upload_series",
+                    "latency",
+                    "loaded_latency",
+                    "budget",
+                ):
+                    setattr(self.results, key, getattr(results, key))
+
+        ipv4 = report.get("ipv4", {})
+        ipv6 = report.get("ipv6", {})
+        if ipv4 and ipv6 and "error" not in ipv4 and "error" not in ipv6:
+            # How IPv6 compares to IPv4, in percent for the transfers
+            delta = {
+                "latency": round(
+                    ipv6["latency"]["median"] - ipv4["latency"]["median"], 3
+                )
+            }
+            for direction in ("download", "upload"):
+                if ipv4.get(direction):
+                    delta[direction] = round(
+                        (ipv6[direction] - ipv4[direction]) / ipv4[direction] * 100, 1
+                    )
+            report["delta"] = delta
 
-        results = {}
-        for server in servers:
-            cum = []
-            url = os.path.dirname(server["url"])
-            stamp = int(timeit.time.time() * 1000)
-            latency_url = "%s/latency.txt?x=%s" % (url, stamp)
-            for i in range(0, 3):
-                this_latency_url = "%s.%s" % (latency_url, i)
-                printer("%s %s" % ("GET", this_latency_url), debug=True)
-                urlparts = urlparse(latency_url)
-                try:
-                    if urlparts[0] == "https":
-                        h = SpeedtestHTTPSConnection(
-                            urlparts[1], source_address=source_address_tuple
-                        )
-                    else:
-                        h = SpeedtestHTTPConnection(
-                            urlparts[1], source_address=source_address_tuple
-                        )
-                    headers = {"User-Agent": user_agent}
-                    path = "%s?%s" % (urlparts[2], urlparts[4])
-                    start = timeit.default_timer()
-                    h.request("GET", path, headers=headers)
-                    r = h.getresponse()
-                    total = timeit.default_timer() - start
-                except HTTP_ERRORS:
-                    e = get_exception()
-                    printer("ERROR: %r" % e, debug=True)
-                    cum.append(3600)
-                    continue
+        self.results.dual_stack = report
+        self._phase_end("dual_stack")
+        return report
 
-                text = r.read(9)
-                if int(r.status) == 200 and text == "test=test".encode():
-                    cum.append(total)
-                else:
-                    cum.append(3600)
-                h.close()
 
-            avg = round((sum(cum) / 6) * 1000.0, 3)
-            results[avg] = server
+_asyncio_speedtest = None
 
-        try:
-            fastest = sorted(results.keys())[0]
-        except IndexError:
-            raise SpeedtestBestServerFailure(
-                "Unable to connect to servers to " "test latency."
-            )
-        best = results[fastest]
-        best["latency"] = fastest
 
-        self.results.ping = fastest
-        self.results.server = best
+def asyncio_engine():
+    """Return the ``AsyncioSpeedtest`` class, or None where asyncio is not
+    available
 
-        self._best.update(best)
-        printer("Best Server:\n%r" % best, debug=True)
-        return best
+    asyncio takes longer to import than the rest of the script, so it is
+    only imported, and the engine built, on the first call
+    """
+
+    global _asyncio_speedtest
+    if _asyncio_speedtest is not None:
+        return _asyncio_speedtest
+    asyncio = import_optional("asyncio")
+    if asyncio is None:
+        return None
+    AsyncSpeedtestJob, AsyncSpeedtestTransfer = _asyncio_transfers(asyncio)
+
+    class AsyncioSpeedtest(Speedtest):
+        """Class for performing standard speedtest.net testing operations,
+        running the latency, download and upload tests on a single asyncio
+        event loop with non-blocking sockets instead of threads
+
+        The loop opens its connections directly, so tests against servers
+        that are behind a configured proxy, or use HTTPS without the ssl
+        module, are run by the threaded ``Speedtest`` methods instead
+        """
+
+        def __init__(self, *args, **kwargs):
+            Speedtest.__init__(self, *args, **kwargs)
+            self._user_agent = build_user_agent()
+            self._proxies = ProxyHandler().proxies
+
+        def _fallback(self, urls):
+            """Return why one of ``urls`` can not be reached from the event
+            loop, None if all of them can
+            """
+
+            for url in urls:
+                scheme = urlparse(url)[0]
+                if scheme == "https" and ssl is None:
+                    reason = "ssl is not available"
+                elif self._proxies.get(scheme):
+                    reason = "a %s proxy is configured" % scheme
+                else:
+                    continue
+                printer("%s, using the threaded engine" % reason, debug=True)
+                return reason
+            return None
 
-    def download(self, callback=do_nothing, threads=None):
-        """Test download speed against speedtest.net
+        def _transfer(
+            self,
+            url,
+            jobs,
+            streams,
+            length,
+            callback=do_nothing,
+            threads=None,
+            repeat=False,
+            parent=None,
+            budget=None,
+        ):
+            if self._source_address:
+                source_address_tuple = (self._source_address, 0)
+            else:
+                source_address_tuple = None
+
+            sampler = SpeedtestSampler(parent=parent)
+            return AsyncSpeedtestTransfer(
+                url,
+                jobs,
+                streams,
+                length,
+                callback=callback,
+                shutdown_event=self._shutdown_event,
+                source_address=source_address_tuple,
+                timeout=self._timeout,
+                user_agent=self._user_agent,
+                sampler=sampler,
+                ramp=self._ramp(sampler, threads, streams),
+                repeat=repeat,
+                error_callback=self._error_callback(),
+                budget=budget,
+                family=self._family,
+            )
 
-        A ``threads`` value of ``None`` will fall back to those dictated
-        by the speedtest.net configuration
-        """
+        @staticmethod
+        def _run(transfers):
+            loop = asyncio.new_event_loop()
+            try:
+                futures = [transfer.start(loop) for transfer in transfers]
+                loop.run_until_complete(asyncio.gather(*futures))
+                # Let connections cancelled when a transfer finished wind
+                # down before the loop is closed
+                tasks = []
+                for transfer in transfers:
+                    tasks.extend(transfer.connecting)
+                if tasks:
+                    loop.run_until_complete(
+                        asyncio.gather(*tasks, return_exceptions=True)
+                    )
+            finally:
+                loop.close()
 
-        urls = []
-        for size in self.config["sizes"]["download"]:
-            for _ in range(0, self.config["counts"]["download"]):
-                urls.append(
-                    "%s/random%sx%s.jpg"
-                    % (os.path.dirname(self.best["url"]), size, size)
-                )
+        def _probe_servers(self, servers):
+            """Measure the latency to each of ``servers`` and return a list
+            of (average latency, index, server) tuples, lowest latency first
 
-        request_count = len(urls)
-        requests = []
-        for i, url in enumerate(urls):
-            requests.append(build_request(url, bump=i, secure=self._secure))
+            All servers are probed concurrently, each over one persistent
+            connection
+            """
 
-        max_threads = threads or self.config["threads"]["download"]
-        in_flight = {"threads": 0}
+            if self._fallback([server["url"] for server in servers]):
+                return Speedtest._probe_servers(self, servers)
 
-        def producer(q, requests, request_count):
-            for i, request in enumerate(requests):
-                thread = HTTPDownloader(
-                    i,
-                    request,
-                    start,
-                    self.config["length"]["download"],
-                    opener=self._opener,
-                    shutdown_event=self._shutdown_event,
+            transfers = []
+            for server in servers:
+                url = os.path.dirname(server["url"])
+                stamp = int(timeit.time.time() * 1000)
+                jobs = []
+                for i in range(0, 3):
+                    latency_url = "%s/latency.txt?x=%s.%s" % (url, stamp, i)
+                    printer("%s %s" % ("GET", latency_url), debug=True)
+                    jobs.append(AsyncSpeedtestJob(i, latency_url, capture=True))
+                transfers.append(self._transfer(url, jobs, 1, self._timeout, threads=1))
+
+            self._run(transfers)
+
+            results = []
+            for i, (server, transfer) in enumerate(zip(servers, transfers)):
+                cum = [self._job_latency(job) for job in transfer.jobs]
+                avg = round((sum(cum) / 6) * 1000.0, 3)
+                results.append((avg, i, server))
+            results.sort()
+
+            return results
+
+        @staticmethod
+        def _job_latency(job):
+            """Return the round trip time of a ``latency.txt`` job, 3600
+            if it failed
+            """
+
+            if (
+                job.status == 200
+                and job.capture[:9] == "test=test".encode()
+                and job.elapsed is not None
+            ):
+                return job.elapsed
+            return 3600
+
+        def _latency_samples(self, url, samples, deadline):
+            """Return the round trip time in seconds of ``samples`` requests
+            for ``url`` over one persistent connection, 3600 for each failure
+            """
+
+            if self._fallback([url]):
+                return Speedtest._latency_samples(self, url, samples, deadline)
+
+            jobs = []
+            for i in range(0, samples):
+                jobs.append(AsyncSpeedtestJob(i, "%s.%s" % (url, i), capture=True))
+            transfer = self._transfer(
+                url, jobs, 1, max(0, deadline - timeit.default_timer()), threads=1
+            )
+            self._run([transfer])
+            return [self._job_latency(job) for job in jobs]
+
+        @staticmethod
+        def _progress(callback, total):
+            """Merge the progress reported by several transfers into a single
+            sequence of ``total`` requests for ``callback``
+            """
+
+            done = [0]
+
+            def inner(current, count, start=False, end=False):
+                if end:
+                    done[0] += 1
+                    return callback(done[0] - 1, total, end=True)
+                return callback(current, total, start=start)
+
+            return inner
+
+        def _run_servers(self, servers, jobs, direction, callback, threads):
+            """Run ``jobs``, one list per server, against all of ``servers``
+            at once and return the total bytes moved, their throughput and
+            the aggregate sampler summary
+            """
+
+            callback = self._progress(callback, sum([len(j) for j in jobs]))
+            sampler = SpeedtestSampler()
+            budget = self._transfer_budget(direction, sampler)
+            transfers = []
+            for server, server_jobs in zip(servers, jobs):
+                transfers.append(
+                    self._transfer(
+                        server["url"],
+                        server_jobs,
+                        threads or self.config["threads"][direction],
+                        self.config["length"][direction],
+                        callback=callback,
+                        threads=threads,
+                        repeat=bool(self._duration),
+                        parent=sampler,
+                        budget=budget,
+                    )
                 )
-                while in_flight["threads"] >= max_threads:
-                    timeit.time.sleep(0.001)
-                thread.start()
-                q.put(thread, True)
-                in_flight["threads"] += 1
-                callback(i, request_count, start=True)
-
-        finished = []
-
-        def consumer(q, request_count):
-            _is_alive = thread_is_alive
-            while len(finished) < request_count:
-                thread = q.get(True)
-                while _is_alive(thread):
-                    thread.join(timeout=0.001)
-                in_flight["threads"] -= 1
-                finished.append(sum(thread.result))
-                callback(thread.i, request_count, end=True)
-
-        q = Queue(max_threads)
-        prod_thread = threading.Thread(
-            target=producer, args=(q, requests, request_count)
-        )
-        cons_thread = threading.Thread(target=consumer, args=(q, request_count))
-        start = timeit.default_timer()
-        prod_thread.start()
-        cons_thread.start()
-        _is_alive = thread_is_alive
-        while _is_alive(prod_thread):
-            prod_thread.join(timeout=0.001)
-        while _is_alive(cons_thread):
-            cons_thread.join(timeout=0.001)
+            loaded = self._start_loaded_probe(direction)
+            sampler.start = timeit.default_timer()
+            self._phase_start(direction, sampler)
+            # The loop runs every stream on this thread, alongside the
+            # loaded latency probe and progress reporter, if any
+            active = threading.active_count()
+            self._run(transfers)
+            self._stop_loaded_probe(loaded, direction)
+
+            stoptime = max([t.stoptime for t in transfers])
+            elapsed = stoptime - min([t.starttime for t in transfers])
+            total = sum([t.total for t in transfers])
+            self._check_cached_best(servers, total)
+            series = sampler.summary(stoptime)
+            bps = self._budget_rate(direction, budget, (total / elapsed) * 8.0)
+            self._record_servers(
+                servers, [t.sampler for t in transfers], direction, elapsed
+            )
+            self._phase_end(
+                direction,
+                bps=bps,
+                bytes=total,
+                streams=sum([t.streams for t in transfers]),
+                threads=active,
+            )
+            return total, bps, series
 
-        stop = timeit.default_timer()
-        self.results.bytes_received = sum(finished)
-        self.results.download = (self.results.bytes_received / (stop - start)) * 8.0
-        if self.results.download > 100000:
-            self.config["threads"]["upload"] = 8
-        return self.results.download
+        def download(self, callback=do_nothing, threads=None, servers=None):
+            """Test download speed against speedtest.net
 
-    def upload(self, callback=do_nothing, pre_allocate=True, threads=None):
-        """Test upload speed against speedtest.net
+            A ``threads`` value of ``None`` will start with the threads
+            dictated by the speedtest.net configuration and add more until
+            the throughput stops improving, each "thread" being a
+            persistent connection on the event loop
 
-        A ``threads`` value of ``None`` will fall back to those dictated
-        by the speedtest.net configuration
-        """
+            With ``servers`` the test runs against all of them at once, each
+            with its own connections, the result being their aggregate
+            throughput
+            """
 
-        sizes = []
+            servers = servers or [self.best]
+            if self._fallback([server["url"] for server in servers]):
+                return Speedtest.download(self, callback, threads, servers)
 
-        for size in self.config["sizes"]["upload"]:
-            for _ in range(0, self.config["counts"]["upload"]):
-                sizes.append(size)
+            jobs = []
+            for server in servers:
+                server_jobs = []
+                for i, url in enumerate(self._download_urls(server)):
+                    request = build_request(url, bump=i, secure=self._secure)
+                    server_jobs.append(AsyncSpeedtestJob(i, request.get_full_url()))
+                jobs.append(server_jobs)
+
+            (
+                self.results.bytes_received,
+                self.results.download,
+                self.results.download_series,
+            ) = self._run_servers(servers, jobs, "download", callback, threads)
+            return self.results.download
+
+        def upload(
+            self, callback=do_nothing, pre_allocate=True, threads=None, servers=None
+        ):
+            """Test upload speed against speedtest.net
 
-        # request_count = len(sizes)
-        request_count = self.config["upload_max"]
+            A ``threads`` value of ``None`` will start with the threads
+            dictated by the speedtest.net configuration and add more until
+            the throughput stops improving. Upload data is always read from
+            the shared ``HTTPUploaderPayload``, so ``pre_allocate`` has no
+            effect
 
-        requests = []
-        for i, size in enumerate(sizes):
-            # We set ``0`` for ``start`` and handle setting the actual
-            # ``start`` in ``HTTPUploader`` to get better measurements
-            data = HTTPUploaderData(
-                size,
-                0,
-                self.config["length"]["upload"],
-                shutdown_event=self._shutdown_event,
-            )
-            if pre_allocate:
-                data.pre_allocate()
+            With ``servers`` the test runs against all of them at once, each
+            with its own connections, the result being their aggregate
+            throughput
+            """
 
-            headers = {"Content-length": size}
-            requests.append(
-                (
-                    build_request(
-                        self.best["url"], data, secure=self._secure, headers=headers
-                    ),
-                    size,
-                )
-            )
+            servers = servers or [self.best]
+            if self._fallback([server["url"] for server in servers]):
+                return Speedtest.upload(self, callback, pre_allocate, threads, servers)
 
-        max_threads = threads or self.config["threads"]["upload"]
-        in_flight = {"threads": 0}
+            sizes = self._upload_sizes()
+            if not self._duration:
+                sizes = sizes[: self.config["upload_max"]]
 
-        def producer(q, requests, request_count):
-            for i, request in enumerate(requests[:request_count]):
-                thread = HTTPUploader(
-                    i,
-                    request[0],
-                    start,
-                    request[1],
-                    self.config["length"]["upload"],
-                    opener=self._opener,
-                    shutdown_event=self._shutdown_event,
-                )
-                while in_flight["threads"] >= max_threads:
-                    timeit.time.sleep(0.001)
-                thread.start()
-                q.put(thread, True)
-                in_flight["threads"] += 1
-                callback(i, request_count, start=True)
-
-        finished = []
-
-        def consumer(q, request_count):
-            _is_alive = thread_is_alive
-            while len(finished) < request_count:
-                thread = q.get(True)
-                while _is_alive(thread):
-                    thread.join(timeout=0.001)
-                in_flight["threads"] -= 1
-                finished.append(thread.result)
-                callback(thread.i, request_count, end=True)
-
-        q = Queue(threads or self.config["threads"]["upload"])
-        prod_thread = threading.Thread(
-            target=producer, args=(q, requests, request_count)
-        )
-        cons_thread = threading.Thread(target=consumer, args=(q, request_count))
-        start = timeit.default_timer()
-        prod_thread.start()
-        cons_thread.start()
-        _is_alive = thread_is_alive
-        while _is_alive(prod_thread):
-            prod_thread.join(timeout=0.1)
-        while _is_alive(cons_thread):
-            cons_thread.join(timeout=0.1)
+            jobs = []
+            for server in servers:
+                server_jobs = []
+                for i, size in enumerate(sizes):
+                    data = HTTPUploaderPayload.get(size)
+                    request = build_request(server["url"], data, secure=self._secure)
+                    server_jobs.append(
+                        AsyncSpeedtestJob(
+                            i, request.get_full_url(), data=data, capture=True
+                        )
+                    )
+                jobs.append(server_jobs)
 
-        stop = timeit.default_timer()
-        self.results.bytes_sent = sum(finished)
-        self.results.upload = (self.results.bytes_sent / (stop - start)) * 8.0
-        return self.results.upload
+            (
+                self.results.bytes_sent,
+                self.results.upload,
+                self.results.upload_series,
+            ) = self._run_servers(servers, jobs, "upload", callback, threads)
+            return self.results.upload
+
+    _asyncio_speedtest = AsyncioSpeedtest
+    return AsyncioSpeedtest
 
 
 def ctrl_c(shutdown_event):
@@ -1762,6 +5288,219 @@ def version():
     sys.exit(0)
 
 
+def print_latency(label, profile, quiet=False):
+    """Print a latency profile from ``Speedtest.latency``"""
+
+    if "min" not in profile:
+        printer("%s: all %s samples lost" % (label, profile["samples"]), quiet)
+        return
+    printer(
+        "%s: %s ms min, %s ms median, %s ms p95, %s ms p99, %s ms jitter "
+        "(%s samples, %s lost)"
+        % (
+            label,
+            profile["min"],
+            profile["median"],
+            profile["p95"],
+            profile["p99"],
+            profile["jitter"],
+            profile["samples"],
+            profile["lost"],
+        ),
+        quiet,
+    )
+
+
+def print_loaded_latency(direction, results, quiet=False):
+    """Print the latency measured during the ``direction`` test"""
+
+    profile = (results.loaded_latency or {}).get(direction)
+    if not profile:
+        return
+    if "delta_median" not in profile:
+        print_latency("Loaded latency", profile, quiet)
+        return
+    printer(
+        "Loaded latency: %s ms median (%+0.3f ms), %s ms p95 (%+0.3f ms)"
+        % (
+            profile["median"],
+            profile["delta_median"],
+            profile["p95"],
+            profile["delta_p95"],
+        ),
+        quiet,
+    )
+
+
+def print_budget(direction, results, quiet=False):
+    """Print how ``--budget`` ended the ``direction`` test"""
+
+    budget = (results.budget or {}).get(direction)
+    if not budget:
+        return
+    moved = (results.bytes_received, results.bytes_sent)[direction == "upload"]
+    if budget["stopped"] == "converged":
+        reason = "steady state within %0.1f%%" % (budget["error"] * 100)
+    elif budget["stopped"] == "limit":
+        reason = "budget of %0.1f MB used" % (budget["limit"] / 1000.0 / 1000.0)
+    else:
+        reason = "test length reached"
+    printer("Moved %0.1f MB, %s" % (moved / 1000.0 / 1000.0, reason), quiet)
+
+
+def print_dual_stack(results, units, quiet=False):
+    """Print what each address family got from ``Speedtest.dual_stack``"""
+
+    report = results.dual_stack
+    for name, label in (("ipv4", "IPv4"), ("ipv6", "IPv6")):
+        entry = report[name]
+        if "error" in entry:
+            printer("%s: %s" % (label, entry["error"]), quiet)
+            continue
+        line = "%s (%s): Latency: %s ms" % (
+            label,
+            entry["address"],
+            entry["latency"]["median"],
+        )
+        for direction in ("download", "upload"):
+            if direction in entry:
+                line += ", %s: %0.2f M%s/s" % (
+                    direction.title(),
+                    (entry[direction] / 1000.0 / 1000.0) / units[1],
+                    units[0],
+                )
+        printer(line, quiet)
+
+    delta = report.get("delta")
+    if delta:
+        line = "IPv6 vs IPv4: Latency: %+0.3f ms" % delta["latency"]
+        for direction in ("download", "upload"):
+            if direction in delta:
+                line += ", %s: %+0.1f%%" % (direction.title(), delta[direction])
+        printer(line, quiet)
+
+
+def print_profile(profile, error=False):
+    """Print the phases recorded by a ``SpeedtestProfile``"""
+
+    order = ("config", "servers", "ping", "latency", "download", "upload", "share")
+    phases = [p for p in order if p in profile.phases]
+    phases.extend(sorted([p for p in profile.phases if p not in order]))
+
+    printer("Profile:", error=error)
+    for phase in phases:
+        entry = profile.phases[phase]
+        line = "%-8s %8.3fs wall %8.3fs CPU" % (phase, entry["wall"], entry["cpu"])
+        if "cpu_utilization" in entry:
+            line += " %6.1f%%" % (entry["cpu_utilization"] * 100)
+        if "bytes" in entry:
+            line += ", %s bytes" % entry["bytes"]
+        if "cpu_per_gbit" in entry:
+            line += ", %0.4f CPU s/Gbit" % entry["cpu_per_gbit"]
+        if "streams" in entry:
+            line += ", %(streams)s streams on %(threads)s threads" % entry
+        printer(line, error=error)
+
+    for phase in profile.bound():
+        printer(
+            "WARNING: the %s test kept %0.0f%% of a CPU core busy, the result "
+            "may be limited by this machine rather than the network"
+            % (phase, profile.phases[phase]["cpu_utilization"] * 100),
+            error=True,
+        )
+
+
+def print_history(summary, units):
+    """Print a summary from ``SpeedtestHistory.summary``"""
+
+    printer(
+        "History of the last %s days: %s results" % (summary["days"], summary["count"])
+    )
+    if not summary["count"]:
+        return
+    printer("Latest: %s" % summary["latest"])
+    for metric in SpeedtestHistory.metrics:
+        stats = summary.get(metric)
+        if not stats:
+            continue
+        if metric == "ping":
+            scale = 1
+            unit = "ms"
+        else:
+            scale = 1000.0 * 1000.0 * units[1]
+            unit = "M%s/s" % units[0]
+        line = "%s: " % metric.capitalize() + ", ".join(
+            [
+                "%0.2f %s %s" % (stats[key] / scale, unit, key)
+                for key in ("latest", "median", "mean", "p10", "p90")
+            ]
+        )
+        if "change" in stats:
+            line += ", %+0.1f%% vs baseline" % stats["change"]
+        printer(line)
+
+
+def check_thresholds(args, results, baseline=None):
+    """Compare ``results`` with the thresholds given on the command line
+    and print those not met. Returns the exit code for a TRMM check:
+    ``SpeedtestThresholdFailure.failed`` if an absolute threshold failed,
+    ``SpeedtestThresholdFailure.dropped`` if only the comparison with the
+    ``baseline`` history summary did, 0 otherwise
+    """
+
+    scale = 1000.0 * 1000.0 * args.units[1]
+    unit = "M%s/s" % args.units[0]
+
+    failed = []
+    for metric, minimum in (
+        ("download", args.min_download),
+        ("upload", args.min_upload),
+    ):
+        if minimum is None or not getattr(args, metric):
+            continue
+        value = getattr(results, metric) / scale
+        if value < minimum:
+            failed.append(
+                "%s %0.2f %s is below %0.2f %s"
+                % (metric.capitalize(), value, unit, minimum, unit)
+            )
+    if args.max_ping is not None and results.ping > args.max_ping:
+        failed.append("Ping %s ms is above %s ms" % (results.ping, args.max_ping))
+
+    dropped = []
+    if args.max_drop is not None and baseline:
+        for metric in ("download", "upload"):
+            stats = baseline.get(metric)
+            if not stats or not getattr(args, metric):
+                continue
+            value = getattr(results, metric)
+            drop = (stats["median"] - value) / stats["median"] * 100
+            if drop > args.max_drop:
+                dropped.append(
+                    "%s %0.2f %s is %0.1f%% below the %s day median of %0.2f %s"
+                    % (
+                        metric.capitalize(),
+                        value / scale,
+                        unit,
+                        drop,
+                        baseline["days"],
+                        stats["median"] / scale,
+                        unit,
+                    )
+                )
+
+    for message in failed:
+        printer("FAIL: %s" % message, error=True)
+    for message in dropped:
+        printer("WARNING: %s" % message, error=True)
+
+    if failed:
+        return SpeedtestThresholdFailure.failed
+    if dropped:
+        return SpeedtestThresholdFailure.dropped
+    return 0
+
+
 def csv_header(delimiter=","):
     """Print the CSV Headers"""
 
@@ -1857,6 +5596,21 @@ def parse_args():
         "information in JSON format. Speeds listed in "
         "bit/s and not affected by --bytes",
     )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        default=False,
+        help="Show the wall clock and CPU time spent in each "
+        "phase, and warn when the CPU rather than the network "
+        "limited a result. Always included in --json",
+    )
+    parser.add_argument(
+        "--progress-fd",
+        type=PARSER_TYPE_INT,
+        help="Write progress as newline delimited JSON events "
+        "to this file descriptor, 1 for stdout which also "
+        "suppresses verbose output. Speeds listed in bit/s",
+    )
     parser.add_argument(
         "--list",
         action="store_true",
@@ -1874,6 +5628,38 @@ def parse_args():
         action="append",
         help="Exclude a server from selection. Can be " "supplied multiple times",
     )
+    parser.add_argument(
+        "--multi",
+        type=PARSER_TYPE_INT,
+        help="Test against the N closest servers at once and "
+        "report their aggregate throughput",
+    )
+    parser.add_argument(
+        "--latency",
+        type=PARSER_TYPE_INT,
+        help="Take N latency samples over a persistent "
+        "connection to the best server and report their "
+        "distribution and jitter",
+    )
+    parser.add_argument(
+        "--latency-connect",
+        action="store_true",
+        help="With --latency or --dual-stack, also time N TCP connects",
+    )
+    parser.add_argument(
+        "--loaded-latency",
+        action="store_true",
+        help="Sample the latency during the download and "
+        "upload tests and report the increase over idle "
+        "latency (bufferbloat)",
+    )
+    parser.add_argument(
+        "--idle-samples",
+        default=30,
+        type=PARSER_TYPE_INT,
+        help="With --loaded-latency and no --latency, take N "
+        "idle latency samples to compare against. Default 30",
+    )
     parser.add_argument("--mini", help="URL of the Speedtest Mini server")
     parser.add_argument("--source", help="Source IP address to bind to")
     parser.add_argument(
@@ -1894,11 +5680,142 @@ def parse_args():
         action="store_const",
         default=True,
         const=False,
-        help="Do not pre allocate upload data. Pre allocation "
-        "is enabled by default to improve upload "
-        "performance. To support systems with "
-        "insufficient memory, use this option to avoid a "
-        "MemoryError",
+        help="Do not pre allocate upload data. Upload data is "
+        "a single buffer shared by all upload requests, "
+        "pre allocated by default before the upload test "
+        "starts",
+    )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        default=False,
+        help="Cache the speedtest.net configuration, server list "
+        "and best server on disk, and reuse them on later runs",
+    )
+    parser.add_argument(
+        "--cache-file",
+        default=None,
+        help="Path of the cache file used by --cache. Default "
+        "speedtest-cli-cache.json in the temporary directory",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        default=21600,
+        type=PARSER_TYPE_INT,
+        help="Seconds before cached data used by --cache " "expires. Default 21600",
+    )
+    parser.add_argument(
+        "--history",
+        action="store_true",
+        help="Append the results to a local history database",
+    )
+    parser.add_argument(
+        "--history-file",
+        default=None,
+        help="Path of the history database used by --history "
+        "and --history-query. Default .speedtest-cli-history.sqlite "
+        "in the home directory",
+    )
+    parser.add_argument(
+        "--history-query",
+        action="store_true",
+        help="Show statistics of the results stored by --history "
+        "and how the latest compares to the ones before it, "
+        "then exit",
+    )
+    parser.add_argument(
+        "--history-days",
+        default=7,
+        type=PARSER_TYPE_FLOAT,
+        help="Days of history used by --history-query. Default 7",
+    )
+    parser.add_argument(
+        "--min-download",
+        type=PARSER_TYPE_FLOAT,
+        help="Exit with code %d if the download speed, in "
+        "Mbit/s or Mbyte/s with --bytes, is below this. Errors exit "
+        "with code 1, invalid arguments with code 2" % SpeedtestThresholdFailure.failed,
+    )
+    parser.add_argument(
+        "--min-upload",
+        type=PARSER_TYPE_FLOAT,
+        help="Exit with code %d if the upload speed, in "
+        "Mbit/s or Mbyte/s with --bytes, is below this"
+        % SpeedtestThresholdFailure.failed,
+    )
+    parser.add_argument(
+        "--max-ping",
+        type=PARSER_TYPE_FLOAT,
+        help="Exit with code %d if the ping, in ms, is above this"
+        % SpeedtestThresholdFailure.failed,
+    )
+    parser.add_argument(
+        "--max-drop",
+        type=PARSER_TYPE_FLOAT,
+        help="Exit with code %d, unless another threshold failed, "
+        "if the download or upload speed is more than this "
+        "percentage below its median over the --history-days "
+        "stored by --history" % SpeedtestThresholdFailure.dropped,
+    )
+    parser.add_argument(
+        "--dual-stack",
+        action="store_true",
+        help="Run the latency, download and upload tests once over "
+        "IPv4 and once over IPv6 and report both, to find sites "
+        "where a broken IPv6 path degrades performance. The main "
+        "results are those of the family used by default",
+    )
+    parser.add_argument(
+        "--site-lock",
+        metavar="PATH",
+        help="Wait for a free slot in the lock at PATH, on a "
+        "path shared by the agents of a site, before testing, so "
+        "that the agents do not share the uplink during a test",
+    )
+    parser.add_argument(
+        "--site-slots",
+        default=1,
+        type=PARSER_TYPE_INT,
+        help="Agents allowed to test at once with --site-lock. Default 1",
+    )
+    parser.add_argument(
+        "--site-wait",
+        default=900,
+        type=PARSER_TYPE_FLOAT,
+        help="Seconds to wait for a slot with --site-lock before "
+        "giving up. Default 900",
+    )
+    parser.add_argument(
+        "--duration",
+        type=PARSER_TYPE_FLOAT,
+        help="Stream for this many seconds in each of the "
+        "download and upload tests, instead of running "
+        "through a fixed set of file sizes",
+    )
+    parser.add_argument(
+        "--budget",
+        type=PARSER_TYPE_FLOAT,
+        metavar="MB",
+        help="Move at most this many megabytes in the download "
+        "and upload tests together, ending each test as soon as "
+        "its steady state throughput is known to within "
+        "--budget-tolerance. For metered links",
+    )
+    parser.add_argument(
+        "--budget-tolerance",
+        default=5,
+        type=PARSER_TYPE_FLOAT,
+        metavar="PCT",
+        help="Margin of error, in percent at 95%% confidence, "
+        "within which --budget ends a test early. Default 5",
+    )
+    parser.add_argument(
+        "--engine",
+        default="threads",
+        choices=("threads", "asyncio"),
+        help='Test engine to use. "threads" uses a thread per '
+        'connection, "asyncio" runs all connections on a single '
+        "event loop (Python 3 only). Default threads",
     )
     parser.add_argument(
         "--version", action="store_true", help="Show the version number and exit"
@@ -1924,15 +5841,29 @@ def validate_optional_args(args):
     """
     optional_args = {
         "json": ("json/simplejson python module", json),
+        "cache": ("json/simplejson python module", json),
+        "progress_fd": ("json/simplejson python module", json),
+        "history": ("sqlite3 python module", "sqlite3"),
+        "history_query": ("sqlite3 python module", "sqlite3"),
+        "max_drop": ("sqlite3 python module", "sqlite3"),
         "secure": ("SSL support", HTTPSConnection),
     }
 
     for arg, info in optional_args.items():
-        if getattr(args, arg, False) and info[1] is None:
+        if not getattr(args, arg, False):
+            continue
+        module = info[1]
+        if isinstance(module, str):
+            # Only imported by the code paths that use it, see import_optional
+            module = import_optional(module)
+        if module is None:
             raise SystemExit(
                 "%s is not installed. --%s is " "unavailable" % (info[0], arg)
             )
 
+    if getattr(args, "engine", None) == "asyncio" and asyncio_engine() is None:
+        raise SystemExit("asyncio is not available. --engine asyncio is unavailable")
+
 
 def printer(string, quiet=False, debug=False, error=False, **kwargs):
     """Helper function print a string with various features"""
@@ -1975,6 +5906,43 @@ def shell():
     if len(args.csv_delimiter) != 1:
         raise SpeedtestCLIError("--csv-delimiter must be a single character")
 
+    if args.duration is not None and args.duration <= 0:
+        raise SpeedtestCLIError("--duration must be greater than 0")
+
+    if args.multi is not None and args.multi < 1:
+        raise SpeedtestCLIError("--multi must be at least 1")
+
+    if args.latency is not None and args.latency < 1:
+        raise SpeedtestCLIError("--latency must be at least 1")
+
+    if args.latency_connect and not (args.latency or args.dual_stack):
+        raise SpeedtestCLIError(
+            "--latency-connect can only be used with --latency or --dual-stack"
+        )
+
+    if args.idle_samples < 1:
+        raise SpeedtestCLIError("--idle-samples must be at least 1")
+
+    if args.budget is not None and args.budget <= 0:
+        raise SpeedtestCLIError("--budget must be greater than 0")
+
+    if args.budget_tolerance <= 0:
+        raise SpeedtestCLIError("--budget-tolerance must be greater than 0")
+
+    if args.dual_stack and args.multi:
+        raise SpeedtestCLIError("--dual-stack can not be used with --multi")
+
+    if args.site_slots < 1:
+        raise SpeedtestCLIError("--site-slots must be at least 1")
+
+    if args.progress_fd is not None:
+        try:
+            os.fstat(args.progress_fd)
+        except OSError:
+            raise SpeedtestCLIError(
+                "--progress-fd %s is not an open file descriptor" % args.progress_fd
+            )
+
     if args.csv_header:
         csv_header(args.csv_delimiter)
 
@@ -1986,7 +5954,7 @@ def shell():
     if debug:
         DEBUG = True
 
-    if args.simple or args.csv or args.json:
+    if args.simple or args.csv or args.json or args.progress_fd == 1:
         quiet = True
     else:
         quiet = False
@@ -1996,16 +5964,65 @@ def shell():
     else:
         machine_format = False
 
+    if args.history_query:
+        import sqlite3
+
+        try:
+            summary = SpeedtestHistory(args.history_file).summary(args.history_days)
+        except sqlite3.Error:
+            raise SpeedtestCLIError("Could not read history: %s" % get_exception())
+        if args.json:
+            printer(json.dumps(summary))
+        else:
+            print_history(summary, args.units)
+        sys.exit(0)
+
     # Don't set a callback if we are running quietly
     if quiet or debug:
         callback = do_nothing
     else:
         callback = print_dots(shutdown_event)
 
+    progress = None
+    if args.progress_fd is not None:
+        progress = SpeedtestProgress(args.progress_fd)
+        progress.emit("start", pid=os.getpid(), version=__version__)
+
+    if args.site_lock:
+        printer("Waiting for a site slot...", quiet)
+        site_lock = SpeedtestSiteLock(args.site_lock, args.site_slots, args.site_wait)
+        site_lock.acquire()
+        # Released on any exit, including errors and Ctrl-C, and expired by
+        # the other agents should this process be killed
+        atexit.register(site_lock.release)
+        printer(
+            "Acquired site slot %d after %0.1f s" % (site_lock.slot, site_lock.waited),
+            quiet,
+        )
+        if progress:
+            progress.emit("site_slot", slot=site_lock.slot, waited=site_lock.waited)
+
     printer("Retrieving speedtest.net configuration...", quiet)
     try:
-        speedtest = Speedtest(
-            source_address=args.source, timeout=args.timeout, secure=args.secure
+        if args.engine == "asyncio":
+            engine = asyncio_engine()
+        else:
+            engine = Speedtest
+        if args.cache:
+            cache = SpeedtestCache(args.cache_file, args.cache_ttl)
+        else:
+            cache = None
+        speedtest = engine(
+            source_address=args.source,
+            timeout=args.timeout,
+            secure=args.secure,
+            cache=cache,
+            duration=args.duration,
+            loaded_latency=args.loaded_latency,
+            idle_samples=args.idle_samples,
+            progress=progress,
+            budget=args.budget and args.budget * 1000 * 1000,
+            budget_tolerance=args.budget_tolerance / 100.0,
         )
     except (ConfigRetrievalError,) + HTTP_ERRORS:
         printer("Cannot retrieve speedtest configuration", error=True)
@@ -2034,10 +6051,11 @@ def shell():
 
     printer("Testing from %(isp)s (%(ip)s)..." % speedtest.config["client"], quiet)
 
+    multi = None
     if not args.mini:
         printer("Retrieving speedtest.net server list...", quiet)
         try:
-            speedtest.get_servers(servers=args.server, exclude=args.exclude)
+            speedtest.index_servers(servers=args.server, exclude=args.exclude)
         except NoMatchedServers:
             raise SpeedtestCLIError(
                 "No matched servers: %s" % ", ".join("%s" % s for s in args.server)
@@ -2055,7 +6073,10 @@ def shell():
             printer("Retrieving information for the selected server...", quiet)
         else:
             printer("Selecting best server based on ping...", quiet)
-        speedtest.get_best_server()
+        if args.multi:
+            multi = speedtest.get_best_servers(args.multi)
+        else:
+            speedtest.get_best_server()
     elif args.mini:
         speedtest.get_best_server(speedtest.set_mini_server(args.mini))
 
@@ -2066,38 +6087,110 @@ def shell():
         "%(latency)s ms" % results.server,
         quiet,
     )
-
-    if args.download:
-        printer("Testing download speed", quiet, end=("", "\n")[bool(debug)])
-        speedtest.download(callback=callback, threads=(None, 1)[args.single])
+    for server in (multi or [])[1:]:
         printer(
-            "Download: %0.2f M%s/s"
-            % ((results.download / 1000.0 / 1000.0) / args.units[1], args.units[0]),
+            "Also testing %(sponsor)s (%(name)s) [%(d)0.2f km]: "
+            "%(latency)s ms" % server,
             quiet,
         )
-    else:
-        printer("Skipping download test", quiet)
 
-    if args.upload:
-        printer("Testing upload speed", quiet, end=("", "\n")[bool(debug)])
-        speedtest.upload(
+    if args.dual_stack:
+        printer(
+            "Testing latency, download and upload speed over IPv4 and IPv6",
+            quiet,
+            end=("", "\n")[bool(debug)],
+        )
+        speedtest.dual_stack(
+            samples=args.latency or 10,
+            download=args.download,
+            upload=args.upload,
             callback=callback,
-            pre_allocate=args.pre_allocate,
             threads=(None, 1)[args.single],
+            pre_allocate=args.pre_allocate,
+            connect=args.latency_connect,
         )
+        print_dual_stack(results, args.units, quiet)
+    else:
+        if args.latency:
+            printer("Testing latency...", quiet)
+            latency = speedtest.latency(args.latency, connect=args.latency_connect)
+            print_latency("Latency", latency, quiet)
+            if "connect" in latency:
+                print_latency("TCP connect", latency["connect"], quiet)
+
+        if args.download:
+            printer("Testing download speed", quiet, end=("", "\n")[bool(debug)])
+            speedtest.download(
+                callback=callback, threads=(None, 1)[args.single], servers=multi
+            )
+            printer(
+                "Download: %0.2f M%s/s"
+                % ((results.download / 1000.0 / 1000.0) / args.units[1], args.units[0]),
+                quiet,
+            )
+        else:
+            printer("Skipping download test", quiet)
+
+        print_loaded_latency("download", results, quiet)
+        print_budget("download", results, quiet)
+
+        if args.upload:
+            printer("Testing upload speed", quiet, end=("", "\n")[bool(debug)])
+            speedtest.upload(
+                callback=callback,
+                pre_allocate=args.pre_allocate,
+                threads=(None, 1)[args.single],
+                servers=multi,
+            )
+            printer(
+                "Upload: %0.2f M%s/s"
+                % ((results.upload / 1000.0 / 1000.0) / args.units[1], args.units[0]),
+                quiet,
+            )
+        else:
+            printer("Skipping upload test", quiet)
+
+        print_loaded_latency("upload", results, quiet)
+        print_budget("upload", results, quiet)
+
+    for entry in results.per_server:
         printer(
-            "Upload: %0.2f M%s/s"
-            % ((results.upload / 1000.0 / 1000.0) / args.units[1], args.units[0]),
+            "%s (%s): Download: %0.2f M%s/s, Upload: %0.2f M%s/s"
+            % (
+                entry["server"]["sponsor"],
+                entry["server"]["name"],
+                (entry["download"] / 1000.0 / 1000.0) / args.units[1],
+                args.units[0],
+                (entry["upload"] / 1000.0 / 1000.0) / args.units[1],
+                args.units[0],
+            ),
             quiet,
         )
-    else:
-        printer("Skipping upload test", quiet)
 
     printer("Results:\n%r" % results.dict(), debug=True)
 
     if not args.simple and args.share:
         results.share()
 
+    baseline = None
+    if args.max_drop is not None:
+        import sqlite3
+
+        try:
+            baseline = SpeedtestHistory(args.history_file).summary(args.history_days)
+        except sqlite3.Error:
+            e = get_exception()
+            printer("Could not read history, --max-drop skipped: %s" % e, error=True)
+
+    if args.history:
+        import sqlite3
+
+        try:
+            SpeedtestHistory(args.history_file).add(results)
+        except sqlite3.Error:
+            e = get_exception()
+            printer("Could not record history: %s" % e, error=True)
+
     if args.simple:
         printer(
             "Ping: %s ms\nDownload: %0.2f M%s/s\nUpload: %0.2f M%s/s"
@@ -2117,12 +6210,24 @@ def shell():
     if args.share and not machine_format:
         printer("Share results: %s" % results.share())
 
+    if args.profile:
+        print_profile(speedtest.profile, error=machine_format)
+
+    if progress:
+        progress.emit("result", results=results.dict())
+
+    code = check_thresholds(args, results, baseline)
+    if code:
+        raise SpeedtestThresholdFailure(code)
+
 
 def main():
     try:
         shell()
     except KeyboardInterrupt:
         printer("\nCancelling...", error=True)
+    except SpeedtestThresholdFailure:
+        raise SystemExit(get_exception().code)
     except (SpeedtestException, SystemExit):
         e = get_exception()
         # Ignore a successful exit, or argparse exit
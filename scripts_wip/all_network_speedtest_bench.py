@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+"""Local Speedtest Mini compatible server and benchmark for
+scripts/all_network_speedtest.py
+
+Everything runs over loopback, no internet access is needed.
+
+    serve   Run the test server (latency.txt, random*.jpg, upload.php)
+    bench   Run get_best_server/download/upload against the test server
+            for each engine and report throughput and client CPU time
+    startup Time cold starts of the script with --version and list the
+            slowest imports
+
+Examples:
+
+    python all_network_speedtest_bench.py serve --port 8080
+    python all_network_speedtest_bench.py bench --engine threads asyncio
+    python all_network_speedtest_bench.py bench --delay 0.02 --rate 200
+    python all_network_speedtest_bench.py startup --runs 20
+    git show <baseline>:scripts/all_network_speedtest.py > /tmp/baseline.py
+    python all_network_speedtest_bench.py startup --baseline /tmp/baseline.py
+
+--delay adds a fixed delay in seconds before every response and --rate
+caps the aggregate transfer rate in Mbit/s, roughly what netem would do
+on a real link. Unless --url is given, bench starts the server in a child
+process so its CPU time is not counted against the client.
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SCRIPT = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    os.pardir,
+    "scripts",
+    "all_network_speedtest.py",
+)
+
+CHUNK = 65536
+BLOB = os.urandom(1 << 20)
+
+
+class Shaper:
+    """Paces the bytes sent and received by every connection to an
+    aggregate rate"""
+
+    def __init__(self, rate=None):
+        # Mbit/s to bytes/s
+        self.rate = rate * 125000.0 if rate else None
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def consume(self, size):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._next = max(self._next, now) + size / self.rate
+            wait = self._next - now
+        if wait > 0:
+            time.sleep(wait)
+
+
+class MiniHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    wbufsize = CHUNK
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, body, ctype="text/plain"):
+        self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        path = self.path.split("?")[0]
+
+        if path.endswith("/latency.txt"):
+            return self._reply(b"test=test")
+
+        match = re.search(r"/random(\d+)x(\d+)\.jpg$", path)
+        if match:
+            size = int(match.group(1)) * int(match.group(2)) * 2
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(size))
+            self.end_headers()
+            sent = 0
+            while sent < size:
+                chunk = min(CHUNK, size - sent)
+                self.server.shaper.consume(chunk)
+                self.wfile.write(BLOB[sent % len(BLOB) :][:chunk])
+                sent += chunk
+            return
+
+        if path in ("/", "/speedtest", "/speedtest/"):
+            return self._reply(b'<html>upload_extension: "php"</html>', "text/html")
+
+        self.send_error(404)
+
+    def do_POST(self):
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        remaining = length = int(self.headers.get("Content-Length", 0))
+        while remaining > 0:
+            data = self.rfile.read(min(CHUNK, remaining))
+            if not data:
+                break
+            self.server.shaper.consume(len(data))
+            remaining -= len(data)
+        self._reply(("size=%d" % (length - remaining)).encode())
+
+
+class MiniServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, delay=0, rate=None):
+        ThreadingHTTPServer.__init__(self, address, MiniHandler)
+        self.delay = delay
+        self.shaper = Shaper(rate)
+
+    def handle_error(self, request, client_address):
+        # Clients abort transfers at the end of every test
+        pass
+
+
+def serve(args):
+    server = MiniServer((args.host, args.port), args.delay, args.rate)
+    print("http://%s:%d/" % server.server_address[:2], flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def load_speedtest(path):
+    spec = importlib.util.spec_from_file_location("all_network_speedtest", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def bench_config(length, threads):
+    """Build the same configuration get_config derives from the default
+    speedtest.net settings, without fetching it"""
+    up_sizes = [524288, 1048576, 7340032]
+    upload_count = 17
+    return {
+        "client": {"ip": "127.0.0.1", "lat": "0", "lon": "0", "isp": "Loopback"},
+        "ignore_servers": [],
+        "sizes": {
+            "upload": up_sizes,
+            "download": [350, 500, 750, 1000, 1500, 2000, 2500, 3000, 3500, 4000],
+        },
+        "counts": {"upload": upload_count, "download": 4},
+        "threads": {"upload": threads[1], "download": threads[0]},
+        "length": {"upload": length, "download": length},
+        "upload_max": upload_count * len(up_sizes),
+    }
+
+
+def engine_class(module, name):
+    """Return the Speedtest class of engine ``name``, None if the script
+    does not have it"""
+    if name == "threads":
+        return module.Speedtest
+    if hasattr(module, "asyncio_engine"):
+        return module.asyncio_engine()
+    # Scripts that built the asyncio engine on import
+    return getattr(module, "AsyncioSpeedtest", None)
+
+
+def make_engine(module, name, config):
+    base = engine_class(module, name)
+
+    class BenchSpeedtest(base):
+        def get_config(self):
+            self.config.update(json.loads(json.dumps(config)))
+            self.lat_lon = (0.0, 0.0)
+            return self.config
+
+    return BenchSpeedtest
+
+
+def measure(func):
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    result = func()
+    return result, time.perf_counter() - wall, time.process_time() - cpu
+
+
+def bench_once(engine, url, args):
+    speedtest = engine(timeout=args.timeout, duration=args.duration)
+    servers = speedtest.set_mini_server(url)
+
+    phases = {}
+    _, wall, cpu = measure(lambda: speedtest.get_best_server(servers))
+    phases["latency"] = {"wall": wall, "cpu": cpu, "ping": speedtest.results.ping}
+    for phase in ("download", "upload"):
+        threads = args.threads or None
+        bits, wall, cpu = measure(lambda: getattr(speedtest, phase)(threads=threads))
+        moved = speedtest.results.bytes_received
+        if phase == "upload":
+            moved = speedtest.results.bytes_sent
+        phases[phase] = {
+            "wall": wall,
+            "cpu": cpu,
+            "mbps": bits / 1e6,
+            "bytes": moved,
+            # CPU seconds spent by the client per Gbit moved
+            "cpu_per_gbit": cpu / (moved * 8 / 1e9) if moved else None,
+        }
+    return phases
+
+
+def summarize(runs):
+    """Median of every metric across runs"""
+    summary = {}
+    for phase in runs[0]:
+        summary[phase] = {}
+        for key in runs[0][phase]:
+            values = [run[phase][key] for run in runs if run[phase][key] is not None]
+            summary[phase][key] = statistics.median(values) if values else None
+    return summary
+
+
+def start_server(args):
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.abspath(__file__),
+            "serve",
+            "--port",
+            "0",
+            "--delay",
+            str(args.delay),
+        ]
+        + (["--rate", str(args.rate)] if args.rate else []),
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    return process, process.stdout.readline().strip()
+
+
+def bench(args):
+    module = load_speedtest(args.script)
+    config = bench_config(args.length, args.stream_counts)
+
+    process = None
+    url = args.url
+    if not url:
+        process, url = start_server(args)
+    try:
+        results = {}
+        for name in args.engine:
+            if engine_class(module, name) is None:
+                continue
+            engine = make_engine(module, name, config)
+            runs = [bench_once(engine, url, args) for _ in range(args.runs)]
+            results[name] = summarize(runs)
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+
+    if args.json:
+        print(json.dumps(results, indent=4, sort_keys=True))
+        return
+
+    row = "%-8s %-9s %12s %8s %8s %12s"
+    print(row % ("engine", "phase", "Mbit/s", "wall", "cpu", "cpu s/Gbit"))
+    for name, phases in results.items():
+        for phase, data in phases.items():
+            mbps = cpu_per_gbit = "-"
+            if "mbps" in data:
+                mbps = "%0.2f" % data["mbps"]
+            if data.get("cpu_per_gbit"):
+                cpu_per_gbit = "%0.4f" % data["cpu_per_gbit"]
+            wall = "%0.3f" % data["wall"]
+            cpu = "%0.3f" % data["cpu"]
+            print(row % (name, phase, mbps, wall, cpu, cpu_per_gbit))
+
+
+def timed_run(command):
+    start = time.perf_counter()
+    subprocess.run(command, stdout=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+
+def import_times(script):
+    """Cumulative import time in seconds of every module the script
+    imports directly, from python -X importtime"""
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", script, "--version"],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    times = {}
+    for line in process.stderr.splitlines():
+        match = re.match(r"import time:\s+\d+ \|\s+(\d+) \| (\S.*)$", line)
+        if match:
+            times[match.group(2)] = int(match.group(1)) / 1e6
+    return times
+
+
+def startup(args):
+    """Time cold starts of the script, and of the baseline script if any,
+    alternating between them. Returns 1 if the script starts slower than
+    the baseline allows"""
+    scripts = [args.script] + ([args.baseline] if args.baseline else [])
+    python = []
+    times = dict((script, []) for script in scripts)
+    for _ in range(args.runs):
+        python.append(timed_run([sys.executable, "-c", "pass"]))
+        for script in scripts:
+            times[script].append(timed_run([sys.executable, script, "--version"]))
+    imports = sorted(import_times(args.script).items(), key=lambda i: -i[1])
+    results = {
+        "python": statistics.median(python),
+        "script": statistics.median(times[args.script]),
+        "imports": dict(imports[: args.top]),
+    }
+    slower = False
+    if args.baseline:
+        results["baseline"] = statistics.median(times[args.baseline])
+        slower = results["script"] > results["baseline"] * (1 + args.tolerance / 100)
+
+    if args.json:
+        print(json.dumps(results, indent=4, sort_keys=True))
+    else:
+        print("%-24s %8.1f ms" % ("python -c pass", results["python"] * 1000))
+        print("%-24s %8.1f ms" % ("script --version", results["script"] * 1000))
+        if args.baseline:
+            print("%-24s %8.1f ms" % ("baseline --version", results["baseline"] * 1000))
+        if imports[: args.top]:
+            print("\nSlowest imports:")
+        for name, seconds in imports[: args.top]:
+            print("%-24s %8.1f ms" % (name, seconds * 1000))
+
+    if slower:
+        sys.stderr.write(
+            "Startup is slower than the baseline: %0.1f ms, %0.1f ms allowed\n"
+            % (
+                results["script"] * 1000,
+                results["baseline"] * (1 + args.tolerance / 100) * 1000,
+            )
+        )
+        return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    shaping = argparse.ArgumentParser(add_help=False)
+    shaping.add_argument(
+        "--delay", type=float, default=0, help="Seconds added before every response"
+    )
+    shaping.add_argument("--rate", type=float, help="Aggregate rate cap in Mbit/s")
+
+    parser_serve = commands.add_parser(
+        "serve", parents=[shaping], help="Run the test server"
+    )
+    parser_serve.add_argument("--host", default="127.0.0.1")
+    parser_serve.add_argument("--port", type=int, default=8080)
+
+    parser_bench = commands.add_parser(
+        "bench", parents=[shaping], help="Benchmark the client"
+    )
+    parser_bench.add_argument(
+        "--url", help="Use an already running server instead of starting one"
+    )
+    parser_bench.add_argument(
+        "--script", default=SCRIPT, help="Speedtest script to benchmark"
+    )
+    parser_bench.add_argument(
+        "--engine",
+        nargs="+",
+        default=["threads", "asyncio"],
+        choices=("threads", "asyncio"),
+    )
+    parser_bench.add_argument(
+        "--runs", type=int, default=3, help="Runs per engine, the median is reported"
+    )
+    parser_bench.add_argument(
+        "--length", type=float, default=10, help="Test length in seconds"
+    )
+    parser_bench.add_argument(
+        "--duration", type=float, help="Use the --duration mode of the client"
+    )
+    parser_bench.add_argument(
+        "--threads", type=int, help="Fixed stream count instead of the ramp"
+    )
+    parser_bench.add_argument(
+        "--stream-counts",
+        type=int,
+        nargs=2,
+        default=(8, 2),
+        metavar=("DOWNLOAD", "UPLOAD"),
+        help="Initial download and upload streams",
+    )
+    parser_bench.add_argument("--timeout", type=float, default=10)
+    parser_bench.add_argument("--json", action="store_true")
+
+    parser_startup = commands.add_parser(
+        "startup", help="Time the script's startup and imports"
+    )
+    parser_startup.add_argument(
+        "--script", default=SCRIPT, help="Speedtest script to benchmark"
+    )
+    parser_startup.add_argument(
+        "--runs", type=int, default=10, help="Cold starts, the median is reported"
+    )
+    parser_startup.add_argument(
+        "--top", type=int, default=10, help="Number of slowest imports to list"
+    )
+    parser_startup.add_argument(
+        "--baseline",
+        help="Script to compare with, exits with 1 if --script starts slower",
+    )
+    parser_startup.add_argument(
+        "--tolerance",
+        type=float,
+        default=0,
+        help="Slowdown against --baseline allowed, in percent",
+    )
+    parser_startup.add_argument("--json", action="store_true")
+
+    args = parser.parse_args()
+    if args.command == "serve":
+        serve(args)
+    elif args.command == "startup":
+        sys.exit(startup(args))
+    else:
+        bench(args)
+
+
+if __name__ == "__main__":
+    main()
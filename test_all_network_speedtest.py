@@ -0,0 +1,1008 @@
+import contextlib
+import glob
+import importlib.util
+import io
+import json
+import os
+import random
+import socket
+import re
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def _load_bench():
+    path = os.path.join(HERE, "scripts_wip", "all_network_speedtest_bench.py")
+    spec = importlib.util.spec_from_file_location("all_network_speedtest_bench", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+bench = _load_bench()
+speedtest = bench.load_speedtest(bench.SCRIPT)
+
+# Aggregate rate cap of the shaped server, in Mbit/s
+RATE = 100
+
+
+@contextlib.contextmanager
+def serving(srv):
+    """Run ``srv`` on a thread for the duration of the block"""
+    thread = threading.Thread(target=srv.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield srv
+    finally:
+        srv.shutdown()
+        srv.server_close()
+
+
+@pytest.mark.parametrize("direction", ["download", "upload"])
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_rate_matches_cap(engine, direction):
+    srv = bench.MiniServer(("127.0.0.1", 0), rate=RATE)
+    thread = threading.Thread(target=srv.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        config = bench.bench_config(3, (8, 2))
+        st = bench.make_engine(speedtest, engine, config)(duration=3)
+        st.get_best_server(
+            st.set_mini_server("http://127.0.0.1:%d/speedtest/" % srv.server_port)
+        )
+        bps = getattr(st, direction)()
+    finally:
+        srv.shutdown()
+        srv.server_close()
+    assert RATE * 0.9e6 <= bps <= RATE * 1.05e6
+
+
+class FakeRequest(object):
+    """Stands in for HTTPDownloader and HTTPUploader in the worker pool"""
+
+    running = 0
+    most = 0
+    lock = threading.Lock()
+
+    def __init__(self, i, error=None):
+        self.i = i
+        self.error = error
+        self.thread = None
+
+    def run(self):
+        cls = FakeRequest
+        with cls.lock:
+            cls.running += 1
+            cls.most = max(cls.most, cls.running)
+        self.thread = threading.current_thread().ident
+        time.sleep(0.01)
+        with cls.lock:
+            cls.running -= 1
+
+
+def test_worker_pool_reuses_threads():
+    FakeRequest.most = 0
+    requests = [FakeRequest(i) for i in range(20)]
+    calls = []
+
+    def callback(i, count, start=False, end=False):
+        calls.append((start, end, count))
+
+    pool = speedtest.SpeedtestWorkerPool(4, callback=callback)
+    finished = pool.run(requests)
+    assert sorted(finished, key=lambda r: r.i) == requests
+    assert pool.threads == 4
+    assert FakeRequest.most <= 4
+    assert len(set([r.thread for r in requests])) <= 4
+    assert calls.count((True, False, 20)) == 20
+    assert calls.count((False, True, 20)) == 20
+
+
+def test_worker_pool_stops_on_shutdown():
+    event = threading.Event()
+    event.set()
+    requests = [FakeRequest(i) for i in range(10)]
+    pool = speedtest.SpeedtestWorkerPool(3, shutdown_event=event)
+    assert len(pool.run(requests)) == 10
+    # Requests are still reported as finished, without being run
+    assert not [r for r in requests if r.thread]
+
+
+def test_worker_pool_reports_errors():
+    error = speedtest.SpeedtestHTTPError("boom")
+    requests = [FakeRequest(0), FakeRequest(1, error), FakeRequest(2)]
+    errors = []
+    pool = speedtest.SpeedtestWorkerPool(
+        2, error_callback=lambda i, e: errors.append((i, e))
+    )
+    pool.run(requests)
+    assert errors == [(1, error)]
+
+
+def test_worker_pool_no_more_threads_than_requests():
+    pool = speedtest.SpeedtestWorkerPool(8)
+    pool.run([FakeRequest(0), FakeRequest(1)])
+    assert pool.threads == 2
+
+
+class CountingHandler(bench.MiniHandler):
+    """MiniHandler recording the client port of every request, that can
+    close the connection after each response without saying so"""
+
+    def handle_one_request(self):
+        bench.MiniHandler.handle_one_request(self)
+        if self.server.close_every:
+            self.close_connection = True
+
+    def do_GET(self):
+        self.server.ports.append(self.client_address[1])
+        return bench.MiniHandler.do_GET(self)
+
+    def do_POST(self):
+        self.server.ports.append(self.client_address[1])
+        return bench.MiniHandler.do_POST(self)
+
+
+def counting_server(close_every=False):
+    srv = bench.MiniServer(("127.0.0.1", 0))
+    srv.RequestHandlerClass = CountingHandler
+    srv.close_every = close_every
+    srv.ports = []
+    return srv
+
+
+def _upload_request(url, size=100000):
+    data = speedtest.HTTPUploaderData(size, speedtest.timeit.default_timer(), 10)
+    data.pre_allocate()
+    return speedtest.build_request(url, data=data, headers={"Content-length": size})
+
+
+def test_connection_pool_reuses_connections():
+    with serving(counting_server()) as srv:
+        base = "http://127.0.0.1:%d/speedtest/" % srv.server_port
+        pool = speedtest.SpeedtestConnectionPool()
+        opener = speedtest.build_opener(pool=pool)
+        for _ in range(3):
+            f = opener.open(speedtest.build_request(base + "random350x350.jpg"))
+            assert len(f.read()) == 350 * 350 * 2
+            f.close()
+            f = opener.open(_upload_request(base + "upload.php"))
+            assert f.read() == b"size=100000"
+            f.close()
+        pool.clear()
+    assert len(srv.ports) == 6
+    assert len(set(srv.ports)) == 1
+
+
+def test_connection_pool_replaces_dropped_connections():
+    with serving(counting_server(close_every=True)) as srv:
+        url = "http://127.0.0.1:%d/speedtest/latency.txt" % srv.server_port
+        pool = speedtest.SpeedtestConnectionPool()
+        opener = speedtest.build_opener(pool=pool)
+        for _ in range(3):
+            f = opener.open(speedtest.build_request(url))
+            assert f.read() == b"test=test"
+            f.close()
+            time.sleep(0.05)
+        pool.clear()
+    assert len(set(srv.ports)) == 3
+
+
+@pytest.mark.parametrize("upload", [False, True])
+def test_connection_pool_retries_stale_connections(monkeypatch, upload):
+    # The server closes the connection right after the liveness check
+    monkeypatch.setattr(speedtest, "_connection_dropped", lambda conn: False)
+    with serving(counting_server(close_every=True)) as srv:
+        base = "http://127.0.0.1:%d/speedtest/" % srv.server_port
+        opener = speedtest.build_opener(pool=speedtest.SpeedtestConnectionPool())
+        for _ in range(3):
+            if upload:
+                f = opener.open(_upload_request(base + "upload.php"))
+                assert f.read() == b"size=100000"
+            else:
+                f = opener.open(speedtest.build_request(base + "latency.txt"))
+                assert f.read() == b"test=test"
+            f.close()
+            time.sleep(0.05)
+    assert len(set(srv.ports)) == 3
+
+
+class CountingShaper(bench.Shaper):
+    """Shaper also counting the bytes the server sent and received"""
+
+    def __init__(self, rate=None):
+        bench.Shaper.__init__(self, rate)
+        self.total = 0
+
+    def consume(self, size):
+        with self._lock:
+            self.total += size
+        bench.Shaper.consume(self, size)
+
+
+def shaped_server(rate=RATE, delay=0):
+    srv = bench.MiniServer(("127.0.0.1", 0), delay=delay)
+    srv.shaper = CountingShaper(rate)
+    return srv
+
+
+def mini_speedtest(srv, engine="threads", length=3, **kwargs):
+    """Return a Speedtest of ``engine`` with ``srv`` as its best server"""
+    config = bench.bench_config(length, (8, 2))
+    st = bench.make_engine(speedtest, engine, config)(**kwargs)
+    st.get_best_server(
+        st.set_mini_server("http://127.0.0.1:%d/speedtest/" % srv.server_port)
+    )
+    return st
+
+
+@pytest.mark.parametrize("direction", ["download", "upload"])
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_counts_bytes_the_server_moved(engine, direction):
+    with serving(shaped_server()) as srv:
+        st = mini_speedtest(srv, engine, duration=2)
+        srv.shaper.total = 0
+        getattr(st, direction)()
+        moved = srv.shaper.total
+    # Bytes still in the socket buffers of either end when the test ends
+    # are counted by one of them only, a few MB on loopback
+    if direction == "download":
+        assert 0.85 * moved <= st.results.bytes_received <= moved
+    else:
+        assert abs(st.results.bytes_sent - moved) <= 0.1 * moved
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_latency(engine):
+    with serving(shaped_server(delay=0.02)) as srv:
+        st = mini_speedtest(srv, engine)
+    # Like speedtest.net, the sum of 3 samples is divided by 6
+    assert 10 <= st.results.ping < 20
+
+
+class ProxyHandler(CountingHandler):
+    """Answers requests for absolute URLs itself, as a proxy would"""
+
+    def parse_request(self):
+        if not bench.MiniHandler.parse_request(self):
+            return False
+        self.path = re.sub(r"^http://[^/]+", "", self.path)
+        return True
+
+
+def test_asyncio_runs_threads_behind_a_proxy(monkeypatch):
+    monkeypatch.delenv("no_proxy", raising=False)
+    monkeypatch.delenv("NO_PROXY", raising=False)
+    proxy = counting_server()
+    proxy.RequestHandlerClass = ProxyHandler
+    with serving(proxy):
+        monkeypatch.setenv("http_proxy", "http://127.0.0.1:%d" % proxy.server_port)
+        with serving(shaped_server()) as srv:
+            st = mini_speedtest(srv, "asyncio", length=1)
+            direct = srv.shaper.total
+            assert st.download() > 0
+            assert st.upload() > 0
+            # Nothing but the raw latency probes reached the server
+            # without the proxy
+            assert srv.shaper.total == direct
+    assert proxy.ports
+
+
+CONFIG = (
+    '<?xml version="1.0"?><settings>'
+    '<client ip="%s" lat="40.1" lon="-74.1" isp="Test ISP" isprating="3.7" '
+    'rating="0" ispdlavg="0" ispulavg="0" loggedin="0" country="TL"/>'
+    '<server-config threadcount="4" ignoreids="" notonmap="" forcepingid="" '
+    'preferredserverid=""/>'
+    '<download testlength="1" initialtest="250K" mintestsize="250K" '
+    'threadsperurl="4"/>'
+    '<upload testlength="1" ratio="5" initialtest="0" mintestsize="32K" '
+    'threads="2" maxchunksize="512K" maxchunkcount="50" threadsperurl="4"/>'
+    "</settings>"
+)
+
+SERVER = (
+    '<server url="http://127.0.0.1:%d/speedtest/upload.php" lat="40.%d" '
+    'lon="-74.1" name="City%d" country="Testland" cc="TL" sponsor="Sponsor%d" '
+    'id="%d" host="127.0.0.1:%d"/>'
+)
+
+
+class SpeedtestNetHandler(bench.MiniHandler):
+    """MiniHandler also answering for speedtest.net, with the configuration
+    and a server list pointing back at the same server"""
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path.endswith("/speedtest-config.php"):
+            self.server.requests.append("config")
+            body = CONFIG % self.server.client_ip
+            return self._reply(body.encode(), "text/xml")
+        if "/speedtest-servers" in path:
+            self.server.requests.append("servers")
+            port = self.server.server_port
+            servers = "".join(
+                [SERVER % (port, i, i, i, 1000 + i, port) for i in range(3)]
+            )
+            body = '<?xml version="1.0"?><settings><servers>%s</servers></settings>'
+            return self._reply((body % servers).encode(), "text/xml")
+        if self.server.broken and path.startswith("/speedtest/"):
+            return self.send_error(404)
+        return bench.MiniHandler.do_GET(self)
+
+
+class SpeedtestNetServer(bench.MiniServer):
+    def __init__(self, rate=None):
+        bench.MiniServer.__init__(self, ("127.0.0.1", 0), rate=rate)
+        self.RequestHandlerClass = SpeedtestNetHandler
+        self.client_ip = "10.0.0.1"
+        self.broken = False
+        self.requests = []
+
+
+@pytest.fixture
+def server(monkeypatch):
+    srv = SpeedtestNetServer()
+    local = "http://127.0.0.1:%d" % srv.server_port
+    build_request = speedtest.build_request
+
+    def build_local_request(url, *args, **kwargs):
+        url = re.sub(r"^(https?)?://(www|c)\.speedtest\.net", local, url)
+        return build_request(url, *args, **kwargs)
+
+    monkeypatch.setattr(speedtest, "build_request", build_local_request)
+    with serving(srv):
+        yield srv
+
+
+@pytest.fixture
+def network(monkeypatch):
+    """The network the machine is on, as Speedtest sees it"""
+    current = ["10.0.0.0"]
+    monkeypatch.setattr(speedtest.Speedtest, "_network_key", lambda self: current[0])
+    return current
+
+
+def _cached(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def test_cache_expires(tmp_path):
+    path = str(tmp_path / "cache.json")
+    speedtest.SpeedtestCache(path, 60).set("config", {"a": 1}, "net")
+    assert speedtest.SpeedtestCache(path, 60).get("config", "net") == {"a": 1}
+    assert speedtest.SpeedtestCache(path, 60).get("config", "other") is None
+    time.sleep(0.01)
+    assert speedtest.SpeedtestCache(path, 0.001).get("config", "net") is None
+
+
+def test_cache_unreadable(tmp_path):
+    path = tmp_path / "cache.json"
+    path.write_text("{not json")
+    cache = speedtest.SpeedtestCache(str(path), 60)
+    assert cache.get("config") is None
+    cache.set("config", {"a": 1})
+    assert _cached(str(path))["config"]["default"]["data"] == {"a": 1}
+
+
+def test_cache_follows_network(server, network, tmp_path):
+    path = str(tmp_path / "cache.json")
+
+    st = speedtest.Speedtest(cache=speedtest.SpeedtestCache(path))
+    st.get_best_server()
+    assert server.requests == ["config", "servers"]
+
+    # Same network, nothing is fetched again
+    st = speedtest.Speedtest(cache=speedtest.SpeedtestCache(path))
+    st.get_best_server()
+    assert server.requests == ["config", "servers"]
+    assert st._cached_best == "10.0.0.1|Test ISP"
+
+    # Another network, with another public address
+    network[0] = "192.168.1.0"
+    server.client_ip = "10.0.0.2"
+    st = speedtest.Speedtest(cache=speedtest.SpeedtestCache(path))
+    st.get_best_server()
+    assert server.requests == ["config", "servers"] * 2
+    assert st._cached_best is None
+    cached = _cached(path)
+    assert sorted(cached["config"]) == ["10.0.0.0", "192.168.1.0"]
+    assert sorted(cached["best"]) == ["10.0.0.1|Test ISP", "10.0.0.2|Test ISP"]
+
+
+def test_cache_dropped_with_failed_best(server, network, tmp_path):
+    path = str(tmp_path / "cache.json")
+    st = speedtest.Speedtest(cache=speedtest.SpeedtestCache(path))
+    st.get_best_server()
+
+    server.broken = True
+    st = speedtest.Speedtest(cache=speedtest.SpeedtestCache(path), duration=0.5)
+    st.get_best_server()
+    cached = _cached(path)
+    assert not cached["config"]
+
+    # The best server is selected again, a test moving nothing drops it too
+    server.broken = False
+    st = speedtest.Speedtest(cache=speedtest.SpeedtestCache(path), duration=0.5)
+    st.get_best_server()
+    assert st._cached_best == "10.0.0.1|Test ISP"
+    server.broken = True
+    assert st.download() == 0
+    cached = _cached(path)
+    assert not cached["config"]
+    assert not cached["best"]
+
+
+def _random_servers(count, seed=7):
+    rng = random.Random(seed)
+    return [
+        {
+            "id": str(i),
+            "lat": "%.4f" % rng.uniform(-90, 90),
+            "lon": "%.4f" % rng.uniform(-180, 180),
+        }
+        for i in range(count)
+    ]
+
+
+def _closest(servers, lat_lon, limit, accept=lambda s: True):
+    def km(server):
+        return speedtest.distance(lat_lon, (float(server["lat"]), float(server["lon"])))
+
+    return sorted([s for s in servers if accept(s)], key=km)[:limit]
+
+
+@pytest.mark.parametrize("lat_lon", [(40.1, -74.1), (-33.9, 151.2), (89.9, 179.9)])
+def test_server_index_nearest(lat_lon):
+    servers = _random_servers(2000)
+    index = speedtest.SpeedtestServerIndex()
+    for server in servers:
+        index.add(server)
+    index.build()
+    assert index.nearest(lat_lon, 10) == _closest(servers, lat_lon, 10)
+
+    def even(server):
+        return int(server["id"]) % 2 == 0
+
+    assert index.nearest(lat_lon, 5, even) == _closest(servers, lat_lon, 5, even)
+    assert index.nearest(lat_lon, 0) == []
+
+
+def test_server_index_persisted():
+    servers = _random_servers(300)
+    index = speedtest.SpeedtestServerIndex()
+    for server in servers + [{"id": "x", "lat": "", "lon": "1"}]:
+        index.add(server)
+    index.build()
+    # Servers with unusable coordinates are left out
+    assert len(index) == 300
+
+    data = json.loads(json.dumps(index.to_dict()))
+    loaded = speedtest.SpeedtestServerIndex.from_dict(data)
+    assert loaded.nearest((10, 10), 20) == index.nearest((10, 10), 20)
+    # A plain server list, as cached before the index existed
+    rebuilt = speedtest.SpeedtestServerIndex.from_dict(servers)
+    assert rebuilt.nearest((10, 10), 20) == index.nearest((10, 10), 20)
+    assert rebuilt.first(lambda s: s["id"] == "42") == servers[42]
+
+
+def _baseline_body(length):
+    # The upload body speedtest-cli has always sent
+    chars = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    return ("content1=" + (chars * (length // 36 + 1))[0 : length - 9]).encode()
+
+
+def test_upload_payload_shared():
+    speedtest.HTTPUploaderPayload.clear()
+    large = speedtest.HTTPUploaderPayload.get(1000000)
+    small = speedtest.HTTPUploaderPayload.get(1000)
+    assert bytes(large) == _baseline_body(1000000)
+    assert bytes(small) == _baseline_body(1000)
+    # Smaller bodies are views of the same buffer, which can not be written
+    assert small.obj is large.obj
+    assert small.readonly
+    # A larger body replaces the buffer
+    assert speedtest.HTTPUploaderPayload.get(2000000).obj is not large.obj
+    speedtest.HTTPUploaderPayload.clear()
+
+
+def test_upload_data_reads_the_payload():
+    data = speedtest.HTTPUploaderData(300000, speedtest.timeit.default_timer(), 10)
+    chunks = []
+    while True:
+        chunk = data.read(65536)
+        if not len(chunk):
+            break
+        assert len(chunk) <= 65536
+        chunks.append(bytes(chunk))
+    assert b"".join(chunks) == _baseline_body(300000)
+    data.rewind()
+    assert bytes(data.read(9)) == b"content1="
+
+
+def _sampled(megabytes, interval=0.25):
+    sampler = speedtest.SpeedtestSampler(0, interval)
+    for i, size in enumerate(megabytes):
+        sampler.add(int(size * 1e6), now=(i + 0.5) * interval)
+    return sampler
+
+
+def test_sampler_excludes_slow_start():
+    sampler = _sampled([0.2, 0.8, 1.6, 3.0, 3.1, 3.0, 3.2, 3.1])
+    summary = sampler.summary(2.0)
+    assert summary["ramp_up"] == 0.75
+    assert summary["steady"] == pytest.approx(3.1e6 * 32, rel=0.01)
+    assert summary["curve"] == [44.8e6, 99.2e6]
+
+
+def test_sampler_ignores_bursts():
+    # Uploads counted once acknowledged: nothing while the server had
+    # stopped reading, then a burst as it catches up
+    megabytes = [2.0, 3.8, 3.9, 0.0, 1.73, 7.67, 4.02, 3.38]
+    summary = _sampled(megabytes).summary(2.0)
+    assert summary["ramp_up"] <= 0.25
+    after_ramp = 2.0 - summary["ramp_up"]
+    assert summary["steady"] <= sum(megabytes) * 8e6 / after_ramp
+    # The burst alone ran at 245 Mbit/s, the test at 106 Mbit/s
+    assert summary["steady"] < 115e6
+
+
+def test_sampler_counts_the_partial_interval():
+    # A stall in the final partial interval, which is left out of the
+    # time series, still holds the steady state down
+    summary = _sampled([3.0] * 8).summary(2.2)
+    assert len(summary["bytes"]) == 8
+    assert summary["steady"] == pytest.approx(24e6 * 8 / 2.2)
+
+
+def _ramp_up(streams, per_stream, capacity, limit=None, seconds=10):
+    """Run a ``SpeedtestStreamRamp`` against a simulated link where each
+    stream moves ``per_stream`` bits/s, up to ``capacity`` in all"""
+    sampler = speedtest.SpeedtestSampler(0)
+    ramp = speedtest.SpeedtestStreamRamp(sampler, streams, limit)
+    step = 0.05
+    for i in range(1, int(seconds / step) + 1):
+        rate = min(capacity, per_stream * ramp.streams)
+        sampler.add(int(rate * step / 8), now=i * step)
+        ramp.update(i * step)
+    return ramp
+
+
+def test_stream_ramp_stops_at_capacity():
+    ramp = _ramp_up(2, 10e6, 100e6)
+    assert ramp.held
+    # Past the 10 streams filling the link, by less than doubling
+    assert 10 <= ramp.streams <= 20
+
+
+def test_stream_ramp_holds_without_gain():
+    ramp = _ramp_up(4, 50e6, 100e6)
+    assert ramp.held
+    assert ramp.streams <= 8
+
+
+def test_stream_ramp_limit():
+    ramp = _ramp_up(2, 1e6, 1e9)
+    assert ramp.held
+    assert ramp.streams == speedtest.SpeedtestStreamRamp.max_streams
+    ramp = _ramp_up(2, 1e6, 1e9, limit=6)
+    assert ramp.streams == 6
+    # A fixed stream count is never changed
+    assert _ramp_up(4, 1e6, 1e9, limit=4).streams == 4
+
+
+def test_connect_samples_spaced():
+    srv = shaped_server()
+    accepted = []
+
+    def verify_request(request, client_address):
+        accepted.append(time.time())
+        return True
+
+    srv.verify_request = verify_request
+    with serving(srv) as srv:
+        st = mini_speedtest(srv)
+        del accepted[:]
+        latency = st.latency(samples=10, connect=True)
+        # Until the server has accepted the last connect
+        time.sleep(0.2)
+    connect = latency["connect"]
+    assert connect["samples"] == 10
+    assert connect["lost"] == 0
+    # Well below a SYN retransmit
+    assert connect["p99"] < 100
+    # The persistent connection of the request samples, then the first
+    # connect, which is not counted, and the 10 samples
+    assert len(accepted) == 12
+    gaps = [b - a for a, b in zip(accepted[1:], accepted[2:])]
+    assert min(gaps) >= st.connect_interval * 0.9
+
+
+def _history_result(download, upload=10e6, ping=20):
+    return speedtest.SpeedtestResults(
+        download=download, upload=upload, ping=ping, server={"id": 1}
+    )
+
+
+def test_history_summary(tmp_path):
+    history = speedtest.SpeedtestHistory(str(tmp_path / "history.sqlite"))
+    assert history.summary() == {"days": 7, "count": 0}
+    for download in (100e6, 90e6, 0, 50e6):
+        history.add(_history_result(download))
+    summary = history.summary()
+    assert summary["count"] == 4
+    # The skipped test, recorded as 0, is left out
+    assert summary["download"]["min"] == 50e6
+    assert summary["download"]["baseline"] == 95e6
+    assert summary["download"]["change"] == -47.4
+
+
+def _main(monkeypatch, *args):
+    monkeypatch.setattr(sys, "argv", ["speedtest"] + list(args))
+    try:
+        speedtest.main()
+    except SystemExit:
+        return sys.exc_info()[1].code
+    return 0
+
+
+def test_history_query_unreadable(monkeypatch, tmp_path):
+    path = tmp_path / "history.sqlite"
+    path.write_bytes(b"not a database" * 100)
+    code = _main(monkeypatch, "--history-query", "--history-file", str(path))
+    assert code.startswith("ERROR: Could not read history:")
+
+
+def test_max_drop_unreadable_history(server, monkeypatch, tmp_path):
+    path = tmp_path / "history.sqlite"
+    path.write_bytes(b"not a database" * 100)
+    errors = []
+    printer = speedtest.printer
+
+    def record(string, *args, **kwargs):
+        if kwargs.get("error"):
+            errors.append(string)
+        printer(string, *args, **kwargs)
+
+    monkeypatch.setattr(speedtest, "printer", record)
+    code = _main(
+        monkeypatch,
+        "--simple",
+        "--no-upload",
+        "--duration",
+        "0.5",
+        "--max-drop",
+        "10",
+        "--history-file",
+        str(path),
+    )
+    assert code == 0
+    assert [e for e in errors if "--max-drop skipped" in e]
+
+
+def test_max_drop_exit_code(server, monkeypatch, tmp_path):
+    history = speedtest.SpeedtestHistory(str(tmp_path / "history.sqlite"))
+    for _ in range(3):
+        history.add(_history_result(1e12, 1e12))
+    code = _main(
+        monkeypatch,
+        "--simple",
+        "--no-upload",
+        "--duration",
+        "0.5",
+        "--max-drop",
+        "10",
+        "--history",
+        "--history-file",
+        history.path,
+    )
+    assert code == speedtest.SpeedtestThresholdFailure.dropped
+
+
+@pytest.mark.parametrize(
+    "args, code",
+    [
+        (["--min-download", "1000000"], speedtest.SpeedtestThresholdFailure.failed),
+        (["--min-download", "0.001"], 0),
+    ],
+)
+def test_threshold_exit_code(server, monkeypatch, args, code):
+    common = ["--simple", "--no-upload", "--duration", "0.5"]
+    assert _main(monkeypatch, *(common + args)) == code
+
+
+def test_version_imports():
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", bench.SCRIPT, "--version"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    assert speedtest.__version__ in process.stdout
+    imported = set(re.findall(r"\| +(\S+)$", process.stderr, re.M))
+    for name in ("asyncio", "csv", "sqlite3", "platform"):
+        assert name not in imported
+    assert "xml.etree.ElementTree" not in imported
+
+
+def _startup(*args):
+    command = [sys.executable, bench.__file__, "startup", "--runs", "1", "--top", "0"]
+    return subprocess.run(command + list(args), stdout=subprocess.DEVNULL).returncode
+
+
+def test_startup_compares_with_baseline(tmp_path):
+    baseline = tmp_path / "baseline.py"
+    baseline.write_text("print('0')\n")
+    assert _startup("--baseline", str(baseline)) == 1
+    assert _startup("--baseline", bench.SCRIPT, "--tolerance", "100") == 0
+
+
+class FailingHandler(bench.MiniHandler):
+    """MiniHandler answering every upload after the first with an invalid
+    status line"""
+
+    def do_POST(self):
+        self.server.posts += 1
+        if self.server.posts == 1:
+            return bench.MiniHandler.do_POST(self)
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.close_connection = True
+        self.wfile.write(b"BOGUS\r\n\r\n")
+
+
+@pytest.mark.parametrize("pooled", [False, True])
+def test_uploader_keeps_bytes_sent_before_an_error(pooled):
+    srv = bench.MiniServer(("127.0.0.1", 0))
+    srv.RequestHandlerClass = FailingHandler
+    srv.posts = 0
+    with serving(srv):
+        url = "http://127.0.0.1:%d/speedtest/upload.php" % srv.server_port
+        pool = pooled and speedtest.SpeedtestConnectionPool() or None
+        request = _upload_request(url)
+        uploader = speedtest.HTTPUploader(
+            0,
+            request,
+            speedtest.timeit.default_timer(),
+            100000,
+            10,
+            opener=speedtest.build_opener(pool=pool),
+            repeat=True,
+        )
+        uploader.run()
+    assert isinstance(uploader.error, speedtest.BadStatusLine)
+    # The first upload completed, the failed ones may have been received
+    # too, the pooled connection retries the second once
+    assert 100000 <= uploader.result <= 100000 * srv.posts
+
+
+def test_site_lock_slots(tmp_path):
+    path = str(tmp_path / "site")
+    first = speedtest.SpeedtestSiteLock(path, timeout=0)
+    first.acquire()
+    assert first.slot == 0
+    second = speedtest.SpeedtestSiteLock(path, timeout=0)
+    with pytest.raises(speedtest.SpeedtestSiteLockTimeout):
+        second.acquire()
+    first.release()
+    second.acquire()
+    assert second.slot == 0
+    second.release()
+    assert not os.listdir(str(tmp_path))
+
+
+def test_site_lock_expires_stale(tmp_path):
+    path = str(tmp_path / "site")
+    with open(path + ".0", "w") as f:
+        f.write("crashed agent")
+    lock = speedtest.SpeedtestSiteLock(path, timeout=5)
+    lock.stale = 0.05
+    lock.backoff = 0.1
+    lock.acquire()
+    assert lock.slot == 0
+    with open(path + ".0") as f:
+        assert f.read() == lock._token
+    lock.release()
+    assert not os.listdir(str(tmp_path))
+
+
+def test_site_lock_keeps_lock_taken_meanwhile(tmp_path):
+    path = str(tmp_path / "site.0")
+    with open(path, "w") as f:
+        f.write("crashed agent")
+    lock = speedtest.SpeedtestSiteLock(str(tmp_path / "site"))
+    lock.stale = 0.01
+    lock._expire(path)
+    time.sleep(0.02)
+    stale = lock._owner(path)
+
+    # Another agent expires the file and takes the slot right after this
+    # one saw the stale file
+    os.remove(path)
+    with open(path, "w") as f:
+        f.write("other agent")
+    owner = lock._owner
+    seen = []
+
+    def stale_then_owner(name):
+        if not seen:
+            seen.append(name)
+            return stale
+        return owner(name)
+
+    lock._owner = stale_then_owner
+    lock._expire(path)
+    with open(path) as f:
+        assert f.read() == "other agent"
+    assert not glob.glob(str(tmp_path / "*.stale"))
+
+
+def _budget_test(engine, direction, budget, tolerance=0.05, duration=10):
+    with serving(shaped_server()) as srv:
+        st = mini_speedtest(
+            srv,
+            engine,
+            length=10,
+            duration=duration,
+            budget=budget,
+            budget_tolerance=tolerance,
+        )
+        bps = getattr(st, direction)()
+    moved = st.results.bytes_received
+    if direction == "upload":
+        moved = st.results.bytes_sent
+    # The bytes moved over the time taken
+    rate = moved * 8.0 / st.profile.phases[direction]["wall"]
+    return bps, rate, st.results.budget[direction]
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_budget_converges(engine):
+    bps, rate, budget = _budget_test(engine, "download", 200e6)
+    assert budget["stopped"] == "converged"
+    assert bps == budget["estimate"]
+    assert RATE * 0.9e6 <= bps <= RATE * 1.05e6
+
+
+@pytest.mark.parametrize("direction", ["download", "upload"])
+def test_budget_limit(direction):
+    bps, rate, budget = _budget_test("threads", direction, 5e6)
+    assert budget["stopped"] == "limit"
+    assert budget["estimate"] is None
+    assert bps == pytest.approx(rate, rel=0.1)
+    if direction == "download":
+        # A short upload partly lands in the socket buffers
+        assert bps <= RATE * 1.1e6
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_budget_not_converged(engine):
+    bps, rate, budget = _budget_test(engine, "upload", 200e6, 1e-6, duration=2)
+    assert budget["stopped"] is None
+    assert budget["estimate"] is None
+    assert bps == pytest.approx(rate, rel=0.1)
+    assert RATE * 0.9e6 <= bps <= RATE * 1.1e6
+
+
+class MiniServer6(bench.MiniServer):
+    address_family = socket.AF_INET6
+
+
+def _family_server(family):
+    """Return a shaped server listening over ``family`` only, and its host"""
+    if family == socket.AF_INET6:
+        srv, host = MiniServer6(("::1", 0)), "[::1]"
+    else:
+        srv, host = bench.MiniServer(("127.0.0.1", 0)), "127.0.0.1"
+    srv.shaper = CountingShaper(RATE)
+    return srv, host
+
+
+def test_create_connection_family():
+    with serving(counting_server()) as srv:
+        address = ("127.0.0.1", srv.server_port)
+        sock = speedtest.create_connection(address, 5, family=socket.AF_INET)
+        assert sock.family == socket.AF_INET
+        sock.close()
+        with pytest.raises(socket.error):
+            speedtest.create_connection(address, 5, family=socket.AF_INET6)
+
+
+def test_pin_keeps_its_own_results():
+    with serving(shaped_server()) as srv:
+        st = mini_speedtest(srv, duration=1)
+        pinned = st.pin(socket.AF_INET)
+        assert pinned.best == st.best
+        assert pinned.best is not st.best
+        assert pinned._pool.family == socket.AF_INET
+        assert pinned.download() > 0
+    assert pinned.results.bytes_received > 0
+    assert st.results.bytes_received == 0
+
+
+@pytest.mark.parametrize("family", [socket.AF_INET, socket.AF_INET6])
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_dual_stack_reports_the_unreachable_family(engine, family):
+    srv, host = _family_server(family)
+    with serving(srv):
+        config = bench.bench_config(3, (8, 2))
+        st = bench.make_engine(speedtest, engine, config)(duration=1)
+        url = "http://%s:%d/speedtest/" % (host, srv.server_port)
+        st.get_best_server(st.set_mini_server(url))
+        report = st.dual_stack(samples=3)
+    if family == socket.AF_INET:
+        up, down = "ipv4", "ipv6"
+    else:
+        up, down = "ipv6", "ipv4"
+    assert "error" in report[down]
+    assert "error" not in report[up]
+    assert report[up]["default"]
+    assert report[up]["download"] > 0 and report[up]["upload"] > 0
+    assert "delta" not in report
+    # The family that answered provides the main results
+    assert st.results.download == report[up]["download"]
+    assert st.results.dual_stack is report
+    assert "%s_download" % up in st.profile.phases
+
+
+def _meter():
+    return speedtest.SpeedtestTransferMeter(speedtest.timeit.default_timer(), 10)
+
+
+def test_discard_sink_buffer_per_thread():
+    sink = speedtest.SpeedtestDiscardSink(1024)
+    view = sink.buffer()
+    assert isinstance(view, memoryview) and len(view) == 1024
+    assert sink.buffer() is view
+    other = []
+    thread = threading.Thread(target=lambda: other.append(sink.buffer()))
+    thread.start()
+    thread.join()
+    assert other[0] is not view
+
+
+class ReadOnlyBody(object):
+    def __init__(self, body):
+        self.read = io.BytesIO(body).read
+
+
+@pytest.mark.parametrize("body_class", [io.BytesIO, ReadOnlyBody])
+def test_discard_sink_counts_the_body(body_class):
+    sink = speedtest.SpeedtestDiscardSink()
+    meter = _meter()
+    sink.drain(body_class(os.urandom(1000000)), meter)
+    assert meter.flush() == 1000000
+
+
+class BrokenBody(io.BytesIO):
+    def readinto(self, view):
+        raise IOError("connection reset")
+
+
+class FakeOpener(object):
+    def __init__(self, response):
+        self.response = response
+
+    def open(self, request):
+        return self.response
+
+
+def test_downloader_closes_a_failed_response():
+    body = BrokenBody()
+    request = speedtest.build_request("http://127.0.0.1/")
+    downloader = speedtest.HTTPDownloader(
+        0, request, speedtest.timeit.default_timer(), 10, opener=FakeOpener(body)
+    )
+    downloader.run()
+    assert isinstance(downloader.error, IOError)
+    assert body.closed
+    assert sum(downloader.result) == 0